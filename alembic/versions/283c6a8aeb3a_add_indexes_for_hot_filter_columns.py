@@ -0,0 +1,64 @@
+"""Add indexes for hot filter columns
+
+Revision ID: 283c6a8aeb3a
+Revises: fa6eb3733ff5
+Create Date: 2026-10-18 11:03:27.518302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '283c6a8aeb3a'
+down_revision: Union[str, Sequence[str], None] = 'fa6eb3733ff5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PACKAGING_LOG_DETAILS = "Телефон упакован и готов к приемке на склад."
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Телефоны: фильтры по статусам и поиск по серийному номеру без учета регистра
+    op.create_index('ix_phones_commercial_status_model_id', 'phones', ['commercial_status', 'model_id'], unique=False)
+    op.create_index('ix_phones_technical_status', 'phones', ['technical_status'], unique=False)
+    op.create_index('ix_phones_serial_number_lower', 'phones', [sa.text('lower(serial_number)')], unique=False)
+
+    # История движений телефона
+    op.create_index('ix_phone_movement_log_phone_id_timestamp', 'phone_movement_log', ['phone_id', 'timestamp'], unique=False)
+    op.create_index('ix_phone_movement_log_event_type_timestamp', 'phone_movement_log', ['event_type', 'timestamp'], unique=False)
+    op.create_index(
+        'ix_phone_movement_log_packaging', 'phone_movement_log', ['timestamp', 'user_id', 'phone_id'], unique=False,
+        postgresql_where=sa.text(f"details = '{PACKAGING_LOG_DETAILS}'")
+    )
+
+    # Склад, продажи и движение денег
+    op.create_index('ix_warehouse_product_type_id_product_id', 'warehouse', ['product_type_id', 'product_id', 'id'], unique=False)
+    op.create_index('ix_sales_sale_date', 'sales', ['sale_date'], unique=False)
+    op.create_index('ix_sales_user_id_sale_date', 'sales', ['user_id', 'sale_date'], unique=False)
+    op.create_index('ix_sale_details_sale_id', 'sale_details', ['sale_id'], unique=False)
+    op.create_index('ix_sale_details_warehouse_id', 'sale_details', ['warehouse_id'], unique=False)
+    op.create_index('ix_cash_flow_date', 'cash_flow', ['date'], unique=False)
+    op.create_index('ix_cash_flow_account_id_date', 'cash_flow', ['account_id', 'date'], unique=False)
+    op.create_index('ix_device_inspection_user_id_inspection_date', 'device_inspection', ['user_id', 'inspection_date'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_device_inspection_user_id_inspection_date', table_name='device_inspection')
+    op.drop_index('ix_cash_flow_account_id_date', table_name='cash_flow')
+    op.drop_index('ix_cash_flow_date', table_name='cash_flow')
+    op.drop_index('ix_sale_details_warehouse_id', table_name='sale_details')
+    op.drop_index('ix_sale_details_sale_id', table_name='sale_details')
+    op.drop_index('ix_sales_user_id_sale_date', table_name='sales')
+    op.drop_index('ix_sales_sale_date', table_name='sales')
+    op.drop_index('ix_warehouse_product_type_id_product_id', table_name='warehouse')
+    op.drop_index('ix_phone_movement_log_packaging', table_name='phone_movement_log')
+    op.drop_index('ix_phone_movement_log_event_type_timestamp', table_name='phone_movement_log')
+    op.drop_index('ix_phone_movement_log_phone_id_timestamp', table_name='phone_movement_log')
+    op.drop_index('ix_phones_serial_number_lower', table_name='phones')
+    op.drop_index('ix_phones_technical_status', table_name='phones')
+    op.drop_index('ix_phones_commercial_status_model_id', table_name='phones')
@@ -0,0 +1,43 @@
+"""Add account_balances
+
+Revision ID: 7f3d5b1e9a42
+Revises: e2b7c4a9f631
+Create Date: 2026-10-18 16:40:05.772914
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7f3d5b1e9a42'
+down_revision: Union[str, Sequence[str], None] = 'e2b7c4a9f631'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('account_balances',
+    sa.Column('account_id', sa.Integer(), nullable=False),
+    sa.Column('balance', sa.Numeric(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+    sa.PrimaryKeyConstraint('account_id')
+    )
+
+    # Первичное заполнение (та же логика, что в app/balances.py)
+    op.execute("""
+        INSERT INTO account_balances (account_id, balance, updated_at)
+        SELECT account_id, coalesce(sum(amount), 0), now()
+        FROM cash_flow
+        WHERE account_id IS NOT NULL
+        GROUP BY account_id
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('account_balances')
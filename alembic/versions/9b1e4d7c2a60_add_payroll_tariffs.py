@@ -0,0 +1,45 @@
+"""Add payroll_tariffs
+
+Revision ID: 9b1e4d7c2a60
+Revises: 283c6a8aeb3a
+Create Date: 2026-10-18 12:20:05.114093
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b1e4d7c2a60'
+down_revision: Union[str, Sequence[str], None] = '283c6a8aeb3a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    payroll_tariffs = op.create_table('payroll_tariffs',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('code', sa.String(length=50), nullable=False),
+    sa.Column('name', sa.String(length=255), nullable=True),
+    sa.Column('rate', sa.Numeric(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.func.now(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('code')
+    )
+
+    # Текущие ставки, которые раньше были зашиты в get_payroll_report
+    op.bulk_insert(payroll_tariffs, [
+        {'code': 'inspections', 'name': 'Проверка устройства', 'rate': 150},
+        {'code': 'battery_tests', 'name': 'Тест аккумулятора', 'rate': 50},
+        {'code': 'packaging', 'name': 'Упаковка телефона', 'rate': 100},
+        {'code': 'shifts', 'name': 'Смена продавца', 'rate': 2000},
+        {'code': 'phone_sales_bonus', 'name': 'Бонус за проданный телефон', 'rate': 500},
+    ])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('payroll_tariffs')
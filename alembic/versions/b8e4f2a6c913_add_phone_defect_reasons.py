@@ -0,0 +1,104 @@
+"""Add phone_defect_reasons
+
+Revision ID: b8e4f2a6c913
+Revises: 7f3d5b1e9a42
+Create Date: 2026-10-18 17:05:51.204387
+
+"""
+from datetime import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8e4f2a6c913'
+down_revision: Union[str, Sequence[str], None] = '7f3d5b1e9a42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PHONE_EVENT_TYPES = (
+    'ПОСТУПЛЕНИЕ_ОТ_ПОСТАВЩИКА', 'ИНСПЕКЦИЯ_ПРОЙДЕНА', 'ОБНАРУЖЕН_БРАК', 'ПРИНЯТ_НА_СКЛАД', 'ПРОДАН',
+    'ВОЗВРАТ_ОТ_КЛИЕНТА', 'ОТПРАВЛЕН_ПОСТАВЩИКУ', 'ПОЛУЧЕН_ОТ_ПОСТАВЩИКА', 'ОТПРАВЛЕН_В_РЕМОНТ',
+    'ПОЛУЧЕН_ИЗ_РЕМОНТА', 'ОБМЕНЕН', 'ПЕРЕМЕЩЕНИЕ', 'ВЫДАН_КАК_ПОДМЕННЫЙ', 'ПРИНЯТ_ИЗ_ПОДМЕНЫ', 'ОТМЕНА_ПРОДАЖИ',
+)
+CHECKLIST_MARKER = "--- Результаты проверки ---"
+BATCH_SIZE = 1000
+
+
+def _parse_log(log, checklist_ids):
+    """Строки причин из одного лога - тот же разбор, что делал get_defective_phones по тексту."""
+    base = {
+        "phone_id": log.phone_id, "movement_log_id": log.id, "event_type": log.event_type,
+        "checklist_item_id": None, "created_at": log.timestamp or datetime.now(),
+    }
+    details = log.details
+    if not details:
+        return [{**base, "reason_code": "log", "reason": log.event_type}]
+
+    if log.event_type == 'ОБНАРУЖЕН_БРАК' and CHECKLIST_MARKER in details:
+        checklist_str = details.split(CHECKLIST_MARKER)[1]
+        failed_items = [
+            line.strip().replace(": БРАК", "").split('(')[0].strip()
+            for line in checklist_str.strip().split('\n')
+            if "БРАК" in line
+        ]
+        if not failed_items:
+            return [{**base, "reason_code": "log", "reason": "Брак по результатам инспекции"}]
+        return [
+            {**base, "reason_code": "checklist", "checklist_item_id": checklist_ids.get(name), "reason": name}
+            for name in failed_items
+        ]
+
+    reason_code = {
+        'ВОЗВРАТ_ОТ_КЛИЕНТА': "customer_return",
+        'ОБМЕНЕН': "exchange",
+    }.get(log.event_type, "battery_test" if details.startswith("Тест АКБ") else "log")
+    return [{**base, "reason_code": reason_code, "reason": details}]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    defect_reasons = op.create_table('phone_defect_reasons',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('phone_id', sa.Integer(), nullable=False),
+    sa.Column('movement_log_id', sa.Integer(), nullable=True),
+    sa.Column('event_type', sa.Enum(*PHONE_EVENT_TYPES, name='phoneeventtype', native_enum=False), nullable=False),
+    sa.Column('reason_code', sa.String(length=50), nullable=False),
+    sa.Column('checklist_item_id', sa.Integer(), nullable=True),
+    sa.Column('reason', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['checklist_item_id'], ['checklist_items.id'], ),
+    sa.ForeignKeyConstraint(['movement_log_id'], ['phone_movement_log.id'], ),
+    sa.ForeignKeyConstraint(['phone_id'], ['phones.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_phone_defect_reasons_phone_id_created_at', 'phone_defect_reasons', ['phone_id', 'created_at'], unique=False)
+
+    # Однократный разбор существующих логов
+    bind = op.get_bind()
+    checklist_ids = {
+        row.name: row.id
+        for row in bind.execute(sa.text("SELECT id, name FROM checklist_items WHERE name IS NOT NULL"))
+    }
+    logs = bind.execute(sa.text("""
+        SELECT id, phone_id, timestamp, event_type, details
+        FROM phone_movement_log
+        WHERE event_type IN ('ОБНАРУЖЕН_БРАК', 'ВОЗВРАТ_ОТ_КЛИЕНТА', 'ОБМЕНЕН') AND phone_id IS NOT NULL
+        ORDER BY id
+    """)).all()
+    batch = []
+    for log in logs:
+        batch.extend(_parse_log(log, checklist_ids))
+        if len(batch) >= BATCH_SIZE:
+            op.bulk_insert(defect_reasons, batch)
+            batch = []
+    if batch:
+        op.bulk_insert(defect_reasons, batch)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_phone_defect_reasons_phone_id_created_at', table_name='phone_defect_reasons')
+    op.drop_table('phone_defect_reasons')
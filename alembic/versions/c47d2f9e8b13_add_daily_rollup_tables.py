@@ -0,0 +1,112 @@
+"""Add daily rollup tables for analytics
+
+Revision ID: c47d2f9e8b13
+Revises: 9b1e4d7c2a60
+Create Date: 2026-10-18 13:05:42.871130
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c47d2f9e8b13'
+down_revision: Union[str, Sequence[str], None] = '9b1e4d7c2a60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('daily_sales_rollup',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('source_id', sa.Integer(), nullable=True),
+    sa.Column('sales_count', sa.Integer(), nullable=False),
+    sa.Column('revenue', sa.Numeric(), nullable=False),
+    sa.Column('profit', sa.Numeric(), nullable=False),
+    sa.Column('card_revenue', sa.Numeric(), nullable=False),
+    sa.ForeignKeyConstraint(['source_id'], ['traffic_sources.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_daily_sales_rollup_day'), 'daily_sales_rollup', ['day'], unique=False)
+
+    op.create_table('daily_model_sales_rollup',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('model_name_id', sa.Integer(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.Column('revenue', sa.Numeric(), nullable=False),
+    sa.Column('priced_lines', sa.Integer(), nullable=False),
+    sa.Column('priced_sum', sa.Numeric(), nullable=False),
+    sa.Column('purchase_lines', sa.Integer(), nullable=False),
+    sa.Column('purchase_sum', sa.Numeric(), nullable=False),
+    sa.ForeignKeyConstraint(['model_name_id'], ['model_name.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_daily_model_sales_rollup_day'), 'daily_model_sales_rollup', ['day'], unique=False)
+
+    op.create_table('daily_cash_flow_rollup',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=True),
+    sa.Column('operation_categories_id', sa.Integer(), nullable=True),
+    sa.Column('operations_count', sa.Integer(), nullable=False),
+    sa.Column('amount', sa.Numeric(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+    sa.ForeignKeyConstraint(['operation_categories_id'], ['operation_categories.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_daily_cash_flow_rollup_day'), 'daily_cash_flow_rollup', ['day'], unique=False)
+
+    # Первичное заполнение за всю историю (та же логика, что в app/rollups.py)
+    op.execute("""
+        INSERT INTO daily_sales_rollup (day, user_id, source_id, sales_count, revenue, profit, card_revenue)
+        SELECT date(s.sale_date), s.user_id, c.source_id, count(s.id),
+               coalesce(sum(s.total_amount), 0), coalesce(sum(p.profit), 0), coalesce(sum(cp.amount), 0)
+        FROM sales s
+        LEFT JOIN customers c ON c.id = s.customer_id
+        LEFT JOIN (SELECT sale_id, sum(profit) AS profit FROM sale_details GROUP BY sale_id) p ON p.sale_id = s.id
+        LEFT JOIN (SELECT sale_id, sum(amount) AS amount FROM sale_payments
+                   WHERE payment_method = 'КАРТА' GROUP BY sale_id) cp ON cp.sale_id = s.id
+        WHERE s.sale_date IS NOT NULL
+        GROUP BY date(s.sale_date), s.user_id, c.source_id
+    """)
+    op.execute("""
+        INSERT INTO daily_model_sales_rollup (day, model_name_id, units, revenue, priced_lines, priced_sum, purchase_lines, purchase_sum)
+        SELECT date(s.sale_date), m.model_name_id,
+               coalesce(sum(sd.quantity), 0),
+               coalesce(sum(sd.unit_price * sd.quantity), 0),
+               count(sd.id) FILTER (WHERE sd.unit_price > 0),
+               coalesce(sum(sd.unit_price) FILTER (WHERE sd.unit_price > 0), 0),
+               count(sd.id) FILTER (WHERE sd.unit_price > 0 AND p.purchase_price IS NOT NULL),
+               coalesce(sum(p.purchase_price) FILTER (WHERE sd.unit_price > 0 AND p.purchase_price IS NOT NULL), 0)
+        FROM sale_details sd
+        JOIN sales s ON s.id = sd.sale_id
+        JOIN warehouse w ON w.id = sd.warehouse_id
+        JOIN phones p ON p.id = w.product_id
+        JOIN models m ON m.id = p.model_id
+        WHERE w.product_type_id = 1 AND m.model_name_id IS NOT NULL AND s.sale_date IS NOT NULL
+        GROUP BY date(s.sale_date), m.model_name_id
+    """)
+    op.execute("""
+        INSERT INTO daily_cash_flow_rollup (day, account_id, operation_categories_id, operations_count, amount)
+        SELECT date(cf.date), cf.account_id, cf.operation_categories_id, count(cf.id), coalesce(sum(cf.amount), 0)
+        FROM cash_flow cf
+        WHERE cf.date IS NOT NULL
+        GROUP BY date(cf.date), cf.account_id, cf.operation_categories_id
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_daily_cash_flow_rollup_day'), table_name='daily_cash_flow_rollup')
+    op.drop_table('daily_cash_flow_rollup')
+    op.drop_index(op.f('ix_daily_model_sales_rollup_day'), table_name='daily_model_sales_rollup')
+    op.drop_table('daily_model_sales_rollup')
+    op.drop_index(op.f('ix_daily_sales_rollup_day'), table_name='daily_sales_rollup')
+    op.drop_table('daily_sales_rollup')
@@ -0,0 +1,43 @@
+"""Add sdek_webhook_events and indexes on sdek_order_uuid
+
+Revision ID: d3a8f61b5e27
+Revises: c47d2f9e8b13
+Create Date: 2026-10-18 14:10:27.402516
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3a8f61b5e27'
+down_revision: Union[str, Sequence[str], None] = 'c47d2f9e8b13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('sdek_webhook_events',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('order_uuid', sa.String(length=255), nullable=False),
+    sa.Column('status_code', sa.String(length=100), nullable=False),
+    sa.Column('status_date_time', sa.String(length=64), nullable=False),
+    sa.Column('received_at', sa.DateTime(), nullable=True),
+    sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('order_uuid', 'status_code', 'status_date_time', name='uq_sdek_webhook_events_event')
+    )
+    # Вебхук находит заказ/возврат по UUID СДЭК
+    op.create_index(op.f('ix_supplier_orders_sdek_order_uuid'), 'supplier_orders', ['sdek_order_uuid'], unique=False)
+    op.create_index(op.f('ix_return_shipments_sdek_order_uuid'), 'return_shipments', ['sdek_order_uuid'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_return_shipments_sdek_order_uuid'), table_name='return_shipments')
+    op.drop_index(op.f('ix_supplier_orders_sdek_order_uuid'), table_name='supplier_orders')
+    op.drop_table('sdek_webhook_events')
@@ -0,0 +1,35 @@
+"""Add id to cash_flow date indexes
+
+Revision ID: e2b7c4a9f631
+Revises: 5c9e2a7d4f18
+Create Date: 2026-10-18 16:12:40.318604
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2b7c4a9f631'
+down_revision: Union[str, Sequence[str], None] = '5c9e2a7d4f18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Ключ keyset-пагинации движения денег - (date, id): индексы покрывают его целиком
+    op.drop_index('ix_cash_flow_account_id_date', table_name='cash_flow')
+    op.drop_index('ix_cash_flow_date', table_name='cash_flow')
+    op.create_index('ix_cash_flow_date_id', 'cash_flow', ['date', 'id'], unique=False)
+    op.create_index('ix_cash_flow_account_id_date_id', 'cash_flow', ['account_id', 'date', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_cash_flow_account_id_date_id', table_name='cash_flow')
+    op.drop_index('ix_cash_flow_date_id', table_name='cash_flow')
+    op.create_index('ix_cash_flow_date', 'cash_flow', ['date'], unique=False)
+    op.create_index('ix_cash_flow_account_id_date', 'cash_flow', ['account_id', 'date'], unique=False)
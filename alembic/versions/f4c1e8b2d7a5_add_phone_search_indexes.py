@@ -0,0 +1,40 @@
+"""Add trigram indexes for phone search
+
+Revision ID: f4c1e8b2d7a5
+Revises: b8e4f2a6c913
+Create Date: 2026-10-18 17:38:22.640917
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f4c1e8b2d7a5'
+down_revision: Union[str, Sequence[str], None] = 'b8e4f2a6c913'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # Поиск по фрагменту серийного номера/IMEI и модельного номера (LIKE '%...%' и нечеткое совпадение)
+    op.create_index(
+        'ix_phones_serial_number_trgm', 'phones', [sa.text('lower(serial_number) gin_trgm_ops')],
+        unique=False, postgresql_using='gin'
+    )
+    op.create_index(
+        'ix_model_number_name_trgm', 'model_number', [sa.text('lower(name) gin_trgm_ops')],
+        unique=False, postgresql_using='gin'
+    )
+    op.create_index('ix_phones_model_number_id', 'phones', ['model_number_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_phones_model_number_id', table_name='phones')
+    op.drop_index('ix_model_number_name_trgm', table_name='model_number')
+    op.drop_index('ix_phones_serial_number_trgm', table_name='phones')
@@ -0,0 +1,51 @@
+"""Add phone_current_location projection
+
+Revision ID: fa6eb3733ff5
+Revises: 667100551065
+Create Date: 2026-10-18 10:12:41.204517
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'fa6eb3733ff5'
+down_revision: Union[str, Sequence[str], None] = '667100551065'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Creates phone_current_location and fills it from warehouse history."""
+    op.create_table('phone_current_location',
+    sa.Column('phone_id', sa.Integer(), nullable=False),
+    sa.Column('warehouse_id', sa.Integer(), nullable=False),
+    sa.Column('shop_id', sa.Integer(), nullable=True),
+    sa.Column('storage_location', sa.Enum('СКЛАД', 'ВИТРИНА', 'ПОДМЕННЫЙ_ФОНД', name='enumshop', native_enum=False), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['phone_id'], ['phones.id'], ),
+    sa.ForeignKeyConstraint(['warehouse_id'], ['warehouse.id'], ),
+    sa.ForeignKeyConstraint(['shop_id'], ['shops.id'], ),
+    sa.PrimaryKeyConstraint('phone_id')
+    )
+    op.create_index(op.f('ix_phone_current_location_storage_location'), 'phone_current_location', ['storage_location'], unique=False)
+
+    # Первичное заполнение: последняя складская запись по каждому телефону
+    op.execute("""
+        INSERT INTO phone_current_location (phone_id, warehouse_id, shop_id, storage_location, updated_at)
+        SELECT DISTINCT ON (w.product_id)
+               w.product_id, w.id, w.shop_id, w.storage_location, now()
+        FROM warehouse w
+        JOIN phones p ON p.id = w.product_id
+        WHERE w.product_type_id = 1
+        ORDER BY w.product_id, w.id DESC
+    """)
+
+
+def downgrade() -> None:
+    """Drops phone_current_location."""
+    op.drop_index(op.f('ix_phone_current_location_storage_location'), table_name='phone_current_location')
+    op.drop_table('phone_current_location')
@@ -0,0 +1,172 @@
+# app/balances.py
+"""
+Текущие балансы счетов (таблица account_balances).
+
+Баланс счета меняется в той же транзакции, что и cash_flow:
+  * записи, добавленные/измененные/удаленные через сессию ORM, учитываются
+    автоматически - после flush изменения сумм по счетам применяются одним
+    INSERT ... ON CONFLICT DO UPDATE SET balance = balance + delta;
+  * для пакетных insert(models.CashFlow) в обход unit of work вызывается
+    apply_cash_flow_rows(db, rows).
+
+check_account_balances сравнивает таблицу с SUM по cash_flow и возвращает расхождения,
+rebuild_account_balances пересчитывает ее целиком (скрипт check_account_balances.py).
+Операции без счета (account_id IS NULL) в балансы не попадают.
+"""
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from itertools import chain
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, event, func, inspect as sa_inspect, insert, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import models
+
+
+_balances = models.AccountBalance.__table__
+_cash_flow = models.CashFlow.__table__
+
+
+# --- Изменение балансов ---
+
+def _upsert_deltas(deltas: Dict[int, Decimal]):
+    """Один INSERT ... ON CONFLICT на все счета; порядок по account_id исключает взаимные блокировки."""
+    now = datetime.now()
+    rows = [
+        {"account_id": account_id, "balance": delta, "updated_at": now}
+        for account_id, delta in sorted(deltas.items())
+        if delta
+    ]
+    if not rows:
+        return None
+    stmt = pg_insert(_balances).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[_balances.c.account_id],
+        set_={"balance": _balances.c.balance + stmt.excluded.balance, "updated_at": stmt.excluded.updated_at},
+    )
+
+
+def _rebuild_statements():
+    actual = (
+        select(_cash_flow.c.account_id, func.coalesce(func.sum(_cash_flow.c.amount), 0), func.now())
+        .where(_cash_flow.c.account_id.is_not(None))
+        .group_by(_cash_flow.c.account_id)
+    )
+    return (
+        # Ждем транзакции, которые уже изменили балансы, и не даем новым изменить их до нашего commit
+        text("LOCK TABLE account_balances IN SHARE ROW EXCLUSIVE MODE"),
+        delete(_balances),
+        insert(_balances).from_select(["account_id", "balance", "updated_at"], actual),
+    )
+
+
+def _add(deltas: Dict[int, Decimal], account_id: Optional[int], amount, sign: int = 1) -> None:
+    if account_id is not None and amount:
+        deltas[account_id] += sign * Decimal(amount)
+
+
+def _old_and_new(state, key: str):
+    """(старое, новое) значение атрибута; LookupError, если прежнее значение неизвестно (не загружалось)."""
+    history = state.attrs[key].history
+    if history.unchanged:
+        return history.unchanged[0], history.unchanged[0]
+    if history.deleted:
+        return history.deleted[0], history.added[0] if history.added else None
+    raise LookupError(key)
+
+
+def _collect_deltas(session) -> Optional[Dict[int, Decimal]]:
+    """Изменения балансов по счетам из flush. None - изменения не восстановить, нужен полный пересчет."""
+    deltas: Dict[int, Decimal] = defaultdict(Decimal)
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, models.CashFlow):
+            continue
+        state = sa_inspect(obj)
+        if obj in session.new:
+            _add(deltas, state.dict.get("account_id"), state.dict.get("amount"))
+        elif obj in session.deleted:
+            if "account_id" not in state.dict or "amount" not in state.dict:
+                return None
+            _add(deltas, state.dict["account_id"], state.dict["amount"], sign=-1)
+        else:
+            if not (state.attrs.amount.history.has_changes() or state.attrs.account_id.history.has_changes()):
+                continue
+            try:
+                old_account, new_account = _old_and_new(state, "account_id")
+                old_amount, new_amount = _old_and_new(state, "amount")
+            except LookupError:
+                return None
+            _add(deltas, old_account, old_amount, sign=-1)
+            _add(deltas, new_account, new_amount)
+    return deltas
+
+
+@event.listens_for(Session, "after_flush")
+def _apply_flushed_cash_flow(session, flush_context):
+    if not any(isinstance(obj, models.CashFlow) for obj in chain(session.new, session.dirty, session.deleted)):
+        return
+    deltas = _collect_deltas(session)
+    connection = session.connection()
+    if deltas is None:
+        for stmt in _rebuild_statements():
+            connection.execute(stmt)
+        return
+    stmt = _upsert_deltas(deltas)
+    if stmt is not None:
+        connection.execute(stmt)
+
+
+async def apply_cash_flow_rows(db: AsyncSession, rows: Iterable[dict]) -> None:
+    """Учитывает в балансах записи cash_flow, вставленные пакетным insert() (в текущей транзакции)."""
+    deltas: Dict[int, Decimal] = defaultdict(Decimal)
+    for row in rows:
+        _add(deltas, row.get("account_id"), row.get("amount"))
+    stmt = _upsert_deltas(deltas)
+    if stmt is not None:
+        await db.execute(stmt)
+
+
+# --- Сверка ---
+
+async def check_account_balances(db: AsyncSession) -> List[dict]:
+    """Счета, у которых баланс в account_balances расходится с SUM(cash_flow.amount)."""
+    actual = (
+        select(_cash_flow.c.account_id, func.sum(_cash_flow.c.amount).label("amount"))
+        .where(_cash_flow.c.account_id.is_not(None))
+        .group_by(_cash_flow.c.account_id)
+        .subquery()
+    )
+    ledger_balance = func.coalesce(_balances.c.balance, 0)
+    actual_balance = func.coalesce(actual.c.amount, 0)
+    result = await db.execute(
+        select(
+            func.coalesce(_balances.c.account_id, actual.c.account_id).label("account_id"),
+            ledger_balance.label("ledger_balance"),
+            actual_balance.label("actual_balance"),
+        )
+        .select_from(_balances.join(actual, _balances.c.account_id == actual.c.account_id, full=True))
+        .where(ledger_balance != actual_balance)
+        .order_by("account_id")
+    )
+    return [
+        {**row, "drift": row["ledger_balance"] - row["actual_balance"]}
+        for row in result.mappings().all()
+    ]
+
+
+async def get_unassigned_cash_flow_amount(db: AsyncSession) -> Decimal:
+    """Сумма операций без счета - они не входят ни в один баланс."""
+    result = await db.execute(
+        select(func.coalesce(func.sum(_cash_flow.c.amount), 0)).where(_cash_flow.c.account_id.is_(None))
+    )
+    return result.scalar_one()
+
+
+async def rebuild_account_balances(db: AsyncSession) -> None:
+    """Пересчитывает все балансы из cash_flow в текущей транзакции (без commit)."""
+    for stmt in _rebuild_statements():
+        await db.execute(stmt)
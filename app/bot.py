@@ -1,6 +1,7 @@
 # app/bot.py
 import os
 import logging
+import time
 from dotenv import load_dotenv
 load_dotenv()
 from aiogram import Bot, Dispatcher, types
@@ -13,11 +14,11 @@ from aiogram.fsm.state import State, StatesGroup
 from decimal import Decimal
 from sqlalchemy.orm import joinedload, selectinload 
 from sqlalchemy import select
-from typing import Callable, Dict, Any, Awaitable
+from typing import Callable, Dict, Any, Awaitable, Optional, Tuple
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
 
 
-from . import crud, schemas, models
+from . import crud, schemas, models, security
 from .database import AsyncSessionLocal
 
 
@@ -60,26 +61,79 @@ async def who_am_i(message: Message):
     else:
         await message.answer(f"❌ Не могу найти пользователя с Telegram ID {user_id_to_check} в базе данных, к которой я подключен.")
 
-TELEGRAM_SDEK_CHAT_ID = os.getenv("TELEGRAM_SDEK_CHAT_ID")
-
-async def send_sdek_status_update(message: str):
-    """Отправляет сообщение с обновлением статуса СДЭК в специальный чат."""
-    if not TELEGRAM_SDEK_CHAT_ID:
-        print("Переменная TELEGRAM_SDEK_CHAT_ID не установлена. Уведомление не отправлено.")
-        return
-    try:
-        # Используем parse_mode="HTML" для форматирования
-        await bot.send_message(chat_id=TELEGRAM_SDEK_CHAT_ID, text=message, parse_mode="HTML")
-    except Exception as e:
-        print(f"Ошибка при отправке уведомления в Telegram: {e}")
-
-
 # --- ЛОГИКА ОПЛАТЫ (МАШИНА СОСТОЯНИЙ) ---
 class Payment(StatesGroup):
     waiting_for_amount = State()
     waiting_for_account = State()
 
+# Время жизни записи в кэше пользователей бота (секунды). 0 - кэш выключен.
+BOT_PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv("BOT_PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramPrincipalCache:
+    """
+    Кэш Principal по telegram_id с TTL. Запоминается и отсутствие пользователя,
+    чтобы поток callback-запросов от непривязанного аккаунта не ходил в БД.
+    """
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[int, Tuple[float, Optional[security.Principal]]] = {}
+        self.db_lookups = 0
+        self.db_lookups_avoided = 0
+
+    def get(self, telegram_id: int):
+        """Возвращает (найдено_в_кэше, principal)."""
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return False, None
+        expires_at, principal = entry
+        if expires_at <= time.monotonic():
+            self._entries.pop(telegram_id, None)
+            return False, None
+        self.db_lookups_avoided += 1
+        return True, principal
+
+    def set(self, telegram_id: int, principal: Optional[security.Principal]) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        self._entries[telegram_id] = (time.monotonic() + self.ttl_seconds, principal)
+
+    def invalidate(self, *telegram_ids: Optional[int]) -> None:
+        for telegram_id in telegram_ids:
+            if telegram_id is not None:
+                self._entries.pop(telegram_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "ttl_seconds": self.ttl_seconds,
+            "db_lookups": self.db_lookups,
+            "db_lookups_avoided": self.db_lookups_avoided,
+        }
+
+
+telegram_principal_cache = TelegramPrincipalCache(BOT_PRINCIPAL_CACHE_TTL_SECONDS)
+
+
+async def _load_telegram_principal(telegram_id: int) -> Optional[security.Principal]:
+    telegram_principal_cache.db_lookups += 1
+    async with AsyncSessionLocal() as session:
+        stmt = select(models.Users).options(
+            joinedload(models.Users.role)
+            .joinedload(models.Roles.role_permissions)
+            .joinedload(models.RolePermissions.permission)
+        ).filter(models.Users.telegram_id == telegram_id)
+        result = await session.execute(stmt)
+        user = result.unique().scalars().first()
+    return security.principal_from_user(user) if user else None
+
+
 class DbUserMiddleware(BaseMiddleware):
+    """Кладет в data['db_user'] Principal пользователя (или None), связанного с Telegram-аккаунтом."""
+
     async def __call__(
         self,
         handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -93,30 +147,18 @@ class DbUserMiddleware(BaseMiddleware):
         elif event.callback_query:
             from_user = event.callback_query.from_user
 
-        # --- НАЧАЛО БЛОКА ДИАГНОСТИКИ ---
-        print("\n--- DEBUG MIDDLEWARE ---")
-        if from_user:
-            print(f"Получено событие от Telegram ID: {from_user.id}") # <-- НОВАЯ СТРОКА
-        else:
-            print("Не удалось извлечь ID пользователя из события.")
-        # --- КОНЕЦ БЛОКА ДИАГНОСТИКИ ---
-
         db_user = None
         if from_user:
-            async with AsyncSessionLocal() as session:
-                stmt = select(models.Users).options(
-                    joinedload(models.Users.role)
-                    .joinedload(models.Roles.role_permissions)
-                    .joinedload(models.RolePermissions.permission)
-                ).filter(models.Users.telegram_id == from_user.id)
-                result = await session.execute(stmt)
-                db_user = result.unique().scalars().first()
-
-        if db_user:
-            print(f"Найден пользователь в БД: {db_user.username}")
+            cached, db_user = telegram_principal_cache.get(from_user.id)
+            if not cached:
+                db_user = await _load_telegram_principal(from_user.id)
+                telegram_principal_cache.set(from_user.id, db_user)
+            logger.debug(
+                "bot update telegram_id=%s user=%s cached=%s",
+                from_user.id, db_user.username if db_user else None, cached
+            )
         else:
-            print("Пользователь в БД НЕ НАЙДЕН.")
-        print("--- END DEBUG ---\n")
+            logger.debug("bot update without from_user, update_id=%s", event.update_id)
 
         data['db_user'] = db_user
         return await handler(event, data)
@@ -124,11 +166,10 @@ class DbUserMiddleware(BaseMiddleware):
 # Регистрируем Middleware
 dp.update.middleware.register(DbUserMiddleware())
 
-def user_has_permission(user: models.Users, permission_code: str) -> bool:
-    if not user or not user.role or not hasattr(user.role, 'role_permissions'):
+def user_has_permission(user, permission_code: str) -> bool:
+    if not user:
         return False
-    user_permissions = {rp.permission.code for rp in user.role.role_permissions if rp.permission}
-    return permission_code in user_permissions
+    return security.user_has_permission(user, permission_code)
 
 @dp.message(Command('cancel'))
 async def cancel_handler(message: Message, state: FSMContext):
@@ -143,7 +184,7 @@ async def cancel_handler(message: Message, state: FSMContext):
 
 # --- ОБРАБОТЧИКИ КОМАНД ---
 @dp.message(CommandStart())
-async def send_welcome(message: Message, db_user: models.Users):
+async def send_welcome(message: Message, db_user: Optional[security.Principal]):
     """
     Отправляет приветствие и показывает клавиатуру в зависимости от роли.
     """
@@ -167,7 +208,7 @@ async def send_welcome(message: Message, db_user: models.Users):
 
 
 @dp.message(Command('link'))
-async def link_user_account(message: Message, command: CommandObject, db_user: models.Users):
+async def link_user_account(message: Message, command: CommandObject, db_user: Optional[security.Principal]):
     """
     Привязывает Telegram аккаунт к пользователю в системе.
     Использование: ответьте на пересланное сообщение от пользователя командой /link <логин_пользователя>
@@ -201,15 +242,35 @@ async def link_user_account(message: Message, command: CommandObject, db_user: m
             return
 
         # Присваиваем ему Telegram ID и сохраняем
+        previous_telegram_id = user_to_link.telegram_id
         user_to_link.telegram_id = telegram_id_to_link
         await session.commit()
+        telegram_principal_cache.invalidate(previous_telegram_id, telegram_id_to_link)
+        logger.info(
+            "telegram account linked username=%s telegram_id=%s previous_telegram_id=%s",
+            app_username, telegram_id_to_link, previous_telegram_id
+        )
 
         await message.reply(f"✅ Аккаунт Telegram пользователя '{telegram_name}' успешно привязан к сотруднику '{app_username}'.")
 
 
 
+@dp.message(Command('botcache'))
+async def bot_cache_stats(message: Message, db_user: Optional[security.Principal]):
+    """Статистика кэша пользователей бота: сколько обращений к БД удалось избежать."""
+    if not user_has_permission(db_user, 'manage_users'):
+        await message.reply("⛔ У вас недостаточно прав для выполнения этой команды.")
+        return
+    stats = telegram_principal_cache.stats()
+    await message.reply(
+        f"Записей в кэше: {stats['size']} (TTL {stats['ttl_seconds']} с)\n"
+        f"Запросов к БД: {stats['db_lookups']}\n"
+        f"Запросов к БД избежано: {stats['db_lookups_avoided']}"
+    )
+
+
 @dp.message(F.text == "📦 Заказы поставщиков")
-async def list_pending_orders_handler(message: Message, db_user: models.Users):
+async def list_pending_orders_handler(message: Message, db_user: Optional[security.Principal]):
     """Показывает заказы, ожидающие оплаты (реагирует на кнопку)."""
 
     # Проверяем, что у пользователя есть право просматривать заказы
@@ -272,8 +333,10 @@ async def process_amount_entered(message: Message, state: FSMContext):
         await state.update_data(amount=amount)
 
         # Получаем список счетов для выбора
+        # Бот - отдельный процесс и не получает сбросов кэша справочников от API, поэтому читает БД
         async with AsyncSessionLocal() as session:
-            accounts = await crud.get_accounts(session)
+            accounts_result = await session.execute(select(models.Accounts).order_by(models.Accounts.id))
+            accounts = accounts_result.scalars().all()
 
         if not accounts:
             await message.answer("В системе нет счетов для оплаты. Сначала добавьте их в приложении.")
@@ -1,11 +1,12 @@
 # app/crud.py
+import os
 
 from sqlalchemy.orm import Session
 from sqlalchemy.future import select
 from . import models
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload, joinedload, aliased
-from sqlalchemy import func, select, case, or_, desc
+from sqlalchemy import func, select, case, or_, and_, desc, tuple_
 from . import models, schemas
 from datetime import date
 from fastapi import HTTPException, status
@@ -14,11 +15,18 @@ from sqlalchemy import select, or_
 from datetime import date, timedelta, datetime, time
 from sqlalchemy import func
 from typing import List, Optional
-from sqlalchemy import update
+import time as time_module
+from sqlalchemy import update, delete, insert, literal, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from . import security
+from .reference_cache import reference_cache
+from .response_cache import publish_event
+from . import rollups  # noqa: F401 - регистрирует отслеживание изменений для дневных агрегатов
+from . import balances
 from sqlalchemy import extract
-from .bot import send_sdek_status_update
+from .notification_outbox import enqueue_sdek_status_update, enqueue_waiting_list_notifications
 from . import sdek_api
+from . import pagination
 
 
 BATTERY_THRESHOLDS = {
@@ -32,38 +40,55 @@ BATTERY_THRESHOLDS = {
 # Пороговое значение по умолчанию для моделей, которых нет в списке
 DEFAULT_BATTERY_THRESHOLD = 12.0
 
-def _extract_specific_defect_reason(details: str) -> str:
-    """Извлекает из полного лога только строки с конкретной причиной брака."""
-    if not details:
-        return "Причина не указана."
+# Сколько подсказок возвращает автодополнение модельных номеров по умолчанию
+MODEL_NUMBER_SEARCH_LIMIT = int(os.getenv("MODEL_NUMBER_SEARCH_LIMIT", "10"))
+
+def _record_defect_reason(db: AsyncSession, log_entry: models.PhoneMovementLog, reason_code: str, reason: str,
+                          checklist_item_id: Optional[int] = None) -> None:
+    """Сохраняет причину брака вместе с событием log_entry (movement_log_id заполнится при flush)."""
+    db.add(models.PhoneDefectReason(
+        phone_id=log_entry.phone_id,
+        movement_log=log_entry,
+        event_type=log_entry.event_type,
+        reason_code=reason_code,
+        checklist_item_id=checklist_item_id,
+        reason=reason
+    ))
+
+
+def _format_defect_reason(reasons: List[models.PhoneDefectReason]) -> str:
+    """Текст причины брака для списков: непройденные пункты чек-листа через запятую или причина события."""
+    checklist = [r.reason for r in reasons if r.reason_code == "checklist"]
+    if checklist:
+        return "Брак: " + ", ".join(checklist)
+    return reasons[0].reason
+
+
+async def _get_latest_defect_reasons(db: AsyncSession, phone_ids: List[int]) -> dict:
+    """
+    Причина брака по каждому телефону - из последнего события с записанными причинами.
+    Один запрос по индексу (phone_id, created_at) вместо загрузки и разбора всей истории логов.
+    """
+    if not phone_ids:
+        return {}
+    rows = (await db.execute(
+        select(models.PhoneDefectReason)
+        .where(models.PhoneDefectReason.phone_id.in_(phone_ids))
+        .order_by(
+            models.PhoneDefectReason.phone_id,
+            models.PhoneDefectReason.created_at.desc(),
+            models.PhoneDefectReason.movement_log_id.desc(),
+            models.PhoneDefectReason.id
+        )
+    )).scalars().all()
+
+    latest = {}
+    for row in rows:
+        reasons = latest.setdefault(row.phone_id, [])
+        if not reasons or reasons[0].movement_log_id == row.movement_log_id:
+            reasons.append(row)
+    return {phone_id: _format_defect_reason(reasons) for phone_id, reasons in latest.items()}
 
-    # Если в логе есть результаты проверки из чек-листа
-    if "--- Результаты проверки ---" in details:
-        try:
-            # Отделяем часть с чек-листом
-            checklist_str = details.split("--- Результаты проверки ---")[1]
-            
-            # Находим все строки, в которых есть слово "БРАК"
-            failed_items = [
-                # Убираем лишние символы и само слово "БРАК"
-                line.strip().replace(": БРАК", "").split('(')[0].strip()
-                for line in checklist_str.strip().split('\n')
-                if "БРАК" in line
-            ]
-            
-            if failed_items:
-                # Если найдены, возвращаем их списком
-                return "Брак: " + ", ".join(failed_items)
-            else:
-                # Если слово "БРАК" не найдено (маловероятно), возвращаем общий статус
-                return "Брак по результатам инспекции"
-        except Exception:
-             # В случае любой ошибки при обработке строки, возвращаем исходный текст
-            return details
-    else:
-        # Для других типов логов (возврат, обмен, тест АКБ) возвращаем как есть
-        return details
-    
 async def get_unique_model_color_combos(db: AsyncSession):
     """Получает уникальные комбинации 'модель + цвет' с их текущим URL изображения."""
     query = (
@@ -100,6 +125,7 @@ async def update_image_for_model_color_combo(db: AsyncSession, data: schemas.Mod
     )
     await db.execute(stmt)
     await db.commit()
+    reference_cache.invalidate_model_display_names()
     return {"message": "Update successful"}
 
 # --- Функции для Инспекции ---
@@ -109,9 +135,6 @@ async def get_phones_for_inspection(db: AsyncSession):
     query = (
         select(models.Phones)
         .options(
-            selectinload(models.Phones.model).selectinload(models.Models.model_name),
-            selectinload(models.Phones.model).selectinload(models.Models.storage),
-            selectinload(models.Phones.model).selectinload(models.Models.color),
             selectinload(models.Phones.model_number),
             selectinload(models.Phones.supplier_order)
         )
@@ -121,9 +144,8 @@ async def get_phones_for_inspection(db: AsyncSession):
     return result.scalars().all()
 
 async def get_checklist_items(db: AsyncSession):
-    """Получает все пункты из чек-листа."""
-    result = await db.execute(select(models.ChecklistItems).order_by(models.ChecklistItems.display_order))
-    return result.scalars().all()
+    """Получает все пункты из чек-листа (из кэша справочников)."""
+    return await reference_cache.all(db, "checklist_items")
 
 
 async def create_initial_inspection(db: AsyncSession, phone_id: int, inspection_data: schemas.InspectionSubmission, user_id: int):
@@ -154,6 +176,7 @@ async def create_initial_inspection(db: AsyncSession, phone_id: int, inspection_
 
     phone.serial_number = inspection_data.serial_number
 
+    created_model_number = False
     if inspection_data.model_number:
         # ... (код для model_number остается без изменений)
         result = await db.execute(select(models.ModelNumber).filter(models.ModelNumber.name == inspection_data.model_number))
@@ -162,6 +185,7 @@ async def create_initial_inspection(db: AsyncSession, phone_id: int, inspection_
             model_number_obj = models.ModelNumber(name=inspection_data.model_number)
             db.add(model_number_obj)
             await db.flush()
+            created_model_number = True
         phone.model_number_id = model_number_obj.id
 
     new_inspection = models.DeviceInspection(
@@ -230,6 +254,13 @@ async def create_initial_inspection(db: AsyncSession, phone_id: int, inspection_
         details=log_details
     )
     db.add(log_entry)
+    for res in inspection_data.results:
+        if not res.result:
+            _record_defect_reason(
+                db, log_entry, "checklist",
+                checklist_items_map.get(res.checklist_item_id, "Неизвестный пункт"),
+                checklist_item_id=res.checklist_item_id
+            )
 
     results_to_add = [
         models.InspectionResults(
@@ -241,6 +272,8 @@ async def create_initial_inspection(db: AsyncSession, phone_id: int, inspection_
     ]
     db.add_all(results_to_add)
     await db.commit()
+    if created_model_number:
+        reference_cache.invalidate("model_numbers")
 
     final_phone_result = await db.execute(
         select(models.Phones).options(
@@ -330,6 +363,8 @@ async def add_battery_test_results(db: AsyncSession, inspection_id: int, battery
         event_type=log_event, details=log_details
     )
     db.add(log_entry)
+    if log_event == models.PhoneEventType.ОБНАРУЖЕН_БРАК:
+        _record_defect_reason(db, log_entry, "battery_test", log_details)
     # ^^^ КОНЕЦ НОВОЙ ЛОГИКИ ПРОВЕРКИ ^^^
 
     await db.commit()
@@ -374,11 +409,9 @@ async def get_phones_for_battery_test(db: AsyncSession):
 
     return list(latest_inspections_dict.values())
 
-async def search_model_numbers(db: AsyncSession, query: str):
-    """Ищет номера моделей по частичному совпадению."""
-    search_query = select(models.ModelNumber).filter(models.ModelNumber.name.ilike(f"%{query}%")).limit(10)
-    result = await db.execute(search_query)
-    return result.scalars().all()
+async def search_model_numbers(db: AsyncSession, query: str, limit: int = MODEL_NUMBER_SEARCH_LIMIT):
+    """Ищет номера моделей по началу или фрагменту номера (из кэша справочников, без запроса к БД)."""
+    return await reference_cache.search(db, "model_numbers", query, limit)
 
 async def get_unique_model_names(db: AsyncSession, skip: int = 0, limit: int = 1000):
     """Получает список уникальных базовых названий моделей (из таблицы model_name)."""
@@ -440,34 +473,27 @@ async def get_phone_by_id_fully_loaded(db: AsyncSession, phone_id: int):
         raise HTTPException(status_code=404, detail="Телефон не найден")
     return phone
 
-async def get_phones(db: AsyncSession, skip: int = 0, limit: int = 100):
-    """Получает список телефонов с пагинацией и общим количеством."""
-    # Запрос для получения общего количества
-    total_stmt = select(func.count(models.Phones.id))
-    total_result = await db.execute(total_stmt)
-    total = total_result.scalar_one()
-
-    # Запрос для получения самих записей с учетом пагинации
-    query = (
-        select(models.Phones)
-        .options(
-            # Эта часть загружает все, что нужно для форматирования
-            selectinload(models.Phones.model).options(
-                selectinload(models.Models.model_name),
-                selectinload(models.Models.storage),
-                selectinload(models.Models.color)
-            ),
-            selectinload(models.Phones.model_number),    # <-- ВОТ ЭТА СТРОКА ДОБАВЛЕНА
-            selectinload(models.Phones.supplier_order) # <-- И ЭТА ТОЖЕ ДОБАВЛЕНА
-        )
-        .order_by(models.Phones.id.desc())
-        .offset(skip)
-        .limit(limit)
-    )
-    result = await db.execute(query)
-    items = result.scalars().all()
-
-    return {"items": items, "total": total}
+async def get_phones(db: AsyncSession, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, with_total: bool = True):
+    """
+    Получает список телефонов (по убыванию id) с keyset-пагинацией.
+    cursor - next_cursor/prev_cursor из предыдущего ответа; skip работает как раньше, если курсора нет.
+    total берется из кэша (см. pagination.cached_total), with_total=False - без подсчета.
+    """
+    query = select(models.Phones).options(
+        selectinload(models.Phones.model_number),
+        selectinload(models.Phones.supplier_order)
+    )
+    page = await pagination.keyset_page(
+        db, query, limit, cursor,
+        order_desc=[models.Phones.id.desc()],
+        order_asc=[models.Phones.id.asc()],
+        seek=lambda key, direction: models.Phones.id < key[0] if direction == pagination.NEXT else models.Phones.id > key[0],
+        key_of=lambda phone: [phone.id],
+        key_length=1,
+        skip=skip,
+    )
+    page["total"] = await pagination.cached_total(db, "phones", select(models.Phones.id), tags=("inventory",)) if with_total else None
+    return page
 
 # --- Функции для Поставщиков ---
 
@@ -540,10 +566,7 @@ async def pay_supplier_order(db: AsyncSession, payment_data: schemas.SupplierPay
     if not order:
         raise HTTPException(status_code=404, detail="Заказ поставщика не найден")
 
-    operation_category_result = await db.execute(
-        select(models.OperationCategories).filter(models.OperationCategories.name == "Закупка товара")
-    )
-    op_category = operation_category_result.scalars().first()
+    op_category = await reference_cache.get_by_name(db, "operation_categories", "Закупка товара")
     if not op_category:
         raise HTTPException(status_code=500, detail="Категория операции 'Закупка товара' не найдена в БД.")
 
@@ -577,14 +600,12 @@ async def pay_supplier_order(db: AsyncSession, payment_data: schemas.SupplierPay
     return order_id_to_return
 
 async def get_all_storage_options(db: AsyncSession, skip: int = 0, limit: int = 100):
-    """Получает все опции памяти."""
-    result = await db.execute(select(models.Storage).offset(skip).limit(limit))
-    return result.scalars().all()
+    """Получает все опции памяти (из кэша справочников)."""
+    return (await reference_cache.all(db, "storage"))[skip:skip + limit]
 
 async def get_all_color_options(db: AsyncSession, skip: int = 0, limit: int = 100):
-    """Получает все опции цвета."""
-    result = await db.execute(select(models.Colors).offset(skip).limit(limit))
-    return result.scalars().all()
+    """Получает все опции цвета (из кэша справочников)."""
+    return (await reference_cache.all(db, "colors"))[skip:skip + limit]
 
 
 async def get_all_models_full_info(db: AsyncSession, skip: int = 0, limit: int = 1000):
@@ -669,84 +690,97 @@ async def receive_supplier_order(db: AsyncSession, order_id: int, returned_phone
     order.status = models.StatusDelivery.ПОЛУЧЕН
     order.delivery_payment_status = models.OrderPaymentStatus.НЕ_ОПЛАЧЕН
 
-    new_phones = []
-    warehouse_entries = []
-    log_entries = []
+    now = datetime.now()
+    supplier_name = order.supplier.name if order.supplier else "Неизвестно"
 
+    # Строки вставляются пачками (один INSERT на таблицу), без ORM-объекта на каждую единицу товара
+    phone_rows = []
+    warehouse_rows = []
     for detail in order.supplier_order_details:
         if detail.model_id:
-            for _ in range(detail.quantity):
-                new_phone = models.Phones(
-                    model_id=detail.model_id,
-                    supplier_order_id=order.id,
-                    purchase_price=detail.price,
-                    technical_status=models.TechStatus.ОЖИДАЕТ_ПРОВЕРКУ,
-                    commercial_status=models.CommerceStatus.НЕ_ГОТОВ_К_ПРОДАЖЕ,
-                    condition=models.PhoneCondition.REFURBISHED,
-                    added_date=datetime.now().date()
-                )
-                new_phones.append(new_phone)
+            phone_rows.extend(
+                {
+                    "model_id": detail.model_id,
+                    "supplier_order_id": order.id,
+                    "purchase_price": detail.price,
+                    "technical_status": models.TechStatus.ОЖИДАЕТ_ПРОВЕРКУ,
+                    "commercial_status": models.CommerceStatus.НЕ_ГОТОВ_К_ПРОДАЖЕ,
+                    "condition": models.PhoneCondition.REFURBISHED,
+                    "added_date": now.date(),
+                }
+                for _ in range(detail.quantity)
+            )
         elif detail.accessory_id:
             if detail.accessory:
                 detail.accessory.purchase_price = detail.price
-            warehouse_entry = models.Warehouse(
-                product_type_id=2, 
-                product_id=detail.accessory_id,
-                quantity=detail.quantity,
-                shop_id=1, 
-                storage_location=models.EnumShop.СКЛАД,
-                added_date=datetime.now()
-            )
-            warehouse_entries.append(warehouse_entry)
-
-    if new_phones:
-        db.add_all(new_phones)
-    if warehouse_entries:
-        db.add_all(warehouse_entries)
-        
-    await db.flush()
+            warehouse_rows.append({
+                "product_type_id": 2,
+                "product_id": detail.accessory_id,
+                "quantity": detail.quantity,
+                "shop_id": 1,
+                "storage_location": models.EnumShop.СКЛАД,
+                "added_date": now,
+            })
 
-    for phone in new_phones:
-        supplier_name = order.supplier.name if order.supplier else "Неизвестно"
-        log_entry = models.PhoneMovementLog(
-            phone_id=phone.id,
-            user_id=user_id,
-            event_type=models.PhoneEventType.ПОСТУПЛЕНИЕ_ОТ_ПОСТАВЩИКА,
-            details=f"Заказ №{order.id}. Поставщик: {supplier_name}. Цена: {phone.purchase_price} руб."
+    log_rows = []
+    if phone_rows:
+        # sort_by_parameter_order: id возвращаются в порядке строк, чтобы сопоставить цену закупки
+        phone_ids = (await db.scalars(
+            insert(models.Phones).returning(models.Phones.id, sort_by_parameter_order=True),
+            phone_rows
+        )).all()
+        log_rows.extend(
+            {
+                "phone_id": phone_id,
+                "user_id": user_id,
+                "timestamp": now,
+                "event_type": models.PhoneEventType.ПОСТУПЛЕНИЕ_ОТ_ПОСТАВЩИКА,
+                "details": f"Заказ №{order.id}. Поставщик: {supplier_name}. Цена: {row['purchase_price']} руб.",
+            }
+            for phone_id, row in zip(phone_ids, phone_rows)
         )
-        log_entries.append(log_entry)
 
-    if log_entries:
-        db.add_all(log_entries)
-    
+    if warehouse_rows:
+        await db.execute(insert(models.Warehouse), warehouse_rows)
+
     if returned_phone_ids:
-        # Загружаем телефоны, которые нужно обновить
-        returned_phones_res = await db.execute(
-            select(models.Phones).filter(models.Phones.id.in_(returned_phone_ids))
+        # Одним UPDATE возвращаем на инспекцию только телефоны, которые действительно были отправлены поставщику
+        returned_ids = (await db.scalars(
+            update(models.Phones)
+            .where(
+                models.Phones.id.in_(returned_phone_ids),
+                models.Phones.commercial_status == models.CommerceStatus.ОТПРАВЛЕН_ПОСТАВЩИКУ
+            )
+            .values(
+                technical_status=models.TechStatus.ОЖИДАЕТ_ПРОВЕРКУ,
+                commercial_status=models.CommerceStatus.НЕ_ГОТОВ_К_ПРОДАЖЕ
+            )
+            .returning(models.Phones.id)
+            .execution_options(synchronize_session=False)
+        )).all()
+        log_rows.extend(
+            {
+                "phone_id": phone_id,
+                "user_id": user_id,
+                "timestamp": now,
+                "event_type": models.PhoneEventType.ПОЛУЧЕН_ОТ_ПОСТАВЩИКА,
+                "details": f"Получен от поставщика вместе с заказом №{order.id}. Направлен на повторную инспекцию.",
+            }
+            for phone_id in returned_ids
         )
-        returned_phones = returned_phones_res.scalars().all()
-        
-        for phone in returned_phones:
-            # Проверяем, что телефон действительно был отправлен поставщику
-            if phone.commercial_status == models.CommerceStatus.ОТПРАВЛЕН_ПОСТАВЩИКУ:
-                phone.technical_status = models.TechStatus.ОЖИДАЕТ_ПРОВЕРКУ
-                phone.commercial_status = models.CommerceStatus.НЕ_ГОТОВ_К_ПРОДАЖЕ
-                
-                db.add(models.PhoneMovementLog(
-                    phone_id=phone.id, user_id=user_id,
-                    event_type=models.PhoneEventType.ПОЛУЧЕН_ОТ_ПОСТАВЩИКА,
-                    details=f"Получен от поставщика вместе с заказом №{order.id}. Направлен на повторную инспекцию."
-                ))
+
+    if log_rows:
+        await db.execute(insert(models.PhoneMovementLog), log_rows)
 
     await db.commit()
+    await publish_event("supplier_order_received")
     await db.refresh(order)
     return order
 
 
 async def get_shops(db: AsyncSession):
-    """Получает список всех магазинов."""
-    result = await db.execute(select(models.Shops))
-    return result.scalars().all()
+    """Получает список всех магазинов (из кэша справочников)."""
+    return await reference_cache.all(db, "shops")
 
 async def get_phones_ready_for_stock(db: AsyncSession):
     """Получает все телефоны со статусом 'УПАКОВАН', отсортированные по времени упаковки."""
@@ -756,7 +790,7 @@ async def get_phones_ready_for_stock(db: AsyncSession):
             models.PhoneMovementLog.phone_id,
             func.max(models.PhoneMovementLog.timestamp).label("max_timestamp")
         )
-        .filter(models.PhoneMovementLog.details == "Телефон упакован и готов к приемке на склад.")
+        .filter(models.PhoneMovementLog.details == models.PACKAGING_LOG_DETAILS)
         .group_by(models.PhoneMovementLog.phone_id)
         .subquery()
     )
@@ -778,59 +812,93 @@ async def get_phones_ready_for_stock(db: AsyncSession):
     result = await db.execute(query)
     return result.scalars().unique().all()
 
+async def _notify_waiting_list_for_phones(db: AsyncSession, phones: List[models.Phones]):
+    """
+    Сопоставляет поступившие телефоны с листом ожидания: все активные заявки по моделям партии
+    загружаются одним запросом, каждому телефону достается одна заявка в порядке очереди.
+    Уведомления ставятся в очередь, заявки помечаются как уведомленные одним UPDATE.
+    """
+    model_ids = {phone.model_id for phone in phones if phone.model_id}
+    if not model_ids:
+        return
+
+    entries_result = await db.execute(
+        select(models.WaitingList)
+        .where(models.WaitingList.model_id.in_(model_ids), models.WaitingList.status == 0)
+        .order_by(models.WaitingList.created_at, models.WaitingList.id)
+        .with_for_update(skip_locked=True)
+    )
+    queues: dict = {}
+    for entry in entries_result.scalars().all():
+        queues.setdefault(entry.model_id, []).append(entry)
+
+    model_names = await reference_cache.model_names_for(db, queues.keys())
+    notifications = []
+    for phone in phones:
+        queue = queues.get(phone.model_id)
+        if not queue:
+            continue
+        entry = queue.pop(0)
+
+        notifications.append({
+            "user_id": entry.user_id,
+            "waiting_list_id": entry.id,
+            "message": (
+                f"🔔 Появился {model_names[phone.model_id]}, "
+                f"который ждет клиент {entry.customer_name} ({entry.customer_phone or 'номер не указан'})."
+            ),
+        })
+
+    if not notifications:
+        return
+    enqueue_waiting_list_notifications(db, notifications)
+    await db.execute(
+        update(models.WaitingList)
+        .where(models.WaitingList.id.in_([n["waiting_list_id"] for n in notifications]))
+        .values(status=1)
+        .execution_options(synchronize_session=False)
+    )
+
+
 async def accept_phones_to_warehouse(db: AsyncSession, data: schemas.WarehouseAcceptanceRequest, user_id: int):
-    # Эта версия принудительно загружает всю необходимую информацию о модели
-    # для ВСЕХ телефонов в списке, а не только для новых.
+    # Названия моделей для листа ожидания берутся из кэша, связи модели не загружаются
     phones_to_update_result = await db.execute(
-        select(models.Phones)
-        .options(
-            selectinload(models.Phones.model).options(
-                selectinload(models.Models.model_name),
-                selectinload(models.Models.storage),
-                selectinload(models.Models.color)
-            )
-        )
-        .filter(models.Phones.id.in_(data.phone_ids))
+        select(models.Phones).filter(models.Phones.id.in_(data.phone_ids))
     )
     phones_to_update = phones_to_update_result.scalars().unique().all()
 
     shop = await db.get(models.Shops, data.shop_id)
     shop_name = shop.name if shop else "Неизвестный магазин"
+    now = datetime.now()
 
     for phone in phones_to_update:
         phone.commercial_status = models.CommerceStatus.НА_СКЛАДЕ
 
-        db.add(models.Warehouse(
-            product_type_id=1, product_id=phone.id, quantity=1, shop_id=data.shop_id,
-            storage_location=models.EnumShop.СКЛАД, added_date=datetime.now(), user_id=user_id
-        ))
-        db.add(models.PhoneMovementLog(
-            phone_id=phone.id, user_id=user_id, event_type=models.PhoneEventType.ПРИНЯТ_НА_СКЛАД,
-            details=f"Принят на склад магазина '{shop_name}'."
-        ))
-
-        # Этот блок теперь будет работать для ЛЮБОГО телефона, так как данные загружены
-        if phone.model:
-            waiting_list_query = select(models.WaitingList).where(
-                models.WaitingList.model_id == phone.model.id,
-                models.WaitingList.status == 0
-            )
-            waiting_list_results = await db.execute(waiting_list_query)
-
-            for entry in waiting_list_results.scalars().all():
-                model_name_base = phone.model.model_name.name if phone.model.model_name else ""
-                storage_display = models.format_storage_for_display(phone.model.storage.storage) if phone.model.storage else ""
-                color_name = phone.model.color.color_name if phone.model.color else ""
-                full_model_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
+    if phones_to_update:
+        new_warehouse_entries = (await db.scalars(
+            insert(models.Warehouse).returning(models.Warehouse),
+            [
+                {
+                    "product_type_id": 1, "product_id": phone.id, "quantity": 1, "shop_id": data.shop_id,
+                    "storage_location": models.EnumShop.СКЛАД, "added_date": now, "user_id": user_id,
+                }
+                for phone in phones_to_update
+            ]
+        )).all()
+        await db.execute(insert(models.PhoneMovementLog), [
+            {
+                "phone_id": phone.id, "user_id": user_id, "timestamp": now,
+                "event_type": models.PhoneEventType.ПРИНЯТ_НА_СКЛАД,
+                "details": f"Принят на склад магазина '{shop_name}'.",
+            }
+            for phone in phones_to_update
+        ])
+        await upsert_phone_current_locations(db, new_warehouse_entries)
 
-                message = (
-                    f"🔔 Появился {full_model_name}, "
-                    f"который ждет клиент {entry.customer_name} ({entry.customer_phone or 'номер не указан'})."
-                )
-                await create_notification(db, user_id=entry.user_id, message=message, waiting_list_id=entry.id)
-                entry.status = 1
+    await _notify_waiting_list_for_phones(db, phones_to_update)
 
     await db.commit()
+    await publish_event("phones_accepted_to_warehouse")
 
 
 async def get_all_accessories(db: AsyncSession):
@@ -845,9 +913,8 @@ async def get_all_accessories(db: AsyncSession):
     return result.scalars().unique().all()
 
 async def get_traffic_sources(db: AsyncSession):
-    """Получает список всех источников трафика."""
-    result = await db.execute(select(models.TrafficSource))
-    return result.scalars().all()
+    """Получает список всех источников трафика (из кэша справочников)."""
+    return await reference_cache.all(db, "traffic_sources")
 
 async def create_customer(db: AsyncSession, customer: schemas.CustomerCreate):
     """Создает нового покупателя в базе данных."""
@@ -922,6 +989,32 @@ async def get_products_for_sale(db: AsyncSession):
             
     return final_warehouse_items
 
+async def _lock_warehouse_items_for_sale(db: AsyncSession, details: List[schemas.SaleDetailCreate]) -> dict:
+    """
+    Блокирует (SELECT ... FOR UPDATE) все складские позиции чека одним запросом
+    и проверяет, что остатка хватает. Возвращает словарь {warehouse_id: Warehouse}.
+    """
+    requested = {}
+    for detail in details:
+        requested[detail.warehouse_id] = requested.get(detail.warehouse_id, 0) + detail.quantity
+
+    # Сортировка по id дает одинаковый порядок блокировок у параллельных продаж и исключает взаимоблокировки
+    result = await db.execute(
+        select(models.Warehouse)
+        .where(models.Warehouse.id.in_(requested.keys()))
+        .order_by(models.Warehouse.id)
+        .with_for_update()
+    )
+    warehouse_items = {item.id: item for item in result.scalars().all()}
+
+    for warehouse_id, quantity in requested.items():
+        warehouse_item = warehouse_items.get(warehouse_id)
+        if not warehouse_item or (warehouse_item.quantity or 0) < quantity:
+            await db.rollback()
+            raise HTTPException(status_code=400, detail=f"Товара на складе (ID: {warehouse_id}) недостаточно.")
+    return warehouse_items
+
+
 async def create_sale(db: AsyncSession, sale_data: schemas.SaleCreate, user_id: int):
     subtotal = sum(item.unit_price * item.quantity for item in sale_data.details)
     discount_amount = sale_data.discount or Decimal('0')
@@ -941,8 +1034,29 @@ async def create_sale(db: AsyncSession, sale_data: schemas.SaleCreate, user_id:
                 detail=f"Сумма платежей ({total_paid}) не совпадает с итоговой суммой чека ({total_amount})."
             )
 
+    # Блокируем остатки до создания чека: параллельная продажа той же позиции ждет здесь
+    warehouse_items = await _lock_warehouse_items_for_sale(db, sale_data.details)
+
+    # Товары чека - по одному запросу на тип
+    phone_ids = {w.product_id for w in warehouse_items.values() if w.product_type_id == 1}
+    accessory_ids = {w.product_id for w in warehouse_items.values() if w.product_type_id == 2}
+    phones_by_id = {}
+    if phone_ids:
+        phones_result = await db.execute(select(models.Phones).where(models.Phones.id.in_(phone_ids)))
+        phones_by_id = {p.id: p for p in phones_result.scalars().all()}
+    accessories_by_id = {}
+    if accessory_ids:
+        accessories_result = await db.execute(select(models.Accessories).where(models.Accessories.id.in_(accessory_ids)))
+        accessories_by_id = {a.id: a for a in accessories_result.scalars().all()}
+
+    customer_name = "Розничный покупатель"
+    if sale_data.customer_id:
+        customer = await db.get(models.Customers, sale_data.customer_id)
+        if customer: customer_name = customer.name
+
+    now = datetime.now()
     new_sale = models.Sales(
-        sale_date=datetime.now(), customer_id=sale_data.customer_id,
+        sale_date=now, customer_id=sale_data.customer_id,
         total_amount=total_amount,
         delivery_method=sale_data.delivery_method, # <-- Сохраняем способ доставки
         discount=discount_amount,
@@ -952,9 +1066,10 @@ async def create_sale(db: AsyncSession, sale_data: schemas.SaleCreate, user_id:
     db.add(new_sale)
     await db.flush()
 
+    cash_flow_rows = []
+
     # Создаем записи о платежах, только если это НЕ отложенная продажа
     if not sale_data.delivery_method:
-        # ... (остальная часть функции, отвечающая за обработку платежей, остается БЕЗ ИЗМЕНЕНИЙ) ...
         for payment in sale_data.payments:
             db.add(models.SalePayments(
                 sale_id=new_sale.id,
@@ -962,8 +1077,8 @@ async def create_sale(db: AsyncSession, sale_data: schemas.SaleCreate, user_id:
                 amount=payment.amount,
                 payment_method=models.EnumPayment(payment.payment_method)
             ))
-            db.add(models.CashFlow(
-                date=datetime.now(), operation_categories_id=2, account_id=payment.account_id,
+            cash_flow_rows.append(dict(
+                date=now, operation_categories_id=2, account_id=payment.account_id,
                 amount=payment.amount, description=f"Поступление от продажи №{new_sale.id}", currency_id=1,
                 user_id=user_id
             ))
@@ -976,71 +1091,71 @@ async def create_sale(db: AsyncSession, sale_data: schemas.SaleCreate, user_id:
             # СЦЕНАРИЙ 1: Клиент оставил сдачу
             if sale_data.kept_change and sale_data.kept_change > 0:
                 # Находим категорию "Невостребованная сдача"
-                kept_change_category_res = await db.execute(
-                    select(models.OperationCategories).filter(models.OperationCategories.name == "Невостребованная сдача")
-                )
-                kept_change_category = kept_change_category_res.scalars().first()
+                kept_change_category = await reference_cache.get_by_name(db, "operation_categories", "Невостребованная сдача")
                 if not kept_change_category:
                     # Если категория не найдена, это критическая ошибка конфигурации
                     raise HTTPException(status_code=500, detail="Категория операции 'Невостребованная сдача' не найдена. Добавьте ее в БД.")
 
                 # Создаем запись о ДОХОДЕ
-                db.add(models.CashFlow(
-                    date=datetime.now(),
+                cash_flow_rows.append(dict(
+                    date=now,
                     operation_categories_id=kept_change_category.id,
                     account_id=cash_payment.account_id,
                     amount=abs(sale_data.kept_change), # Сумма положительная (доход)
                     description=f"Оставленная сдача по продаже №{new_sale.id}",
-                    currency_id=1
+                    currency_id=1,
+                    user_id=None
                 ))
 
-    # Обновляем остатки и статусы телефонов
-    # ... (эта часть кода остается такой же, как была у вас)
+    # Обновляем остатки и статусы телефонов, собираем строки для пакетной вставки
+    sale_detail_rows = []
+    movement_log_rows = []
     for detail in sale_data.details:
-        warehouse_item = await db.get(models.Warehouse, detail.warehouse_id)
-        if not warehouse_item or warehouse_item.quantity < detail.quantity:
-            await db.rollback()
-            raise HTTPException(status_code=400, detail=f"Товара на складе (ID: {detail.warehouse_id}) недостаточно.")
-
+        warehouse_item = warehouse_items[detail.warehouse_id]
         warehouse_item.quantity -= detail.quantity
         item_profit = None
 
         if warehouse_item.product_type_id == 1: # Телефон
-            phone = await db.get(models.Phones, warehouse_item.product_id)
+            phone = phones_by_id.get(warehouse_item.product_id)
             if phone:
                 if sale_data.delivery_method:
                     phone.commercial_status = models.CommerceStatus.ОТПРАВЛЕН_КЛИЕНТУ
                 else:
                     phone.commercial_status = models.CommerceStatus.ПРОДАН
-                customer_name = "Розничный покупатель"
-                if new_sale.customer_id:
-                    customer = await db.get(models.Customers, new_sale.customer_id)
-                    if customer: customer_name = customer.name
                 log_details = f"Продажа №{new_sale.id} клиенту '{customer_name}'. Цена: {detail.unit_price} руб."
                 if sale_data.delivery_method:
                     log_details += f" (Доставка: {sale_data.delivery_method})"
-                log_entry = models.PhoneMovementLog(
-                    phone_id=phone.id, user_id=user_id,
+                movement_log_rows.append(dict(
+                    phone_id=phone.id, user_id=user_id, timestamp=now,
                     event_type=models.PhoneEventType.ПРОДАН,
-                    details=f"Продажа №{new_sale.id} клиенту '{customer_name}'. Цена: {detail.unit_price} руб."
-                )
-                db.add(log_entry)
+                    details=log_details
+                ))
                 purchase_price = phone.purchase_price or 0
                 item_profit = (detail.unit_price * detail.quantity) - (purchase_price * detail.quantity) - Decimal(800)
 
         elif warehouse_item.product_type_id == 2: # Аксессуар
-            accessory = await db.get(models.Accessories, warehouse_item.product_id)
+            accessory = accessories_by_id.get(warehouse_item.product_id)
             if accessory:
                 purchase_price = accessory.purchase_price or 0
                 item_profit = (detail.unit_price * detail.quantity) - (purchase_price * detail.quantity)
 
-        sale_detail_entry = models.SaleDetails(
+        sale_detail_rows.append(dict(
             sale_id=new_sale.id, warehouse_id=detail.warehouse_id, quantity=detail.quantity,
             unit_price=detail.unit_price, profit=item_profit
-        )
-        db.add(sale_detail_entry)
+        ))
+
+    # Пакетная вставка: один INSERT (executemany) на таблицу вместо строки на каждую позицию.
+    # День продажи для дневных агрегатов уже отмечен через db.add(new_sale) (app/rollups.py)
+    if sale_detail_rows:
+        await db.execute(insert(models.SaleDetails), sale_detail_rows)
+    if movement_log_rows:
+        await db.execute(insert(models.PhoneMovementLog), movement_log_rows)
+    if cash_flow_rows:
+        await db.execute(insert(models.CashFlow), cash_flow_rows)
+        await balances.apply_cash_flow_rows(db, cash_flow_rows)
 
     await db.commit()
+    await publish_event("sale_created")
     await db.refresh(new_sale, attribute_names=['sale_details', 'payments'])
     return new_sale
 
@@ -1158,9 +1273,8 @@ async def add_price_for_model_storage_combo(db: AsyncSession, data: schemas.Pric
 # --- Функции для Движения Денег ---
 
 async def get_operation_categories(db: AsyncSession):
-    """Получает список всех категорий операций."""
-    result = await db.execute(select(models.OperationCategories))
-    return result.scalars().all()
+    """Получает список всех категорий операций (из кэша справочников)."""
+    return await reference_cache.all(db, "operation_categories")
 
 async def get_counterparties(db: AsyncSession):
     """Получает список всех контрагентов."""
@@ -1168,9 +1282,8 @@ async def get_counterparties(db: AsyncSession):
     return result.scalars().all()
 
 async def get_accounts(db: AsyncSession):
-    """Получает список всех счетов."""
-    result = await db.execute(select(models.Accounts))
-    return result.scalars().all()
+    """Получает список всех счетов (из кэша справочников)."""
+    return await reference_cache.all(db, "accounts")
 
 async def create_cash_flow(db: AsyncSession, cash_flow: schemas.CashFlowCreate, user_id: int, commit: bool = True):
     """
@@ -1187,48 +1300,68 @@ async def create_cash_flow(db: AsyncSession, cash_flow: schemas.CashFlowCreate,
     
     if commit:
         await db.commit()
+        await publish_event("cash_flow_created")
         await db.refresh(db_cash_flow, attribute_names=['operation_category', 'account', 'counterparty'])
     else:
+        # Транзакцию фиксирует вызывающий код, кэш аналитики сбросится по TTL
         await db.flush()
         await db.refresh(db_cash_flow, attribute_names=['operation_category', 'account', 'counterparty'])
         
     return db_cash_flow
 
-async def get_cash_flows(db: AsyncSession, skip: int = 0, limit: int = 100, account_id: Optional[int] = None):
-    """Получает список всех денежных операций с пагинацией и фильтрацией по счету."""
-    
-    # Базовый запрос, к которому будем добавлять условия
+def _cash_flow_seek(key: list, direction: str):
+    """
+    Условие keyset-пагинации по (date DESC, id DESC). Строки без даты в этом порядке
+    идут первыми (NULLS FIRST по умолчанию в PostgreSQL), их учитываем отдельно.
+    """
+    key_date, key_id = key
+    row_key = tuple_(models.CashFlow.date, models.CashFlow.id)
+    if direction == pagination.NEXT:
+        if key_date is None:
+            return or_(models.CashFlow.date.is_not(None), models.CashFlow.id < key_id)
+        return row_key < tuple_(key_date, key_id)
+    if key_date is None:
+        return and_(models.CashFlow.date.is_(None), models.CashFlow.id > key_id)
+    return or_(row_key > tuple_(key_date, key_id), models.CashFlow.date.is_(None))
+
+
+async def get_cash_flows(db: AsyncSession, skip: int = 0, limit: int = 100, account_id: Optional[int] = None,
+                         cursor: Optional[str] = None, with_total: bool = True):
+    """
+    Получает список денежных операций (новые сверху) с keyset-пагинацией и фильтрацией по счету.
+    cursor и skip - как в get_phones.
+    """
     base_query = select(models.CashFlow)
     if account_id:
         base_query = base_query.where(models.CashFlow.account_id == account_id)
 
-    # Запрос для получения общего количества с учетом фильтра
-    total_stmt = select(func.count()).select_from(base_query.subquery())
-    total_result = await db.execute(total_stmt)
-    total = total_result.scalar_one()
-
-    # Запрос для получения самих записей
-    items_query = (
-        base_query
-        .options(
+    page = await pagination.keyset_page(
+        db,
+        base_query.options(
             selectinload(models.CashFlow.operation_category),
             selectinload(models.CashFlow.account),
             selectinload(models.CashFlow.counterparty)
-        )
-        .order_by(models.CashFlow.date.desc())
-        .offset(skip)
-        .limit(limit)
-    )
-    result = await db.execute(items_query)
-    items = result.scalars().all()
-
-    return {"items": items, "total": total}
+        ),
+        limit, cursor,
+        order_desc=[models.CashFlow.date.desc(), models.CashFlow.id.desc()],
+        order_asc=[models.CashFlow.date.asc(), models.CashFlow.id.asc()],
+        seek=_cash_flow_seek,
+        key_of=lambda cash_flow: [cash_flow.date, cash_flow.id],
+        key_length=2,
+        skip=skip,
+    )
+    page["total"] = await pagination.cached_total(
+        db, "cash_flows", base_query.with_only_columns(models.CashFlow.id), tags=("cash_flow",),
+        params={"account_id": account_id}
+    ) if with_total else None
+    return page
 
 async def create_account(db: AsyncSession, account: schemas.AccountCreate):
     """Создает новый счет."""
     db_account = models.Accounts(**account.model_dump())
     db.add(db_account)
     await db.commit()
+    reference_cache.invalidate("accounts")
     await db.refresh(db_account)
     return db_account
 
@@ -1241,8 +1374,8 @@ async def create_counterparty(db: AsyncSession, counterparty: schemas.Counterpar
     return db_counterparty
 
 async def get_total_balance(db: AsyncSession) -> Decimal:
-    """Подсчитывает и возвращает общий баланс по всем счетам."""
-    stmt = select(func.coalesce(func.sum(models.CashFlow.amount), 0))
+    """Подсчитывает и возвращает общий баланс по всем счетам (из текущих балансов, app/balances.py)."""
+    stmt = select(func.coalesce(func.sum(models.AccountBalance.balance), 0))
     result = await db.execute(stmt)
     total = result.scalar_one()
     return total
@@ -1260,27 +1393,21 @@ async def get_inventory_valuation(db: AsyncSession) -> Decimal:
 async def get_profit_report(db: AsyncSession, start_date: date, end_date: date) -> dict:
     end_date_inclusive = end_date + timedelta(days=1)
 
-    revenue_result = await db.execute(
-        select(func.sum(models.Sales.total_amount))
-        .filter(models.Sales.sale_date >= start_date)
-        .filter(models.Sales.sale_date < end_date_inclusive)
-    )
-    total_revenue = revenue_result.scalar_one_or_none() or Decimal('0')
-
-    gross_profit_result = await db.execute(
-        select(func.sum(models.SaleDetails.profit))
-        .join(models.Sales)
-        .filter(models.Sales.sale_date >= start_date)
-        .filter(models.Sales.sale_date < end_date_inclusive)
-    )
-    gross_profit = gross_profit_result.scalar_one_or_none() or Decimal('0')
+    # Итоги читаются из дневных агрегатов (app/rollups.py)
+    sales_totals = (await db.execute(
+        select(func.sum(models.DailySalesRollup.revenue), func.sum(models.DailySalesRollup.profit))
+        .filter(models.DailySalesRollup.day >= start_date)
+        .filter(models.DailySalesRollup.day < end_date_inclusive)
+    )).one()
+    total_revenue = sales_totals[0] or Decimal('0')
+    gross_profit = sales_totals[1] or Decimal('0')
     total_cogs = total_revenue - gross_profit
 
     expenses_result = await db.execute(
-        select(func.sum(models.CashFlow.amount))
+        select(func.sum(models.DailyCashFlowRollup.amount))
         .join(models.OperationCategories)
-        .filter(models.CashFlow.date >= start_date)
-        .filter(models.CashFlow.date < end_date_inclusive)
+        .filter(models.DailyCashFlowRollup.day >= start_date)
+        .filter(models.DailyCashFlowRollup.day < end_date_inclusive)
         .filter(models.OperationCategories.type == 'expense')
         .filter(models.OperationCategories.view != 'Техническая операция')
         .filter(models.OperationCategories.name != 'Закупка товара')
@@ -1382,48 +1509,202 @@ async def get_accessories_for_model(db: AsyncSession, model_name_id: int):
     result = await db.execute(query)
     return result.scalars().unique().all()
 
-async def get_phone_history_by_serial(db: AsyncSession, serial_number: str):
-    """Собирает полную историю телефона по его серийному номеру."""
-    phone_query = (
-        select(models.Phones)
-        .options(
-            selectinload(models.Phones.model).options(
-                selectinload(models.Models.model_name),
-                selectinload(models.Models.storage),
-                selectinload(models.Models.color)
-            ),
-            selectinload(models.Phones.supplier_order).selectinload(models.SupplierOrders.supplier),
-            selectinload(models.Phones.device_inspections).options(
-                selectinload(models.DeviceInspection.user),
-                selectinload(models.DeviceInspection.inspection_results).selectinload(models.InspectionResults.checklist_item),
-                selectinload(models.DeviceInspection.battery_tests)
-            ),
-            selectinload(models.Phones.movement_logs).options(
-                selectinload(models.PhoneMovementLog.user)
-            ),
-            selectinload(models.Phones.model_number),
-            # --- НАЧАЛО ИСПРАВЛЕНИЯ ---
-            selectinload(models.Phones.repairs).options(
-                selectinload(models.Repairs.loaner_logs).options(
-                    selectinload(models.LoanerLog.loaner_phone).options(
-                        selectinload(models.Phones.model).options(  
-                            selectinload(models.Models.model_name),
-                            selectinload(models.Models.storage),  
-                            selectinload(models.Models.color)    
-                        )
-                    )
-                )
-            )
+# Разделы истории телефона (параметр ?sections= эндпоинта истории)
+PHONE_HISTORY_SECTIONS = ("timeline", "purchase", "inspections", "repairs", "warehouse", "sale")
+# Разделы, которые видят только сотрудники с правом manage_inventory
+PHONE_HISTORY_MANAGER_SECTIONS = frozenset({"purchase", "inspections"})
+# События ленты, которые видит продавец без права manage_inventory
+SALESPERSON_VISIBLE_EVENTS = (
+    models.PhoneEventType.ПРИНЯТ_НА_СКЛАД,
+    models.PhoneEventType.ПРОДАН,
+    models.PhoneEventType.ВОЗВРАТ_ОТ_КЛИЕНТА,
+    models.PhoneEventType.ОТПРАВЛЕН_В_РЕМОНТ,
+    models.PhoneEventType.ПОЛУЧЕН_ИЗ_РЕМОНТА,
+    models.PhoneEventType.ОБМЕНЕН,
+    models.PhoneEventType.ПЕРЕМЕЩЕНИЕ,
+)
+
+
+async def get_phone_history_by_serial(db: AsyncSession, serial_number: str, sections=None, full_access: bool = True):
+    """
+    Собирает историю телефона по его серийному номеру.
+    Загружается только то, что будет показано: sections - нужные разделы (по умолчанию все),
+    без full_access закупка и инспекции пропускаются, а лента событий фильтруется в запросе.
+    Складская запись и продажа подтягиваются тем же запросом, что и телефон.
+    Возвращает (phone, warehouse_entry, sale_detail).
+    """
+    sections = set(PHONE_HISTORY_SECTIONS if sections is None else sections)
+    if not full_access:
+        sections -= PHONE_HISTORY_MANAGER_SECTIONS
+
+    options = [joinedload(models.Phones.model_number)]
+    if "purchase" in sections:
+        options.append(joinedload(models.Phones.supplier_order).joinedload(models.SupplierOrders.supplier))
+    if "inspections" in sections:
+        options.append(selectinload(models.Phones.device_inspections).options(
+            joinedload(models.DeviceInspection.user),
+            selectinload(models.DeviceInspection.inspection_results).joinedload(models.InspectionResults.checklist_item),
+            selectinload(models.DeviceInspection.battery_tests)
+        ))
+    if "timeline" in sections:
+        movement_logs = models.Phones.movement_logs
+        if not full_access:
+            movement_logs = movement_logs.and_(models.PhoneMovementLog.event_type.in_(SALESPERSON_VISIBLE_EVENTS))
+        options.append(selectinload(movement_logs).joinedload(models.PhoneMovementLog.user))
+    if "repairs" in sections:
+        # Названия моделей подменных телефонов берутся из reference_cache, связи модели не нужны
+        options.append(
+            selectinload(models.Phones.repairs)
+            .selectinload(models.Repairs.loaner_logs)
+            .joinedload(models.LoanerLog.loaner_phone)
+        )
+
+    query = select(models.Phones)
+    with_warehouse = bool(sections & {"warehouse", "sale"})
+    if with_warehouse:
+        # Последняя складская запись телефона и последняя позиция продажи по ней
+        warehouse_entry = aliased(models.Warehouse)
+        sale_detail = aliased(models.SaleDetails)
+        latest_warehouse_id = (
+            select(func.max(warehouse_entry.id))
+            .where(warehouse_entry.product_id == models.Phones.id, warehouse_entry.product_type_id == 1)
+            .correlate(models.Phones)
+            .scalar_subquery()
         )
-        .filter(func.lower(models.Phones.serial_number) == func.lower(serial_number))
+        latest_sale_detail_id = (
+            select(func.max(sale_detail.id))
+            .where(sale_detail.warehouse_id == models.Warehouse.id)
+            .correlate(models.Warehouse)
+            .scalar_subquery()
+        )
+        query = (
+            select(models.Phones, models.Warehouse, models.SaleDetails)
+            .select_from(models.Phones)
+            .outerjoin(models.Warehouse, models.Warehouse.id == latest_warehouse_id)
+            .outerjoin(models.SaleDetails, models.SaleDetails.id == latest_sale_detail_id)
+        )
+        options += [
+            joinedload(models.Warehouse.shop),
+            joinedload(models.Warehouse.user),
+            joinedload(models.SaleDetails.sale).joinedload(models.Sales.customer),
+        ]
+
+    result = await db.execute(
+        query.options(*options).filter(func.lower(models.Phones.serial_number) == func.lower(serial_number))
     )
-    phone_result = await db.execute(phone_query)
-    phone = phone_result.scalars().unique().one_or_none() # Используем unique() для корректной сборки
+    row = result.unique().one_or_none()
 
-    if not phone:
+    if not row:
         raise HTTPException(status_code=404, detail="Телефон с таким серийным номером не найден")
-    
-    return phone
+
+    if with_warehouse:
+        return row[0], row[1], row[2]
+    return row[0], None, None
+
+# Ранги совпадений поиска телефонов: чем меньше, тем выше в выдаче
+PHONE_SEARCH_MATCHES = ("serial_exact", "serial_prefix", "serial_contains", "serial_fuzzy", "model_number", "model_name")
+
+
+def _like_pattern(value: str, prefix: bool = False) -> str:
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{escaped}%" if prefix else f"%{escaped}%"
+
+
+async def search_phones(db: AsyncSession, query: str, limit: int = 20) -> List[dict]:
+    """
+    Поиск телефонов по фрагменту серийного номера (в т.ч. с опечаткой), модельному номеру
+    и названию модели. Один запрос: кандидаты из каждого источника берутся по своему индексу
+    (триграммный GIN для серийных и модельных номеров, остатки склада для названий моделей),
+    затем ранжируются и дополняются статусом и местом хранения из phone_current_location.
+    """
+    q = query.strip().lower()
+    model_names = await reference_cache.model_display_names(db)
+    tokens = q.split()
+    matching_model_ids = [
+        model_id for model_id, model in model_names.items()
+        if model.name and all(token in model.name.lower() for token in tokens)
+    ]
+
+    serial = func.lower(models.Phones.serial_number)
+    serial_rank = case(
+        (serial == q, 0),
+        (serial.like(_like_pattern(q, prefix=True)), 1),
+        (serial.like(_like_pattern(q)), 2),
+        else_=3
+    )
+    branches = [
+        select(models.Phones.id.label("phone_id"), serial_rank.label("rank"), func.similarity(serial, q).label("score"))
+        .where(or_(serial.like(_like_pattern(q)), serial.op("%")(q)))
+        .order_by(serial_rank, func.similarity(serial, q).desc())
+        .limit(limit),
+        select(
+            models.Phones.id.label("phone_id"), literal(4).label("rank"),
+            func.similarity(func.lower(models.ModelNumber.name), q).label("score")
+        )
+        .join(models.ModelNumber, models.Phones.model_number_id == models.ModelNumber.id)
+        .where(func.lower(models.ModelNumber.name).like(_like_pattern(q)))
+        .order_by(models.Phones.id.desc())
+        .limit(limit),
+    ]
+    if matching_model_ids:
+        # По названию модели ищем только то, что есть в наличии
+        branches.append(
+            select(models.Phones.id.label("phone_id"), literal(5).label("rank"), literal(0.0).label("score"))
+            .where(
+                models.Phones.commercial_status == models.CommerceStatus.НА_СКЛАДЕ,
+                models.Phones.model_id.in_(matching_model_ids)
+            )
+            .order_by(models.Phones.id.desc())
+            .limit(limit)
+        )
+    # LIMIT внутри каждой ветки: каждая выбирает своих лучших кандидатов по своему индексу
+    candidates = union_all(*[
+        select(branch.c.phone_id, branch.c.rank, branch.c.score)
+        for branch in (b.subquery() for b in branches)
+    ]).subquery()
+    best = (
+        select(
+            candidates.c.phone_id,
+            func.min(candidates.c.rank).label("rank"),
+            func.max(candidates.c.score).label("score")
+        )
+        .group_by(candidates.c.phone_id)
+        .subquery()
+    )
+
+    result = await db.execute(
+        select(
+            models.Phones,
+            best.c.rank,
+            best.c.score,
+            models.ModelNumber.name,
+            models.PhoneCurrentLocation.storage_location,
+            models.Shops.name
+        )
+        .join(best, best.c.phone_id == models.Phones.id)
+        .outerjoin(models.ModelNumber, models.Phones.model_number_id == models.ModelNumber.id)
+        .outerjoin(models.PhoneCurrentLocation, models.PhoneCurrentLocation.phone_id == models.Phones.id)
+        .outerjoin(models.Shops, models.Shops.id == models.PhoneCurrentLocation.shop_id)
+        .order_by(best.c.rank, best.c.score.desc(), models.Phones.id.desc())
+        .limit(limit)
+    )
+
+    found = []
+    for phone, rank, score, model_number, storage_location, shop_name in result.all():
+        model = model_names.get(phone.model_id)
+        found.append({
+            "id": phone.id,
+            "serial_number": phone.serial_number,
+            "model_name": model.name if model else None,
+            "model_number": model_number,
+            "technical_status": phone.technical_status.value if phone.technical_status else None,
+            "commercial_status": phone.commercial_status.value if phone.commercial_status else None,
+            "storage_location": storage_location.value if storage_location else None,
+            "shop_name": shop_name,
+            "match": PHONE_SEARCH_MATCHES[rank],
+            "score": float(score or 0),
+        })
+    return found
 
 async def get_defective_phones(db: AsyncSession):
     """Получает телефоны со статусом 'БРАК' с последней записью в логе как причиной."""
@@ -1451,14 +1732,8 @@ async def get_defective_phones(db: AsyncSession):
         .join(models.Phones.model)
         .join(models.Models.model_name)
         .options(
-            selectinload(models.Phones.model).options(
-                selectinload(models.Models.model_name),
-                selectinload(models.Models.storage),
-                selectinload(models.Models.color)
-            ),
             selectinload(models.Phones.model_number),
-            selectinload(models.Phones.supplier_order),
-            selectinload(models.Phones.movement_logs)
+            selectinload(models.Phones.supplier_order)
         )
         .filter(models.Phones.technical_status == models.TechStatus.БРАК)
         .filter(models.Phones.commercial_status.notin_([
@@ -1473,26 +1748,9 @@ async def get_defective_phones(db: AsyncSession):
     result = await db.execute(query)
     phones = result.scalars().unique().all()
 
-    # Логика извлечения причины брака остается без изменений
+    defect_reasons = await _get_latest_defect_reasons(db, [phone.id for phone in phones])
     for phone in phones:
-        defect_log = None
-        sorted_logs = sorted(phone.movement_logs, key=lambda log: log.timestamp, reverse=True)
-
-        for log in sorted_logs:
-            if log.event_type in [
-                models.PhoneEventType.ОБНАРУЖЕН_БРАК,
-                models.PhoneEventType.ВОЗВРАТ_ОТ_КЛИЕНТА,
-                models.PhoneEventType.ОБМЕНЕН
-            ]:
-                defect_log = log
-                break
-
-        if defect_log and defect_log.details:
-            phone.defect_reason = _extract_specific_defect_reason(defect_log.details)
-        elif defect_log:
-            phone.defect_reason = log.event_type.value
-        else:
-            phone.defect_reason = "Причина не определена"
+        phone.defect_reason = defect_reasons.get(phone.id, "Причина не определена")
     return phones
 
 async def get_phones_sent_to_supplier(db: AsyncSession):
@@ -1500,44 +1758,17 @@ async def get_phones_sent_to_supplier(db: AsyncSession):
     query = (
         select(models.Phones)
         .options(
-            selectinload(models.Phones.model).selectinload(models.Models.model_name),
-            selectinload(models.Phones.model).selectinload(models.Models.storage),
-            selectinload(models.Phones.model).selectinload(models.Models.color),
             selectinload(models.Phones.model_number),
-            selectinload(models.Phones.supplier_order),
-            selectinload(models.Phones.movement_logs)
+            selectinload(models.Phones.supplier_order)
         )
         .filter(models.Phones.commercial_status == models.CommerceStatus.ОТПРАВЛЕН_ПОСТАВЩИКУ)
     )
     result = await db.execute(query)
     phones = result.scalars().unique().all()
 
+    defect_reasons = await _get_latest_defect_reasons(db, [phone.id for phone in phones])
     for phone in phones:
-        defect_log = None
-        # Сортируем логи, чтобы проверить самые свежие первыми
-        sorted_logs = sorted(phone.movement_logs, key=lambda log: log.timestamp, reverse=True)
-        
-        # Ищем последнюю запись, которая является причиной брака
-        for phone in phones:
-            defect_log = None
-            sorted_logs = sorted(phone.movement_logs, key=lambda log: log.timestamp, reverse=True)
-
-            for log in sorted_logs:
-                if log.event_type in [
-                    models.PhoneEventType.ОБНАРУЖЕН_БРАК,
-                    models.PhoneEventType.ВОЗВРАТ_ОТ_КЛИЕНТА,
-                    models.PhoneEventType.ОБМЕНЕН
-                ]:
-                    defect_log = log
-                    break
-
-            if defect_log and defect_log.details:
-                # VVV ИЗМЕНЕНИЕ ЗДЕСЬ VVV
-                phone.defect_reason = _extract_specific_defect_reason(defect_log.details)
-            elif defect_log:
-                phone.defect_reason = defect_log.event_type.value
-            else:
-                phone.defect_reason = "Изначальная причина не найдена"
+        phone.defect_reason = defect_reasons.get(phone.id, "Изначальная причина не найдена")
 
     return phones
 
@@ -1636,6 +1867,7 @@ async def process_customer_refund(db: AsyncSession, phone_id: int, refund_data:
         details=f"Возврат по браку (Продажа №{sale.id}). Сумма: {sale.total_amount} руб. Причина: {refund_data.notes or 'не указана'}."
     )
     db.add(log_entry)
+    _record_defect_reason(db, log_entry, "customer_return", log_entry.details)
     
     # Используем total_amount из продажи, а не unit_price из детали
     refund_amount = sale.total_amount
@@ -1673,10 +1905,7 @@ async def cancel_sale(db: AsyncSession, sale_id: int, user_id: int):
         raise HTTPException(status_code=400, detail="Эта продажа уже отменена")
 
     # 1. Находим категорию для операции возврата по имени, а не по ID
-    refund_category_result = await db.execute(
-        select(models.OperationCategories).filter(models.OperationCategories.name == "Возвраты клиентам")
-    )
-    refund_category = refund_category_result.scalars().first()
+    refund_category = await reference_cache.get_by_name(db, "operation_categories", "Возвраты клиентам")
     if not refund_category:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -1716,6 +1945,7 @@ async def cancel_sale(db: AsyncSession, sale_id: int, user_id: int):
                     ))
     
     await db.commit()
+    await publish_event("sale_cancelled")
     return {"message": "Продажа успешно отменена"}
 
 async def start_repair(db: AsyncSession, phone_id: int, repair_data: schemas.RepairCreate, user_id: int):
@@ -1870,29 +2100,15 @@ async def get_replacement_options(db: AsyncSession, original_phone_model_id: int
         return []
 
     # 3. Теперь ищем на складе доступные телефоны, у которых model_id - один из найденных
-    latest_warehouse_sq = (
-        select(
-            models.Warehouse.product_id,
-            models.Warehouse.storage_location,
-            func.row_number().over(
-                partition_by=models.Warehouse.product_id,
-                order_by=models.Warehouse.id.desc()
-            ).label("row_num"),
-        )
-        .where(models.Warehouse.product_type_id == 1)
-        .subquery()
-    )
-
     query = (
         select(models.Phones)
-        .join(latest_warehouse_sq, models.Phones.id == latest_warehouse_sq.c.product_id)
-        .where(latest_warehouse_sq.c.row_num == 1)
+        .join(models.PhoneCurrentLocation, models.Phones.id == models.PhoneCurrentLocation.phone_id)
         .filter(models.Phones.model_id.in_(matching_model_ids)) # <--- Используем новый список ID
         .filter(models.Phones.commercial_status == models.CommerceStatus.НА_СКЛАДЕ)
         .filter(
             or_(
-                latest_warehouse_sq.c.storage_location == models.EnumShop.СКЛАД,
-                latest_warehouse_sq.c.storage_location == models.EnumShop.ВИТРИНА
+                models.PhoneCurrentLocation.storage_location == models.EnumShop.СКЛАД,
+                models.PhoneCurrentLocation.storage_location == models.EnumShop.ВИТРИНА
             )
         )
         .options(
@@ -1936,6 +2152,7 @@ async def process_phone_exchange(db: AsyncSession, original_phone_id: int, repla
 
     log_original = models.PhoneMovementLog(phone_id=original_phone.id, user_id=user_id, event_type=models.PhoneEventType.ОБМЕНЕН, details=f"Обменян (возвращен клиентом) в рамках продажи №{sale_detail.sale_id}. Заменен на S/N: {replacement_phone.serial_number}.")
     db.add(log_original)
+    _record_defect_reason(db, log_original, "exchange", log_original.details)
 
     log_replacement = models.PhoneMovementLog(phone_id=replacement_phone.id, user_id=user_id, event_type=models.PhoneEventType.ОБМЕНЕН, details=f"Обменян (выдан клиенту) в рамках продажи №{sale_detail.sale_id}. Заменил S/N: {original_phone.serial_number}.")
     db.add(log_replacement)
@@ -2059,6 +2276,8 @@ async def create_user(db: AsyncSession, user_data: schemas.EmployeeCreate):
     db.add(db_user)
     await db.commit()
     await db.refresh(db_user)
+    # На случай, если в кэше осталась запись удаленного пользователя с тем же именем
+    security.invalidate_principal(db_user.username)
     return db_user
 
 async def get_users(db: AsyncSession):
@@ -2076,6 +2295,7 @@ async def delete_user(db: AsyncSession, user_id: int):
     
     await db.delete(user_to_delete)
     await db.commit()
+    security.invalidate_principal(user_to_delete.username)
     return user_to_delete
 
 async def get_sales_summary_for_user(db: AsyncSession, user_id: int):
@@ -2161,44 +2381,26 @@ async def get_recent_phones_in_stock(db: AsyncSession):
 async def get_grouped_phones_in_stock(db: AsyncSession):
     """
     Gets a grouped list of phone models in stock.
-    Uses a subquery to only consider the latest warehouse entry for each phone.
+    Only the latest warehouse entry for each phone is considered (phone_current_location).
     """
 
-    # --- VVV НАЧАЛО ИЗМЕНЕНИЙ VVV ---
-
-    # 1. Подзапрос, который находит самую последнюю складскую запись для каждого телефона.
-    latest_warehouse_sq = (
-        select(
-            models.Warehouse.product_id,
-            models.Warehouse.storage_location,
-            func.row_number().over(
-                partition_by=models.Warehouse.product_id,
-                order_by=models.Warehouse.id.desc()
-            ).label("row_num")
-        )
-        .where(models.Warehouse.product_type_id == 1)
-    ).subquery()
-
-    # 2. Основной запрос теперь присоединяется к подзапросу и берет только строки, где row_num = 1.
+    # Последнее местоположение телефона берется из проекции phone_current_location
     group_query = (
         select(
             models.Phones.model_id,
             func.count(models.Phones.id).label("quantity"),
             func.array_agg(models.ModelNumber.name).label("model_numbers")
         )
-        .join(latest_warehouse_sq, models.Phones.id == latest_warehouse_sq.c.product_id)
+        .join(models.PhoneCurrentLocation, models.Phones.id == models.PhoneCurrentLocation.phone_id)
         .join(models.ModelNumber, models.Phones.model_number_id == models.ModelNumber.id, isouter=True) # isouter=True на случай, если номера нет
         .where(
-            latest_warehouse_sq.c.row_num == 1, # <-- Ключевой фильтр
             models.Phones.commercial_status == models.CommerceStatus.НА_СКЛАДЕ,
-            latest_warehouse_sq.c.storage_location != models.EnumShop.ПОДМЕННЫЙ_ФОНД,
+            models.PhoneCurrentLocation.storage_location != models.EnumShop.ПОДМЕННЫЙ_ФОНД,
             models.Phones.model_id.is_not(None)
         )
         .group_by(models.Phones.model_id)
     )
 
-    # --- ^^^ КОНЕЦ ИЗМЕНЕНИЙ ^^^ ---
-
     grouped_result = await db.execute(group_query)
     grouped_phones = grouped_result.all()
 
@@ -2233,9 +2435,6 @@ async def get_phones_ready_for_packaging(db: AsyncSession):
     query = (
         select(models.Phones)
         .options(
-            selectinload(models.Phones.model).selectinload(models.Models.model_name),
-            selectinload(models.Phones.model).selectinload(models.Models.storage),
-            selectinload(models.Phones.model).selectinload(models.Models.color),
             selectinload(models.Phones.model_number),
             selectinload(models.Phones.supplier_order) # <--- ДОБАВЬТЕ ЭТУ СТРОКУ
         )
@@ -2269,7 +2468,7 @@ async def package_phones(db: AsyncSession, phone_ids: List[int], user_id: int):
             phone_id=phone.id,
             user_id=user_id,
             event_type=models.PhoneEventType.ИНСПЕКЦИЯ_ПРОЙДЕНА,
-            details="Телефон упакован и готов к приемке на склад."
+            details=models.PACKAGING_LOG_DETAILS
         )
         db.add(log_entry)
 
@@ -2289,6 +2488,7 @@ async def create_traffic_source(db: AsyncSession, source: schemas.TrafficSourceC
     db_source = models.TrafficSource(**source.model_dump())
     db.add(db_source)
     await db.commit()
+    reference_cache.invalidate("traffic_sources")
     await db.refresh(db_source)
     return db_source
 
@@ -2388,37 +2588,14 @@ async def update_note_status(db: AsyncSession, note_id: int, completed: bool, us
 async def get_all_phones_in_stock_detailed(db: AsyncSession):
     """Получает детальный список всех телефонов со статусом 'НА_СКЛАДЕ' с их самым последним местоположением."""
 
-    # 1. Создаем подзапрос, который нумерует записи о складе для каждого телефона,
-    #    начиная с самой новой (row_num = 1).
-    latest_warehouse_sq = (
-        select(
-            models.Warehouse,
-            func.row_number()
-            .over(
-                partition_by=models.Warehouse.product_id,
-                order_by=models.Warehouse.id.desc()
-            )
-            .label("row_num"),
-        )
-        .where(models.Warehouse.product_type_id == 1)
-        .subquery()
-    )
-
-    # Создаем псевдоним для удобного обращения к полям подзапроса
-    LatestWarehouse = aliased(models.Warehouse, latest_warehouse_sq)
-
-    # 2. Основной запрос теперь присоединяется к подзапросу и берет только строки, где row_num = 1.
+    # Последнее местоположение каждого телефона хранится в проекции phone_current_location
     query = (
-        select(models.Phones, LatestWarehouse.storage_location)
+        select(models.Phones, models.PhoneCurrentLocation.storage_location)
         .join(
-            latest_warehouse_sq,
-            models.Phones.id == latest_warehouse_sq.c.product_id,
+            models.PhoneCurrentLocation,
+            models.Phones.id == models.PhoneCurrentLocation.phone_id,
         )
-        .where(latest_warehouse_sq.c.row_num == 1) # <--- Ключевое условие
         .options(
-            selectinload(models.Phones.model).selectinload(models.Models.model_name),
-            selectinload(models.Phones.model).selectinload(models.Models.storage),
-            selectinload(models.Phones.model).selectinload(models.Models.color),
             selectinload(models.Phones.model_number),
             selectinload(models.Phones.supplier_order)
         )
@@ -2441,6 +2618,88 @@ async def get_all_phones_in_stock_detailed(db: AsyncSession):
 
     return phones_with_location
 
+async def upsert_phone_current_locations(db: AsyncSession, warehouse_entries: List[models.Warehouse]):
+    """
+    Обновляет проекцию phone_current_location по складским записям телефонов.
+    Записи должны иметь id (после flush). Коммит остается за вызывающей функцией.
+    """
+    now = datetime.now()
+    rows = {
+        entry.product_id: {
+            "phone_id": entry.product_id,
+            "warehouse_id": entry.id,
+            "shop_id": entry.shop_id,
+            "storage_location": entry.storage_location,
+            "updated_at": now,
+        }
+        for entry in warehouse_entries
+        if entry.product_type_id == 1 and entry.product_id is not None
+    }
+    if not rows:
+        return
+
+    stmt = pg_insert(models.PhoneCurrentLocation).values(list(rows.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.PhoneCurrentLocation.phone_id],
+        set_={
+            "warehouse_id": stmt.excluded.warehouse_id,
+            "shop_id": stmt.excluded.shop_id,
+            "storage_location": stmt.excluded.storage_location,
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+    await db.execute(stmt)
+
+def _latest_phone_warehouse_query():
+    """Последняя складская запись по каждому телефону (эталон для проекции)."""
+    return (
+        select(
+            models.Warehouse.product_id,
+            models.Warehouse.id,
+            models.Warehouse.shop_id,
+            models.Warehouse.storage_location,
+        )
+        .join(models.Phones, models.Phones.id == models.Warehouse.product_id)
+        .where(models.Warehouse.product_type_id == 1)
+        .distinct(models.Warehouse.product_id)
+        .order_by(models.Warehouse.product_id, models.Warehouse.id.desc())
+    )
+
+async def rebuild_phone_current_locations(db: AsyncSession) -> int:
+    """Полностью пересобирает проекцию phone_current_location из таблицы warehouse."""
+    latest = _latest_phone_warehouse_query().subquery()
+    await db.execute(delete(models.PhoneCurrentLocation))
+    result = await db.execute(
+        pg_insert(models.PhoneCurrentLocation).from_select(
+            ["phone_id", "warehouse_id", "shop_id", "storage_location", "updated_at"],
+            select(latest.c.product_id, latest.c.id, latest.c.shop_id, latest.c.storage_location, func.now())
+        )
+    )
+    await db.commit()
+    return result.rowcount
+
+async def verify_phone_current_locations(db: AsyncSession) -> List[dict]:
+    """Сравнивает проекцию с историей склада и возвращает список расхождений."""
+    expected_result = await db.execute(_latest_phone_warehouse_query())
+    expected = {row.product_id: row for row in expected_result.all()}
+
+    actual_result = await db.execute(select(models.PhoneCurrentLocation))
+    actual = {row.phone_id: row for row in actual_result.scalars().all()}
+
+    mismatches = []
+    for phone_id in sorted(set(expected) | set(actual)):
+        exp, act = expected.get(phone_id), actual.get(phone_id)
+        if exp and act and (exp.id, exp.shop_id, exp.storage_location) == (act.warehouse_id, act.shop_id, act.storage_location):
+            continue
+        mismatches.append({
+            "phone_id": phone_id,
+            "expected_warehouse_id": exp.id if exp else None,
+            "actual_warehouse_id": act.warehouse_id if act else None,
+            "expected_location": exp.storage_location.value if exp and exp.storage_location else None,
+            "actual_location": act.storage_location.value if act and act.storage_location else None,
+        })
+    return mismatches
+
 async def move_phone_location(db: AsyncSession, phone_id: int, new_location: models.EnumShop, user_id: int):
     """Перемещает телефон и обновляет его коммерческий статус в зависимости от местоположения."""
     phone = await db.get(models.Phones, phone_id)
@@ -2457,6 +2716,7 @@ async def move_phone_location(db: AsyncSession, phone_id: int, new_location: mod
 
     old_location = warehouse_entry.storage_location.value if warehouse_entry.storage_location else "неизвестно"
     warehouse_entry.storage_location = new_location
+    await upsert_phone_current_locations(db, [warehouse_entry])
     
     if new_location == models.EnumShop.ПОДМЕННЫЙ_ФОНД:
         phone.commercial_status = models.CommerceStatus.ПОДМЕННЫЙ_ФОНД
@@ -2560,8 +2820,8 @@ async def get_phone_by_id_fully_loaded(db: AsyncSession, phone_id: int):
 async def get_phone_by_id_fully_loaded_with_location(db: AsyncSession, phone_id: int):
     """Загружает один телефон со всеми связанными данными и последним местоположением."""
     query = (
-        select(models.Phones, models.Warehouse.storage_location)
-        .join(models.Warehouse, (models.Phones.id == models.Warehouse.product_id) & (models.Warehouse.product_type_id == 1))
+        select(models.Phones, models.PhoneCurrentLocation.storage_location)
+        .join(models.PhoneCurrentLocation, models.Phones.id == models.PhoneCurrentLocation.phone_id)
         .options(
             selectinload(models.Phones.model).options(
                 selectinload(models.Models.model_name),
@@ -2572,7 +2832,6 @@ async def get_phone_by_id_fully_loaded_with_location(db: AsyncSession, phone_id:
             selectinload(models.Phones.supplier_order)  # <--- ДОБАВЛЕНА ЭТА СТРОКА
         )
         .filter(models.Phones.id == phone_id)
-        .order_by(models.Warehouse.id.desc())
     )
     result = await db.execute(query)
     phone_with_location = result.first()
@@ -2584,56 +2843,122 @@ async def get_phone_by_id_fully_loaded_with_location(db: AsyncSession, phone_id:
     phone.storage_location = location.value if location else None
     return phone
 
+# Ставки по умолчанию, если в payroll_tariffs нет нужной строки
+DEFAULT_PAYROLL_TARIFFS = {
+    "inspections": Decimal(150),
+    "battery_tests": Decimal(50),
+    "packaging": Decimal(100),
+    "shifts": Decimal(2000),
+    "phone_sales_bonus": Decimal(500),
+}
+
+PAYROLL_ROLES = ['Продавец', 'Технический специалист', 'Менеджер', 'Администратор']
+
+
+async def get_payroll_tariffs(db: AsyncSession) -> dict:
+    """Возвращает ставки {code: rate} из справочника payroll_tariffs (через кэш справочников)."""
+    tariffs = dict(DEFAULT_PAYROLL_TARIFFS)
+    for tariff in await reference_cache.all(db, "payroll_tariffs"):
+        tariffs[tariff.code] = Decimal(tariff.rate)
+    return tariffs
+
+async def update_payroll_tariff(db: AsyncSession, code: str, data: schemas.PayrollTariffUpdate):
+    """Меняет ставку зарплатного отчета."""
+    result = await db.execute(select(models.PayrollTariff).filter(models.PayrollTariff.code == code))
+    tariff = result.scalars().first()
+    if not tariff:
+        raise HTTPException(status_code=404, detail=f"Ставка '{code}' не найдена.")
+    tariff.rate = data.rate
+    if data.name is not None:
+        tariff.name = data.name
+    await db.commit()
+    await db.refresh(tariff)
+    reference_cache.invalidate("payroll_tariffs")
+    return tariff
+
+async def _count_by_user(db: AsyncSession, stmt) -> dict:
+    """Выполняет сгруппированный по user_id запрос и возвращает {user_id: значение}."""
+    result = await db.execute(stmt)
+    return {user_id: value or 0 for user_id, value in result.all()}
+
 async def get_payroll_report(db: AsyncSession, start_date: date, end_date: date):
     """Собирает и рассчитывает данные для зарплатного отчета, включая выплаты."""
     
     users_result = await db.execute(
         select(models.Users).options(selectinload(models.Users.role))
         .join(models.Users.role)
-        .filter(models.Roles.role_name.in_(['Продавец', 'Технический специалист','Менеджер', 'Администратор']))
+        .filter(models.Roles.role_name.in_(PAYROLL_ROLES))
     )
     users = users_result.scalars().all()
+    if not users:
+        return []
 
-    report = []
+    user_ids = [user.id for user in users]
     end_date_inclusive = end_date + timedelta(days=1)
+    tariffs = await get_payroll_tariffs(db)
+
+    # Все счетчики за период - по одному сгруппированному запросу на показатель, а не на каждого сотрудника
+    inspections = await _count_by_user(db,
+        select(models.DeviceInspection.user_id, func.count(models.DeviceInspection.id))
+        .filter(models.DeviceInspection.user_id.in_(user_ids), models.DeviceInspection.inspection_date >= start_date, models.DeviceInspection.inspection_date < end_date_inclusive)
+        .group_by(models.DeviceInspection.user_id)
+    )
+    battery_tests = await _count_by_user(db,
+        select(models.DeviceInspection.user_id, func.count(models.BatteryTest.id))
+        .join(models.DeviceInspection)
+        .filter(models.DeviceInspection.user_id.in_(user_ids), models.DeviceInspection.inspection_date >= start_date, models.DeviceInspection.inspection_date < end_date_inclusive)
+        .group_by(models.DeviceInspection.user_id)
+    )
+    packaging = await _count_by_user(db,
+        select(models.PhoneMovementLog.user_id, func.count(models.PhoneMovementLog.id))
+        .filter(models.PhoneMovementLog.user_id.in_(user_ids), models.PhoneMovementLog.details == models.PACKAGING_LOG_DETAILS, models.PhoneMovementLog.timestamp >= start_date, models.PhoneMovementLog.timestamp < end_date_inclusive)
+        .group_by(models.PhoneMovementLog.user_id)
+    )
+    shifts = await _count_by_user(db,
+        select(models.EmployeeShifts.user_id, func.count(func.distinct(func.date(models.EmployeeShifts.shift_start))))
+        .filter(models.EmployeeShifts.user_id.in_(user_ids), models.EmployeeShifts.shift_start >= start_date, models.EmployeeShifts.shift_start < end_date_inclusive)
+        .group_by(models.EmployeeShifts.user_id)
+    )
+    phones_sold = await _count_by_user(db,
+        select(models.Sales.user_id, func.sum(models.SaleDetails.quantity))
+        .select_from(models.SaleDetails).join(models.Sales).join(models.Warehouse)
+        .filter(models.Sales.user_id.in_(user_ids), models.Warehouse.product_type_id == 1, models.Sales.sale_date >= start_date, models.Sales.sale_date < end_date_inclusive)
+        .group_by(models.Sales.user_id)
+    )
+    paid = await _count_by_user(db,
+        select(models.Payroll.user_id, func.sum(models.Payroll.amount))
+        .filter(models.Payroll.user_id.in_(user_ids), models.Payroll.payment_date >= start_date, models.Payroll.payment_date < end_date_inclusive)
+        .group_by(models.Payroll.user_id)
+    )
+
+    def line(code: str, count) -> dict:
+        return {"count": count, "rate": tariffs[code], "total": count * tariffs[code]}
 
+    report = []
     for user in users:
         # --- РАСЧЕТ НАЧИСЛЕНИЙ (EARNED) ---
-        earned_salary = Decimal(0)
         breakdown = {}
-        
-        # Расчет для техника
-        inspections_count = (await db.execute(select(func.count(models.DeviceInspection.id)).filter(models.DeviceInspection.user_id == user.id, models.DeviceInspection.inspection_date >= start_date, models.DeviceInspection.inspection_date < end_date_inclusive))).scalar_one()
-        battery_tests_count = (await db.execute(select(func.count(models.BatteryTest.id)).join(models.DeviceInspection).filter(models.DeviceInspection.user_id == user.id, models.DeviceInspection.inspection_date >= start_date, models.DeviceInspection.inspection_date < end_date_inclusive))).scalar_one()
-        packaging_count = (await db.execute(select(func.count(models.PhoneMovementLog.id)).filter(models.PhoneMovementLog.user_id == user.id, models.PhoneMovementLog.details == "Телефон упакован и готов к приемке на склад.", models.PhoneMovementLog.timestamp >= start_date, models.PhoneMovementLog.timestamp < end_date_inclusive))).scalar_one()
 
+        # Расчет для техника
+        inspections_count = inspections.get(user.id, 0)
+        battery_tests_count = battery_tests.get(user.id, 0)
+        packaging_count = packaging.get(user.id, 0)
         if inspections_count > 0 or battery_tests_count > 0 or packaging_count > 0:
-            inspection_total = inspections_count * Decimal(150)
-            battery_total = battery_tests_count * Decimal(50)
-            packaging_total = packaging_count * Decimal(100)
-            breakdown["inspections"] = {"count": inspections_count, "rate": Decimal(150), "total": inspection_total}
-            breakdown["battery_tests"] = {"count": battery_tests_count, "rate": Decimal(50), "total": battery_total}
-            breakdown["packaging"] = {"count": packaging_count, "rate": Decimal(100), "total": packaging_total}
-            earned_salary += inspection_total + battery_total + packaging_total
+            breakdown["inspections"] = line("inspections", inspections_count)
+            breakdown["battery_tests"] = line("battery_tests", battery_tests_count)
+            breakdown["packaging"] = line("packaging", packaging_count)
 
         # Расчет для продавца
-        shifts_count = (await db.execute(select(func.count(func.distinct(func.date(models.EmployeeShifts.shift_start)))).filter(models.EmployeeShifts.user_id == user.id, models.EmployeeShifts.shift_start >= start_date, models.EmployeeShifts.shift_start < end_date_inclusive))).scalar_one()
-        phones_sold_count = (await db.execute(select(func.sum(models.SaleDetails.quantity)).join(models.Sales).join(models.Warehouse).filter(models.Sales.user_id == user.id, models.Warehouse.product_type_id == 1, models.Sales.sale_date >= start_date, models.Sales.sale_date < end_date_inclusive))).scalar_one() or 0
-        
+        shifts_count = shifts.get(user.id, 0)
+        phones_sold_count = phones_sold.get(user.id, 0)
         if shifts_count > 0 or phones_sold_count > 0:
-            shift_total = shifts_count * Decimal(2000)
-            bonus_total = phones_sold_count * Decimal(500)
-            breakdown["shifts"] = {"count": shifts_count, "rate": Decimal(2000), "total": shift_total}
-            breakdown["phone_sales_bonus"] = {"count": phones_sold_count, "rate": Decimal(500), "total": bonus_total}
-            earned_salary += shift_total + bonus_total
+            breakdown["shifts"] = line("shifts", shifts_count)
+            breakdown["phone_sales_bonus"] = line("phone_sales_bonus", phones_sold_count)
+
+        earned_salary = sum((item["total"] for item in breakdown.values()), Decimal(0))
 
         # --- РАСЧЕТ ВЫПЛАТ (PAID) ---
-        paid_amount_res = await db.execute(
-            select(func.sum(models.Payroll.amount))
-            .filter(models.Payroll.user_id == user.id)
-            .filter(models.Payroll.payment_date >= start_date, models.Payroll.payment_date < end_date_inclusive)
-        )
-        paid_amount = paid_amount_res.scalar_one() or Decimal(0)
+        paid_amount = paid.get(user.id) or Decimal(0)
 
         # Собираем итоговый отчет, только если были начисления или выплаты
         if earned_salary > 0 or paid_amount > 0:
@@ -2734,10 +3059,10 @@ async def create_financial_snapshot(db: AsyncSession):
     cash_by_account_res = await db.execute(
         select(
             models.Accounts.name,
-            func.coalesce(func.sum(models.CashFlow.amount), 0).label("balance")
+            func.coalesce(models.AccountBalance.balance, 0).label("balance")
         )
-        .join(models.CashFlow, models.Accounts.id == models.CashFlow.account_id, isouter=True)
-        .group_by(models.Accounts.id)
+        .join(models.AccountBalance, models.Accounts.id == models.AccountBalance.account_id, isouter=True)
+        .order_by(models.Accounts.id)
     )
     cash_by_account_details = [
         {"account_name": row.name, "balance": float(row.balance)} 
@@ -2846,6 +3171,7 @@ async def create_financial_snapshot(db: AsyncSession):
             )
             db.add(new_calculation)
     await db.commit()
+    await publish_event("financial_snapshot_created")
     await db.refresh(new_snapshot)
     
     return new_snapshot
@@ -2857,10 +3183,9 @@ async def get_accounts_with_balances(db: AsyncSession):
         select(
             models.Accounts.id,
             models.Accounts.name,
-            func.coalesce(func.sum(models.CashFlow.amount), 0).label("balance")
+            func.coalesce(models.AccountBalance.balance, 0).label("balance")
         )
-        .outerjoin(models.CashFlow, models.Accounts.id == models.CashFlow.account_id)
-        .group_by(models.Accounts.id, models.Accounts.name)
+        .outerjoin(models.AccountBalance, models.Accounts.id == models.AccountBalance.account_id)
         .order_by(models.Accounts.id)
     )
     result = await db.execute(query)
@@ -2910,10 +3235,7 @@ async def finalize_sale(db: AsyncSession, sale_id: int, account_id: int, user_id
 
     # Рассчитываем комиссию, только если способ доставки - "Авито Доставка"
     if sale.delivery_method == "Авито Доставка":
-        commission_category_result = await db.execute(
-            select(models.OperationCategories).filter(models.OperationCategories.name == "Комиссия Avito")
-        )
-        commission_category = commission_category_result.scalars().first()
+        commission_category = await reference_cache.get_by_name(db, "operation_categories", "Комиссия Avito")
         if not commission_category:
             # Откатываем транзакцию, чтобы не провести только часть операции
             await db.rollback()
@@ -3052,45 +3374,34 @@ async def get_product_analytics(db: AsyncSession, start_date: date, end_date: da
 async def get_financial_analytics(db: AsyncSession, start_date: date, end_date: date):
     end_date_inclusive = end_date + timedelta(days=1)
 
-    # 1. Выручка по дням
-    revenue_q = (
-        select(
-            func.date(models.Sales.sale_date).label("day"),
-            func.sum(models.Sales.total_amount).label("total")
-        )
-        .filter(models.Sales.sale_date >= start_date, models.Sales.sale_date < end_date_inclusive)
-        .group_by(func.date(models.Sales.sale_date))
-    )
-    revenue_res = await db.execute(revenue_q)
-    revenue_series = [{"date": r.day, "value": r.total} for r in revenue_res]
-
-    # 2. Прибыль по дням
-    profit_q = (
+    # 1-2. Выручка и прибыль по дням (из дневных агрегатов)
+    sales_q = (
         select(
-            func.date(models.Sales.sale_date).label("day"),
-            func.sum(models.SaleDetails.profit).label("total")
+            models.DailySalesRollup.day,
+            func.sum(models.DailySalesRollup.revenue).label("revenue"),
+            func.sum(models.DailySalesRollup.profit).label("profit")
         )
-        .join(models.Sales)
-        .filter(models.Sales.sale_date >= start_date, models.Sales.sale_date < end_date_inclusive)
-        .group_by(func.date(models.Sales.sale_date))
+        .filter(models.DailySalesRollup.day >= start_date, models.DailySalesRollup.day < end_date_inclusive)
+        .group_by(models.DailySalesRollup.day)
     )
-    profit_res = await db.execute(profit_q)
-    profit_series = [{"date": r.day, "value": r.total} for r in profit_res]
+    sales_res = (await db.execute(sales_q)).all()
+    revenue_series = [{"date": r.day, "value": r.revenue} for r in sales_res]
+    profit_series = [{"date": r.day, "value": r.profit} for r in sales_res]
 
     # 3. Расходы по дням
     expense_q = (
         select(
-            func.date(models.CashFlow.date).label("day"),
-            func.sum(models.CashFlow.amount).label("total")
+            models.DailyCashFlowRollup.day,
+            func.sum(models.DailyCashFlowRollup.amount).label("total")
         )
         .join(models.OperationCategories)
         .filter(
-            models.CashFlow.date >= start_date, 
-            models.CashFlow.date < end_date_inclusive,
+            models.DailyCashFlowRollup.day >= start_date,
+            models.DailyCashFlowRollup.day < end_date_inclusive,
             models.OperationCategories.type == 'expense',
             models.OperationCategories.view != 'Техническая операция'
         )
-        .group_by(func.date(models.CashFlow.date))
+        .group_by(models.DailyCashFlowRollup.day)
     )
     expense_res = await db.execute(expense_q)
     expense_series = [{"date": r.day, "value": abs(r.total)} for r in expense_res] # Берем модуль, т.к. расходы отрицательные
@@ -3099,12 +3410,12 @@ async def get_financial_analytics(db: AsyncSession, start_date: date, end_date:
     expense_breakdown_q = (
         select(
             models.OperationCategories.name.label("category"),
-            func.sum(models.CashFlow.amount).label("total")
+            func.sum(models.DailyCashFlowRollup.amount).label("total")
         )
         .join(models.OperationCategories)
         .filter(
-            models.CashFlow.date >= start_date, 
-            models.CashFlow.date < end_date_inclusive,
+            models.DailyCashFlowRollup.day >= start_date,
+            models.DailyCashFlowRollup.day < end_date_inclusive,
             models.OperationCategories.type == 'expense',
             models.OperationCategories.view != 'Техническая операция'
         )
@@ -3253,7 +3564,7 @@ async def get_employee_analytics(db: AsyncSession, start_date: date, end_date: d
             func.count().label("packaging_count")
         )
         .filter(
-            models.PhoneMovementLog.details == "Телефон упакован и готов к приемке на склад.",
+            models.PhoneMovementLog.details == models.PACKAGING_LOG_DETAILS,
             models.PhoneMovementLog.timestamp >= start_date,
             models.PhoneMovementLog.timestamp < end_date_inclusive
         )
@@ -3462,14 +3773,12 @@ async def get_tax_report(db: AsyncSession, start_date: date, end_date: date) ->
     """
     end_date_inclusive = end_date + timedelta(days=1)
 
-    # Запрос для суммирования всех платежей, проведенных по карте
+    # Сумма всех платежей, проведенных по карте (из дневных агрегатов)
     card_revenue_query = (
-        select(func.sum(models.SalePayments.amount))
-        .join(models.Sales, models.SalePayments.sale_id == models.Sales.id)
+        select(func.sum(models.DailySalesRollup.card_revenue))
         .filter(
-            models.SalePayments.payment_method == models.EnumPayment.КАРТА,
-            models.Sales.sale_date >= start_date,
-            models.Sales.sale_date < end_date_inclusive
+            models.DailySalesRollup.day >= start_date,
+            models.DailySalesRollup.day < end_date_inclusive
         )
     )
 
@@ -3515,32 +3824,31 @@ async def get_margin_analytics(db: AsyncSession, start_date: date, end_date: dat
     """Собирает аналитику по маржинальности проданных моделей телефонов."""
     end_date_inclusive = end_date + timedelta(days=1)
 
+    # priced_* в агрегатах уже без подарочных товаров (цена 0)
+    rollup = models.DailyModelSalesRollup
     query = (
         select(
             models.ModelName.name,
-            func.avg(models.SaleDetails.unit_price).label("avg_sale_price"),
-            func.avg(models.Phones.purchase_price).label("avg_purchase_price")
+            func.sum(rollup.priced_lines).label("priced_lines"),
+            func.sum(rollup.priced_sum).label("priced_sum"),
+            func.sum(rollup.purchase_lines).label("purchase_lines"),
+            func.sum(rollup.purchase_sum).label("purchase_sum")
         )
-        .join(models.Sales, models.SaleDetails.sale_id == models.Sales.id)
-        .join(models.Warehouse, models.SaleDetails.warehouse_id == models.Warehouse.id)
-        .join(models.Phones, models.Warehouse.product_id == models.Phones.id)
-        .join(models.Models, models.Phones.model_id == models.Models.id)
-        .join(models.ModelName, models.Models.model_name_id == models.ModelName.id)
+        .join(models.ModelName, rollup.model_name_id == models.ModelName.id)
         .where(
-            models.Warehouse.product_type_id == 1,
-            models.Sales.sale_date >= start_date,
-            models.Sales.sale_date < end_date_inclusive,
-            models.SaleDetails.unit_price > 0  # Исключаем подарочные товары
+            rollup.day >= start_date,
+            rollup.day < end_date_inclusive
         )
         .group_by(models.ModelName.name)
+        .having(func.sum(rollup.priced_lines) > 0)
     )
 
     result = await db.execute(query)
     
     analytics_data = []
     for row in result.all():
-        avg_sale = row.avg_sale_price or Decimal('0')
-        avg_purchase = row.avg_purchase_price or Decimal('0')
+        avg_sale = Decimal(row.priced_sum) / row.priced_lines
+        avg_purchase = (Decimal(row.purchase_sum) / row.purchase_lines) if row.purchase_lines else Decimal('0')
         
         margin_percent = Decimal('0')
         if avg_sale > 0:
@@ -3637,23 +3945,19 @@ async def get_abc_analysis(db: AsyncSession, start_date: date, end_date: date) -
     end_date_inclusive = end_date + timedelta(days=1)
 
     # 1. Получаем выручку по каждой модели телефона
+    rollup = models.DailyModelSalesRollup
     revenue_query = (
         select(
             models.ModelName.name.label("model_name"),
-            func.sum(models.SaleDetails.unit_price * models.SaleDetails.quantity).label("total_revenue")
+            func.sum(rollup.revenue).label("total_revenue")
         )
-        .join(models.Sales, models.SaleDetails.sale_id == models.Sales.id)
-        .join(models.Warehouse, models.SaleDetails.warehouse_id == models.Warehouse.id)
-        .join(models.Phones, models.Warehouse.product_id == models.Phones.id)
-        .join(models.Models, models.Phones.model_id == models.Models.id)
-        .join(models.ModelName, models.Models.model_name_id == models.ModelName.id)
+        .join(models.ModelName, rollup.model_name_id == models.ModelName.id)
         .where(
-            models.Warehouse.product_type_id == 1,
-            models.Sales.sale_date >= start_date,
-            models.Sales.sale_date < end_date_inclusive
+            rollup.day >= start_date,
+            rollup.day < end_date_inclusive
         )
         .group_by(models.ModelName.name)
-        .order_by(func.sum(models.SaleDetails.unit_price * models.SaleDetails.quantity).desc())
+        .order_by(func.sum(rollup.revenue).desc())
     )
     
     revenue_results = (await db.execute(revenue_query)).mappings().all()
@@ -3739,14 +4043,15 @@ async def get_average_check_analytics(db: AsyncSession, start_date: date, end_da
     """
     end_date_inclusive = end_date + timedelta(days=1)
     
+    rollup = models.DailySalesRollup
     base_query = (
         select(
-            func.count(models.Sales.id).label("sales_count"),
-            func.sum(models.Sales.total_amount).label("total_revenue")
+            func.coalesce(func.sum(rollup.sales_count), 0).label("sales_count"),
+            func.sum(rollup.revenue).label("total_revenue")
         )
         .where(
-            models.Sales.sale_date >= start_date,
-            models.Sales.sale_date < end_date_inclusive
+            rollup.day >= start_date,
+            rollup.day < end_date_inclusive
         )
     )
 
@@ -3758,7 +4063,7 @@ async def get_average_check_analytics(db: AsyncSession, start_date: date, end_da
     by_employee_query = (
         base_query
         .add_columns(models.Users.name.label("user_name"), models.Users.username)
-        .join(models.Users, models.Sales.user_id == models.Users.id)
+        .join(models.Users, rollup.user_id == models.Users.id)
         .group_by(models.Users.id)
     )
     by_employee_result = (await db.execute(by_employee_query)).mappings().all()
@@ -3767,8 +4072,7 @@ async def get_average_check_analytics(db: AsyncSession, start_date: date, end_da
     by_source_query = (
         base_query
         .add_columns(models.TrafficSource.name.label("source_name"))
-        .join(models.Customers, models.Sales.customer_id == models.Customers.id)
-        .join(models.TrafficSource, models.Customers.source_id == models.TrafficSource.id)
+        .join(models.TrafficSource, rollup.source_id == models.TrafficSource.id)
         .group_by(models.TrafficSource.id)
     )
     by_source_result = (await db.execute(by_source_query)).mappings().all()
@@ -3939,6 +4243,7 @@ async def create_model_number(db: AsyncSession, model_number_data: schemas.Model
     db_model_number = models.ModelNumber(name=model_number_data.name)
     db.add(db_model_number)
     await db.commit()
+    reference_cache.invalidate("model_numbers")
     await db.refresh(db_model_number)
     return db_model_number
 
@@ -4200,17 +4505,53 @@ async def update_return_shipment_with_sdek_info(db: AsyncSession, shipment_id: i
     await db.refresh(shipment)
     return shipment
 
-async def check_and_update_sdek_statuses(db: AsyncSession):
-    """Проверяет статусы заказов СДЭК и отправляет уведомления."""
-    print("Планировщик: Запущена проверка статусов СДЭК...")
+# Итоговые статусы СДЭК: такие заказы больше не проверяются
+SDEK_FINAL_STATUSES = ('Вручен', 'Не вручен')
 
-    unfinished_statuses = ['Вручен', 'Не вручен']
+
+def _apply_sdek_status(item, new_track_number: Optional[str], new_status_name: Optional[str]) -> Optional[str]:
+    """
+    Применяет трек-номер и статус СДЭК к заказу поставщику или возврату.
+    Возвращает текст уведомления, если статус изменился, иначе None.
+    """
+    # Если трек-номер появился, а статуса все еще нет, ставим статус по умолчанию
+    if new_track_number and not item.sdek_status:
+        item.sdek_status = "Зарегистрирован"
+
+    status_has_changed = new_status_name and new_status_name != item.sdek_status
+
+    if new_track_number:
+        item.sdek_track_number = new_track_number
+
+    if not status_has_changed:
+        return None
+
+    old_status = item.sdek_status or "<i>(еще не было)</i>"
+    item.sdek_status = new_status_name
+
+    message_header = f"<b>🚚 Заказ от поставщика №{item.id}</b>" if isinstance(item, models.SupplierOrders) else f"<b>↩️ Возврат поставщику №{item.id}</b>"
+    return (
+        f"{message_header}\n"
+        f"Трек-номер: <code>{item.sdek_track_number or '...'}</code>\n"
+        f"Статус изменен: {old_status} ➡️ <b>{new_status_name}</b>"
+    )
+
+
+async def check_and_update_sdek_statuses(db: AsyncSession) -> dict:
+    """
+    Проверяет статусы заказов СДЭК и отправляет уведомления.
+    Статусы запрашиваются параллельно через общий клиент sdek_api, изменения
+    применяются в сессии последовательно. Возвращает сводку прогона.
+    """
+    print("Планировщик: Запущена проверка статусов СДЭК...")
+    started = time_module.perf_counter()
+    summary = {"checked": 0, "changed": 0, "failed": 0, "duration_seconds": 0.0}
 
     orders_to_check_res = await db.execute(
         select(models.SupplierOrders).where(
             models.SupplierOrders.sdek_order_uuid.is_not(None),
             or_(
-                models.SupplierOrders.sdek_status.notin_(unfinished_statuses),
+                models.SupplierOrders.sdek_status.notin_(SDEK_FINAL_STATUSES),
                 models.SupplierOrders.sdek_status.is_(None)
             )
         )
@@ -4219,7 +4560,7 @@ async def check_and_update_sdek_statuses(db: AsyncSession):
         select(models.ReturnShipment).where(
             models.ReturnShipment.sdek_order_uuid.is_not(None),
             or_(
-                models.ReturnShipment.sdek_status.notin_(unfinished_statuses),
+                models.ReturnShipment.sdek_status.notin_(SDEK_FINAL_STATUSES),
                 models.ReturnShipment.sdek_status.is_(None)
             )
         )
@@ -4228,54 +4569,108 @@ async def check_and_update_sdek_statuses(db: AsyncSession):
 
     if not items_to_check:
         print("Планировщик: Активных заказов СДЭК для проверки не найдено.")
-        return
+        return summary
 
     try:
         token = await sdek_api.get_sdek_token()
     except Exception as e:
         print(f"Планировщик: Не удалось получить токен СДЭК. Ошибка: {e}")
-        return
+        summary["failed"] = len(items_to_check)
+        return summary
+
+    infos = await sdek_api.get_sdek_orders_info([item.sdek_order_uuid for item in items_to_check], token)
+    summary["checked"] = len(items_to_check)
 
     for item in items_to_check:
-        sdek_info = await sdek_api.get_sdek_order_info(item.sdek_order_uuid, token)
+        sdek_info = infos.get(item.sdek_order_uuid)
+        if sdek_info is None:
+            summary["failed"] += 1
 
         if sdek_info and sdek_info.get('entity'):
             sdek_entity = sdek_info['entity']
-
-            # --- VVV НАЧАЛО ИСПРАВЛЕНИЙ VVV ---
-
-            new_track_number = sdek_entity.get('cdek_number')
             new_status_name = None
             statuses = sdek_entity.get('statuses', [])
             if statuses:
                 new_status_name = statuses[-1].get('name')
 
-            # Если трек-номер появился, а статуса все еще нет, ставим статус по умолчанию
-            if new_track_number and not item.sdek_status:
-                item.sdek_status = "Зарегистрирован"
+            message = _apply_sdek_status(item, sdek_entity.get('cdek_number'), new_status_name)
+            if message:
+                summary["changed"] += 1
+                enqueue_sdek_status_update(db, message)
+
+    await db.commit()
+    summary["duration_seconds"] = round(time_module.perf_counter() - started, 3)
+    print(
+        f"Планировщик: Проверка заказов СДЭК завершена. Проверено: {summary['checked']}, "
+        f"изменилось: {summary['changed']}, ошибок: {summary['failed']}, "
+        f"время: {summary['duration_seconds']} с."
+    )
+    return summary
 
-            status_has_changed = new_status_name and new_status_name != item.sdek_status
 
-            if new_track_number:
-                item.sdek_track_number = new_track_number
+async def ingest_sdek_status_webhook(db: AsyncSession, payload: dict) -> dict:
+    """
+    Обрабатывает вебхук СДЭК ORDER_STATUS: находит заказ поставщику или возврат по UUID,
+    обновляет статус и трек-номер и отправляет уведомление, как плановая проверка.
+    Повторная доставка того же события (uuid, код, время статуса) игнорируется.
+    """
+    if payload.get("type") != "ORDER_STATUS":
+        return {"result": "ignored"}
 
-            if new_status_name:
-                old_status = item.sdek_status or "<i>(еще не было)</i>"
-                item.sdek_status = new_status_name
+    order_uuid = payload.get("uuid")
+    attributes = payload.get("attributes") or {}
+    status_code = attributes.get("code")
+    if not order_uuid or not status_code:
+        raise HTTPException(status_code=400, detail="В вебхуке СДЭК нет uuid или кода статуса")
 
-            if status_has_changed:
-                message_header = f"<b>🚚 Заказ от поставщика №{item.id}</b>" if isinstance(item, models.SupplierOrders) else f"<b>↩️ Возврат поставщику №{item.id}</b>"
-                message = (
-                    f"{message_header}\n"
-                    f"Трек-номер: <code>{item.sdek_track_number or '...'}</code>\n"
-                    f"Статус изменен: {old_status} ➡️ <b>{new_status_name}</b>"
-                )
-                await send_sdek_status_update(message)
+    inserted = await db.execute(
+        pg_insert(models.SdekWebhookEvent)
+        .values(
+            order_uuid=order_uuid,
+            status_code=status_code,
+            status_date_time=attributes.get("status_date_time") or payload.get("date_time") or "",
+            received_at=datetime.now(),
+            payload=payload
+        )
+        .on_conflict_do_nothing(constraint="uq_sdek_webhook_events_event")
+        .returning(models.SdekWebhookEvent.id)
+    )
+    if inserted.scalar_one_or_none() is None:
+        await db.rollback()
+        return {"result": "duplicate"}
+
+    item = (await db.execute(
+        select(models.SupplierOrders).where(models.SupplierOrders.sdek_order_uuid == order_uuid)
+    )).scalars().first()
+    if item is None:
+        item = (await db.execute(
+            select(models.ReturnShipment).where(models.ReturnShipment.sdek_order_uuid == order_uuid)
+        )).scalars().first()
+    if item is None:
+        await db.commit()
+        return {"result": "unknown_order"}
 
-            # --- ^^^ КОНЕЦ ИСПРАВЛЕНИЙ ^^^ ---
+    # События могут прийти не по порядку: итоговый статус не перезаписываем промежуточным
+    new_status_name = sdek_api.SDEK_STATUS_NAMES.get(status_code)
+    if item.sdek_status in SDEK_FINAL_STATUSES and new_status_name not in SDEK_FINAL_STATUSES:
+        await db.commit()
+        return {"result": "stale"}
 
+    new_track_number = attributes.get("cdek_number")
+    if new_status_name is None:
+        # Неизвестный код - берем название статуса из API, как при плановой проверке
+        token = await sdek_api.get_sdek_token()
+        sdek_info = await sdek_api.get_sdek_order_info(order_uuid, token)
+        sdek_entity = (sdek_info or {}).get('entity') or {}
+        statuses = sdek_entity.get('statuses') or []
+        new_status_name = statuses[-1].get('name') if statuses else None
+        new_track_number = new_track_number or sdek_entity.get('cdek_number')
+
+    message = _apply_sdek_status(item, new_track_number, new_status_name)
+    if message:
+        enqueue_sdek_status_update(db, message)
     await db.commit()
-    print(f"Планировщик: Проверка {len(items_to_check)} заказов СДЭК завершена.")
+    return {"result": "updated" if message else "unchanged"}
 
 
 async def update_supplier_order_with_sdek_info(
@@ -4306,18 +4701,18 @@ async def get_expense_breakdown_report(db: AsyncSession, start_date: date, end_d
     query = (
         select(
             models.OperationCategories.name,
-            func.sum(models.CashFlow.amount).label("total_amount")
+            func.sum(models.DailyCashFlowRollup.amount).label("total_amount")
         )
         .join(models.OperationCategories)
         .filter(
-            models.CashFlow.date >= start_date,
-            models.CashFlow.date < end_date_inclusive,
+            models.DailyCashFlowRollup.day >= start_date,
+            models.DailyCashFlowRollup.day < end_date_inclusive,
             models.OperationCategories.type == 'expense',
             models.OperationCategories.view != 'Техническая операция',
             models.OperationCategories.name != 'Закупка товара'
         )
         .group_by(models.OperationCategories.name)
-        .order_by(func.sum(models.CashFlow.amount).asc()) # Сортируем от самых больших расходов
+        .order_by(func.sum(models.DailyCashFlowRollup.amount).asc()) # Сортируем от самых больших расходов
     )
     
     result = await db.execute(query)
@@ -1,19 +1,132 @@
 import os
+import time
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import declarative_base, Session
 
 
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
+# Адрес реплики для читающих запросов (аналитика). Если не задан - используется основная БД.
+SQLALCHEMY_READ_DATABASE_URL = os.getenv("DATABASE_READ_URL")
 
-engine = create_async_engine(SQLALCHEMY_DATABASE_URL)
+# --- Настройки пула соединений (из переменных окружения) ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Таймаут выполнения запроса на стороне Postgres (мс). 0 - без ограничения.
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# Размер кэша подготовленных выражений asyncpg. 0 - выключить (нужно за pgbouncer в режиме transaction).
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+
+def _build_connect_args(url: str) -> dict:
+    """Параметры подключения, специфичные для драйвера asyncpg."""
+    if not url or "asyncpg" not in url:
+        return {}
+    connect_args = {"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+    return connect_args
+
+
+def _create_engine(url: str):
+    return create_async_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=_build_connect_args(url),
+    )
+
+
+engine = _create_engine(SQLALCHEMY_DATABASE_URL)
+
+# Отдельный движок только для реплики, иначе чтение идет через общий пул
+if SQLALCHEMY_READ_DATABASE_URL and SQLALCHEMY_READ_DATABASE_URL != SQLALCHEMY_DATABASE_URL:
+    read_engine = _create_engine(SQLALCHEMY_READ_DATABASE_URL)
+else:
+    read_engine = engine
 
 # Асинхронный генератор сессий
 AsyncSessionLocal = async_sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadOnlySessionLocal = async_sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 
 Base = declarative_base()
 
-# Новая асинхронная функция для получения сессии
+
+# --- Метрики пула ---
+
+class PoolWaitStats:
+    """Накопительная статистика времени получения соединения из пула сессией."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total_seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+
+    def as_dict(self) -> dict:
+        return {
+            "acquisitions": self.count,
+            "avg_wait_ms": round(self.total_seconds / self.count * 1000, 3) if self.count else 0.0,
+            "max_wait_ms": round(self.max_seconds * 1000, 3),
+        }
+
+
+pool_wait_stats = PoolWaitStats()
+
+
+# Сессия создает корневую транзакцию до запроса соединения у пула, а after_begin
+# срабатывает сразу после его получения - разница и есть время ожидания (включая connect).
+@event.listens_for(Session, "after_transaction_create")
+def _mark_transaction_start(session, transaction):
+    if transaction.parent is None:
+        session.info["_pool_wait_started_at"] = time.perf_counter()
+
+
+@event.listens_for(Session, "after_begin")
+def _record_pool_wait(session, transaction, connection):
+    started_at = session.info.pop("_pool_wait_started_at", None)
+    if started_at is not None:
+        pool_wait_stats.record(time.perf_counter() - started_at)
+
+
+def _describe_pool(async_engine) -> dict:
+    pool = async_engine.pool
+    stats = {"pool_class": type(pool).__name__}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if callable(method):
+            stats[name] = method()
+    stats["max_overflow"] = DB_MAX_OVERFLOW
+    return stats
+
+
+def get_pool_stats() -> dict:
+    """Состояние пулов соединений: размер, занятые соединения, overflow и время ожидания."""
+    stats = {"primary": _describe_pool(engine), "wait": pool_wait_stats.as_dict()}
+    if read_engine is not engine:
+        stats["read_replica"] = _describe_pool(read_engine)
+    return stats
+
+
+# Новая асинхронная функция для получения сессии.
+# Соединение берется из пула только при первом запросе к БД, а не при создании сессии.
 async def get_db():
     async with AsyncSessionLocal() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+async def get_read_db():
+    """Сессия для читающих запросов (аналитика). Работает через реплику, если она настроена."""
+    async with ReadOnlySessionLocal() as session:
+        yield session
@@ -1,5 +1,6 @@
 # app/main.py 
 import os
+import asyncio
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения в самом начале
@@ -16,7 +17,7 @@ import secrets
 import httpx
 
 from fastapi.responses import JSONResponse
-from fastapi import Depends, FastAPI, HTTPException, status, Request
+from fastapi import Depends, FastAPI, HTTPException, Query, status, Request
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload, selectinload
@@ -29,13 +30,21 @@ from .models import format_enum_value_for_display
 # from sqlalchemy.orm import Session 
 from pydantic import ValidationError
 from . import crud, schemas, security, models, sdek_api
-from .database import get_db
+from .database import get_db, get_read_db, get_pool_stats
+from .reference_cache import reference_cache
+from . import notification_outbox
+from .response_cache import cached_response, response_cache
+from . import rollups
 from fastapi.middleware.cors import CORSMiddleware
 # Следующие импорты больше не нужны, если FastAPI не отдает статику
 # from fastapi.staticfiles import StaticFiles
 # from starlette.responses import HTMLResponse
 SERVER_DOMAIN = os.getenv("SERVER_DOMAIN")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Секрет в URL вебхука СДЭК; без него прием вебхуков выключен
+SDEK_WEBHOOK_SECRET = os.getenv("SDEK_WEBHOOK_SECRET")
+# Статусы приходят вебхуком, опрос СДЭК - редкая сверка на случай пропущенных событий
+SDEK_RECONCILE_INTERVAL_MINUTES = int(os.getenv("SDEK_RECONCILE_INTERVAL_MINUTES", "360"))
 
 
 app = FastAPI(title="resale shop API")
@@ -112,17 +121,18 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 @app.get("/api/v1/model-numbers/search", response_model=List[schemas.ModelNumber], tags=["Inspections"], dependencies=[Depends(security.require_permission("perform_inspections"))])
 async def search_for_model_numbers(
     q: str, # Параметр запроса, например /search?q=ABC
-    db: AsyncSession = Depends(get_db),
-    current_user: schemas.User = Depends(security.get_current_active_user)
+    limit: int = Query(crud.MODEL_NUMBER_SEARCH_LIMIT, ge=1, le=100),
+    db: AsyncSession = Depends(get_db)
 ):
-    """Ищет номера моделей для автодополнения."""
-    return await crud.search_model_numbers(db=db, query=q)
+    """Ищет номера моделей для автодополнения: сначала совпадения по началу номера, затем по фрагменту."""
+    return await crud.search_model_numbers(db=db, query=q, limit=limit)
 
 
 @app.get("/api/v1/phones/for-inspection", response_model=List[schemas.Phone], tags=["Inspections"])
 async def read_phones_for_inspection(db: AsyncSession = Depends(get_db)):
     phones = await crud.get_phones_for_inspection(db=db)
-    return [_format_phone_response(p) for p in phones]
+    model_names = await reference_cache.model_display_names(db, (p.model_id for p in phones))
+    return [_format_phone_response(p, model_names) for p in phones]
 
 
 
@@ -173,9 +183,7 @@ async def add_battery_test_endpoint(
 
     if updated_phone.model:
         model_name_base = updated_phone.model.model_name.name if updated_phone.model.model_name else ""
-        storage_display = models.format_storage_for_display(updated_phone.model.storage.storage) if updated_phone.model.storage else ""
-        color_name = updated_phone.model.color.color_name if updated_phone.model.color else ""
-        full_display_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
+        full_display_name = models.model_display_name(updated_phone.model)
         
         phone_dict['model'] = schemas.ModelDetail(
             id=updated_phone.model.id,
@@ -191,7 +199,8 @@ async def add_battery_test_endpoint(
 @app.get("/api/v1/phones/ready-for-packaging", response_model=List[schemas.Phone], tags=["Inspections"])
 async def read_phones_for_packaging(db: AsyncSession = Depends(get_db)):
     phones = await crud.get_phones_ready_for_packaging(db=db)
-    return [_format_phone_response(p) for p in phones]
+    model_names = await reference_cache.model_display_names(db, (p.model_id for p in phones))
+    return [_format_phone_response(p, model_names) for p in phones]
 
 @app.post("/api/v1/phones/package", response_model=List[schemas.Phone], tags=["Inspections"])
 async def package_phones_endpoint(
@@ -251,22 +260,35 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def _format_phone_response(phone: models.Phones) -> schemas.Phone:
+def _model_detail(model_display) -> schemas.ModelDetail:
+    """ModelDetail из записи кэша названий моделей (reference_cache.model_display_names)."""
+    return schemas.ModelDetail(
+        id=model_display.id,
+        name=model_display.name,
+        base_name=model_display.base_name,
+        model_name_id=model_display.model_name_id,
+        storage_id=model_display.storage_id,
+        color_id=model_display.color_id,
+        image_url=model_display.image_url
+    )
+
+def _format_phone_response(phone: models.Phones, model_names: Optional[dict] = None) -> schemas.Phone:
     """
     НАДЕЖНАЯ и ПОЛНАЯ функция форматирования.
     Безопасно собирает все данные о телефоне.
+    Если передана карта model_names (reference_cache.model_display_names), название модели
+    берется из нее и связи phone.model не нужны - так форматируются большие списки.
     """
     model_detail_schema = None
-    if hasattr(phone, 'model') and phone.model and phone.model.model_name and phone.model.storage and phone.model.color:
-        model_name_base = phone.model.model_name.name
-        storage_display = models.format_storage_for_display(phone.model.storage.storage)
-        color_name = phone.model.color.color_name
-        full_display_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
-
+    if model_names is not None:
+        model_display = model_names.get(phone.model_id)
+        if model_display and model_display.complete:
+            model_detail_schema = _model_detail(model_display)
+    elif hasattr(phone, 'model') and phone.model and phone.model.model_name and phone.model.storage and phone.model.color:
         model_detail_schema = schemas.ModelDetail(
             id=phone.model.id,
-            name=full_display_name,
-            base_name=model_name_base,
+            name=models.model_display_name(phone.model),
+            base_name=phone.model.model_name.name,
             model_name_id=phone.model.model_name_id,
             storage_id=phone.model.storage_id,
             color_id=phone.model.color_id,
@@ -336,10 +358,7 @@ async def _format_sale_response(sale: models.Sales, db: AsyncSession) -> schemas
                 serial_number = product_obj.serial_number
                 model_number = product_obj.model_number.name if product_obj.model_number else None
                 if product_obj.model:
-                    model_name_base = product_obj.model.model_name.name if product_obj.model.model_name else ""
-                    storage_display = models.format_storage_for_display(product_obj.model.storage.storage) if product_obj.model.storage else ""
-                    color_name = product_obj.model.color.color_name if product_obj.model.color else ""
-                    product_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
+                    product_name = models.model_display_name(product_obj.model)
 
         elif detail.warehouse.product_type_id == 2: # Аксессуар
             product_obj = accessories_map.get(detail.warehouse.product_id)
@@ -372,7 +391,7 @@ async def read_counterparties(db: AsyncSession = Depends(get_db), current_user:
 
 @app.get("/api/v1/cashflow/accounts", response_model=List[schemas.Account], tags=["Cash Flow"],
          dependencies=[Depends(security.require_any_permission("manage_cashflow", "perform_sales"))])
-async def read_accounts(db: AsyncSession = Depends(get_db), current_user: schemas.User = Depends(security.get_current_active_user)):
+async def read_accounts(db: AsyncSession = Depends(get_db)):
     return await crud.get_accounts(db=db)
 
 @app.get("/api/v1/sales/my-sales", response_model=List[schemas.SaleResponse], tags=["Sales"])
@@ -437,10 +456,7 @@ async def read_my_sales(
                     serial_number = product_obj.serial_number
                     model_number = product_obj.model_number.name if product_obj.model_number else None
                     if product_obj.model:
-                        model_name_base = product_obj.model.model_name.name if product_obj.model.model_name else ""
-                        storage_display = models.format_storage_for_display(product_obj.model.storage.storage) if product_obj.model.storage else ""
-                        color_name = product_obj.model.color.color_name if product_obj.model.color else ""
-                        product_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
+                        product_name = models.model_display_name(product_obj.model)
             
             elif detail.warehouse.product_type_id == 2: # Аксессуар
                 product_obj = accessories_map.get(detail.warehouse.product_id)
@@ -482,11 +498,18 @@ async def read_cash_flows(
     skip: int = 0,
     limit: int = 100,
     account_id: Optional[int] = None, # Добавляем фильтр
+    cursor: Optional[str] = None,
+    with_total: bool = True,
     db: AsyncSession = Depends(get_db),
     current_user: schemas.User = Depends(security.get_current_active_user)
 ):
-    cash_flows_data = await crud.get_cash_flows(db=db, skip=skip, limit=limit, account_id=account_id)
-    return {"items": cash_flows_data["items"], "total": cash_flows_data["total"]}
+    """
+    Движение денег, новые сверху. Следующая/предыдущая страница - по next_cursor/prev_cursor
+    из ответа (skip оставлен для совместимости). total кэшируется, with_total=false - без него.
+    """
+    return await crud.get_cash_flows(
+        db=db, skip=skip, limit=limit, account_id=account_id, cursor=cursor, with_total=with_total
+    )
 
 @app.post("/api/v1/cashflow/accounts", response_model=schemas.Account, tags=["Cash Flow"],
           dependencies=[Depends(security.require_permission("manage_cashflow"))])
@@ -645,7 +668,7 @@ async def login_for_access_token(
     # Создаем access token
     access_token_expires = timedelta(minutes=security.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = security.create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data=security.build_access_token_claims(user), expires_delta=access_token_expires
     )
 
     # Создаем refresh token
@@ -672,12 +695,15 @@ async def refresh_access_token(
     if not db_token or db_token.expires_at < datetime.utcnow():
         raise HTTPException(status_code=401, detail="Refresh token expired or invalid")
 
-    user = db_token.user
+    # Перечитываем пользователя вместе с правами, чтобы новый токен содержал актуальные права
+    user = await crud.get_user_by_username(db, username=db_token.user.username)
+    if not user:
+        raise HTTPException(status_code=401, detail="Refresh token expired or invalid")
     
     # Создаем новый access token
     access_token_expires = timedelta(minutes=security.ACCESS_TOKEN_EXPIRE_MINUTES)
     new_access_token = security.create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data=security.build_access_token_claims(user), expires_delta=access_token_expires
     )
 
     # Возвращаем новый access token и старый refresh token
@@ -696,6 +722,50 @@ async def logout(
     return {"message": "Successfully logged out"}
 
 
+@app.get("/api/v1/metrics/db-pool", tags=["Health Check"], dependencies=[Depends(security.require_permission("manage_users"))])
+async def read_db_pool_metrics():
+    """Статистика пула соединений с БД (занятые соединения, overflow, время ожидания)."""
+    return get_pool_stats()
+
+@app.get("/api/v1/auth/permission-cache/stats", tags=["Users"], dependencies=[Depends(security.require_permission("manage_users"))])
+async def read_permission_cache_stats():
+    """Статистика кэша прав: размер, попадания и промахи."""
+    return security.principal_cache.stats()
+
+@app.post("/api/v1/auth/permission-cache/clear", tags=["Users"], dependencies=[Depends(security.require_permission("manage_users"))])
+async def clear_permission_cache():
+    """Сбрасывает кэш прав (например, после изменения прав ролей в БД)."""
+    security.invalidate_all_principals()
+    return {"message": "Кэш прав сброшен"}
+
+@app.get("/api/v1/analytics/cache/stats", tags=["Analytics"], dependencies=[Depends(security.require_permission("view_reports"))])
+async def read_analytics_cache_stats():
+    """Статистика кэша аналитических ответов."""
+    return response_cache.stats()
+
+@app.post("/api/v1/analytics/cache/clear", tags=["Analytics"], dependencies=[Depends(security.require_permission("manage_users"))])
+async def clear_analytics_cache():
+    """Сбрасывает кэш аналитических ответов."""
+    await response_cache.clear()
+    return {"message": "Кэш аналитики сброшен"}
+
+@app.get("/api/v1/notifications/outbox/stats", tags=["Users"], dependencies=[Depends(security.require_permission("manage_users"))])
+async def read_notification_outbox_stats(hours: int = 24, db: AsyncSession = Depends(get_db)):
+    """Очередь уведомлений: строки по статусам и задержка доставки."""
+    return await notification_outbox.get_outbox_stats(db, hours)
+
+@app.get("/api/v1/reference-cache/stats", tags=["Users"], dependencies=[Depends(security.require_permission("manage_users"))])
+async def read_reference_cache_stats():
+    """Статистика кэша справочников: версии, размеры таблиц, попадания и промахи."""
+    return reference_cache.stats()
+
+@app.post("/api/v1/reference-cache/clear", tags=["Users"], dependencies=[Depends(security.require_permission("manage_users"))])
+async def clear_reference_cache():
+    """Сбрасывает кэш справочников (например, после правки справочников напрямую в БД)."""
+    reference_cache.invalidate()
+    return {"message": "Кэш справочников сброшен"}
+
+
 @app.get("/api/v1/users/me/", response_model=schemas.User)
 async def read_users_me(current_user: models.Users = Depends(security.get_current_active_user)):
     user_data = {
@@ -847,21 +917,40 @@ async def read_accessories_in_stock(db: AsyncSession = Depends(get_db)):
 async def read_phones(
     skip: int = 0,
     limit: int = 100,
+    cursor: Optional[str] = None,
+    with_total: bool = True,
     db: AsyncSession = Depends(get_db),
     current_user: schemas.User = Depends(security.get_current_active_user),
 ):
     """
     Получает список всех телефонов с пагинацией.
+    Следующая/предыдущая страница - по next_cursor/prev_cursor из ответа (skip оставлен
+    для совместимости). total кэшируется, with_total=false - без него.
     """
-    phones_data = await crud.get_phones(db=db, skip=skip, limit=limit)
+    phones_data = await crud.get_phones(db=db, skip=skip, limit=limit, cursor=cursor, with_total=with_total)
     
-    # Используем вашу существующую логику форматирования
-    formatted_phones = [_format_phone_response(p) for p in phones_data["items"]]
+    model_names = await reference_cache.model_display_names(db, (p.model_id for p in phones_data["items"]))
+    phones_data["items"] = [_format_phone_response(p, model_names) for p in phones_data["items"]]
     
-    return {"items": formatted_phones, "total": phones_data["total"]}
+    return phones_data
 
 
 
+@app.get(
+    "/api/v1/phones/search",
+    response_model=List[schemas.PhoneSearchResult],
+    tags=["Phones"],
+    dependencies=[Depends(security.require_any_permission("manage_inventory", "perform_sales"))]
+)
+async def search_phones(
+    q: str = Query(..., min_length=3, description="Фрагмент серийного номера, модельный номер или название модели"),
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_db)
+):
+    """Поиск телефонов с ранжированием: статус и место хранения в одном ответе."""
+    return await crud.search_phones(db=db, query=q, limit=limit)
+
+
 @app.get(
     "/api/v1/phones/history/{serial_number}",
     response_model=schemas.PhoneHistoryResponse,
@@ -870,42 +959,49 @@ async def read_phones(
 )
 async def get_phone_history(
     serial_number: str,
+    sections: Optional[str] = None,
     db: AsyncSession = Depends(get_db),
-    current_user: models.Users = Depends(security.get_current_active_user)
+    current_user: security.Principal = Depends(security.get_current_active_principal)
 ):
-    """Получает историю телефона. Доступно только менеджерам и продавцам."""
-
-    phone = await crud.get_phone_history_by_serial(db=db, serial_number=serial_number)
+    """
+    Получает историю телефона. Доступно только менеджерам и продавцам.
+    sections - разделы через запятую (timeline, purchase, inspections, repairs, warehouse, sale);
+    по умолчанию все. Продавцу закупка и инспекции не загружаются и не показываются.
+    """
+    if sections:
+        requested_sections = {section.strip() for section in sections.split(",") if section.strip()}
+        unknown_sections = requested_sections - set(crud.PHONE_HISTORY_SECTIONS)
+        if unknown_sections:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Неизвестные разделы истории: {', '.join(sorted(unknown_sections))}. "
+                       f"Доступны: {', '.join(crud.PHONE_HISTORY_SECTIONS)}"
+            )
+    else:
+        requested_sections = set(crud.PHONE_HISTORY_SECTIONS)
 
-    if not phone:
-        raise HTTPException(status_code=404, detail="Телефон не найден")
+    is_manager = security.user_has_permission(current_user, "manage_inventory")
 
-    # --- НАЧАЛО БЛОКА ИЗМЕНЕНИЙ ---
+    phone, warehouse_entry, sale_detail = await crud.get_phone_history_by_serial(
+        db=db, serial_number=serial_number, sections=requested_sections, full_access=is_manager
+    )
+    model_names = await reference_cache.model_display_names(db, [phone.model_id])
 
-    # 1. Загружаем и форматируем информацию о ремонтах и подменных устройствах
+    # 1. Ремонты и подменные устройства
+    repairs = phone.repairs if "repairs" in requested_sections else []
+    loaner_model_names = await reference_cache.model_names_for(db, (
+        log.loaner_phone.model_id for repair in repairs for log in repair.loaner_logs if log.loaner_phone
+    ))
     repairs_list = []
-    for repair in phone.repairs:
+    for repair in repairs:
         active_loaner_info = None
         # Ищем активную (невозвращенную) запись о выдаче для этого ремонта
         active_loaner_log = next((log for log in repair.loaner_logs if not log.date_returned), None)
 
         if active_loaner_log and active_loaner_log.loaner_phone:
             loaner = active_loaner_log.loaner_phone
-            
-            # --- НАЧАЛО НОВОЙ ЛОГИКИ СБОРКИ СТРОКИ ---
-            model_name_base = ""
-            storage_display = ""
-            color_name = ""
-            
-            if loaner.model:
-                model_name_base = loaner.model.model_name.name if loaner.model.model_name else ""
-                storage_display = models.format_storage_for_display(loaner.model.storage.storage) if loaner.model.storage else ""
-                color_name = loaner.model.color.color_name if loaner.model.color else ""
-            
-            full_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
-            
+            full_name = loaner_model_names.get(loaner.model_id, "")
             loaner_details_str = f"ID: {loaner.id}, {full_name} (S/N: {loaner.serial_number or 'б/н'})"
-            # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
 
             active_loaner_info = schemas.ActiveLoanerLog(
                 id=active_loaner_log.id,
@@ -934,60 +1030,42 @@ async def get_phone_history(
             active_loaner=active_loaner_info # Добавляем вычисленное значение
         ))
 
-
-
-    # --- КОНЕЦ БЛОКА ИЗМЕНЕНИЙ ---
-
-    is_manager = security.user_has_permission(current_user, "manage_inventory")
-    is_salesperson = security.user_has_permission(current_user, "perform_sales")
-
-    logs_to_display = phone.movement_logs
+    # 2. Закупка и инспекции - только для менеджеров (для продавца не загружались)
     purchase_info = None
     inspections_list = []
+    if is_manager:
+        if "purchase" in requested_sections and phone.supplier_order:
+            purchase_info = schemas.PhoneHistoryPurchase(
+                supplier_order_id=phone.supplier_order.id,
+                order_date=phone.supplier_order.order_date,
+                purchase_price=phone.purchase_price,
+                supplier_name=phone.supplier_order.supplier.name if phone.supplier_order.supplier else "Неизвестно"
+            )
 
-    if phone.supplier_order:
-        purchase_info = schemas.PhoneHistoryPurchase(
-            supplier_order_id=phone.supplier_order.id,
-            order_date=phone.supplier_order.order_date,
-            purchase_price=phone.purchase_price,
-            supplier_name=phone.supplier_order.supplier.name if phone.supplier_order.supplier else "Неизвестно"
-        )
-
-    for insp in phone.device_inspections:
-        # ... (остальная часть функции остается без изменений)
-        inspection_details = schemas.PhoneHistoryInspection(
-            inspection_date=insp.inspection_date,
-            inspected_by=insp.user.name if insp.user else "Неизвестно",
-            results=[ schemas.PhoneHistoryInspectionResult(item_name=res.checklist_item.name, result=res.result, notes=res.notes) for res in insp.inspection_results ],
-            battery_tests=[ schemas.PhoneHistoryBatteryTest(start_time=bt.start_time, end_time=bt.end_time, start_battery_level=bt.start_battery_level, end_battery_level=bt.end_battery_level, battery_drain=bt.battery_drain) for bt in insp.battery_tests ]
-        )
-        inspections_list.append(inspection_details)
+        for insp in (phone.device_inspections if "inspections" in requested_sections else []):
+            inspections_list.append(schemas.PhoneHistoryInspection(
+                inspection_date=insp.inspection_date,
+                inspected_by=insp.user.name if insp.user else "Неизвестно",
+                results=[ schemas.PhoneHistoryInspectionResult(item_name=res.checklist_item.name, result=res.result, notes=res.notes) for res in insp.inspection_results ],
+                battery_tests=[ schemas.PhoneHistoryBatteryTest(start_time=bt.start_time, end_time=bt.end_time, start_battery_level=bt.start_battery_level, end_battery_level=bt.end_battery_level, battery_drain=bt.battery_drain) for bt in insp.battery_tests ]
+            ))
 
+    # 3. Склад и продажа - загружены вместе с телефоном
     warehouse_info = None
     sale_info = None
-    warehouse_entry_result = await db.execute(select(models.Warehouse).options(selectinload(models.Warehouse.shop), selectinload(models.Warehouse.user)).filter_by(product_id=phone.id, product_type_id=1))
-    warehouse_entry = warehouse_entry_result.scalars().first()
-    if warehouse_entry:
+    if warehouse_entry and "warehouse" in requested_sections:
         warehouse_info = schemas.PhoneHistoryWarehouse(added_date=warehouse_entry.added_date, shop_name=warehouse_entry.shop.name if warehouse_entry.shop else "Неизвестно", accepted_by=warehouse_entry.user.name if warehouse_entry.user else "Неизвестно")
-        sale_detail_result = await db.execute(select(models.SaleDetails).options(selectinload(models.SaleDetails.sale).selectinload(models.Sales.customer)).filter_by(warehouse_id=warehouse_entry.id))
-        sale_detail = sale_detail_result.scalars().first()
-        if sale_detail and sale_detail.sale:
-            sale = sale_detail.sale
-            sale_info = schemas.PhoneHistorySale(sale_id=sale.id, sale_date=sale.sale_date, unit_price=sale_detail.unit_price, customer_name=sale.customer.name if sale.customer else None, customer_number=sale.customer.number if sale.customer else None)
-
-    if is_salesperson and not is_manager:
-        salesperson_visible_events = { models.PhoneEventType.ПРИНЯТ_НА_СКЛАД, models.PhoneEventType.ПРОДАН, models.PhoneEventType.ВОЗВРАТ_ОТ_КЛИЕНТА, models.PhoneEventType.ОТПРАВЛЕН_В_РЕМОНТ, models.PhoneEventType.ПОЛУЧЕН_ИЗ_РЕМОНТА, models.PhoneEventType.ОБМЕНЕН, models.PhoneEventType.ПЕРЕМЕЩЕНИЕ, }
-        logs_to_display = [ log for log in phone.movement_logs if log.event_type in salesperson_visible_events ]
-        purchase_info = None
-        inspections_list = []
+    if sale_detail and sale_detail.sale and "sale" in requested_sections:
+        sale = sale_detail.sale
+        sale_info = schemas.PhoneHistorySale(sale_id=sale.id, sale_date=sale.sale_date, unit_price=sale_detail.unit_price, customer_name=sale.customer.name if sale.customer else None, customer_number=sale.customer.number if sale.customer else None)
+
+    # 4. Лента событий (для продавца отфильтрована в запросе)
+    logs_to_display = phone.movement_logs if "timeline" in requested_sections else []
 
     model_detail = None
-    if phone.model:
-        model_name_base = phone.model.model_name.name if phone.model.model_name else ""
-        storage_display = models.format_storage_for_display(phone.model.storage.storage) if phone.model.storage else ""
-        color_name = phone.model.color.color_name if phone.model.color else ""
-        full_display_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
-        model_detail = schemas.ModelDetail(id=phone.model.id, name=full_display_name, base_name=model_name_base, model_name_id=phone.model.model_name_id, storage_id=phone.model.storage_id, color_id=phone.model.color_id, image_url=phone.model.image_url)
+    model_display = model_names.get(phone.model_id)
+    if model_display:
+        model_detail = _model_detail(model_display)
 
     return schemas.PhoneHistoryResponse(
         id=phone.id, serial_number=phone.serial_number,
@@ -997,7 +1075,7 @@ async def get_phone_history(
         movement_logs=[ schemas.PhoneMovementLog(id=log.id, timestamp=log.timestamp, event_type=log.event_type.value.replace('_', ' ').capitalize(), details=log.details, user=log.user) for log in logs_to_display ],
         purchase_info=purchase_info, inspections=inspections_list,
         warehouse_info=warehouse_info, sale_info=sale_info,
-        repairs=repairs_list # <--- ДОБАВЛЕНО: Передаем отформатированный список ремонтов
+        repairs=repairs_list
     )
 
 # --- Эндпоинты для Поставщиков ---
@@ -1294,7 +1372,7 @@ async def refresh_sdek_status_for_order(
 
 
 @app.get("/api/v1/shops", response_model=List[schemas.Shop], tags=["Warehouse"], dependencies=[Depends(security.require_any_permission("manage_inventory", "perform_sales"))])
-async def read_shops(db: AsyncSession = Depends(get_db), current_user: schemas.User = Depends(security.get_current_active_user)):
+async def read_shops(db: AsyncSession = Depends(get_db)):
     return await crud.get_shops(db=db)
 
 @app.get("/api/v1/phones/ready-for-stock", response_model=List[schemas.Phone], tags=["Warehouse"], dependencies=[Depends(security.require_any_permission("manage_inventory", "perform_sales"))])
@@ -1318,11 +1396,7 @@ async def read_phones_ready_for_stock(
 
         if phone.model:
             model_name_base = phone.model.model_name.name if phone.model.model_name else ""
-            storage_display = models.format_storage_for_display(phone.model.storage.storage) if phone.model.storage else ""
-            color_name = phone.model.color.color_name if phone.model.color else ""
-
-            full_name_parts = [part for part in [model_name_base, storage_display, color_name] if part]
-            full_display_name = " ".join(full_name_parts)
+            full_display_name = models.model_display_name(phone.model)
 
             phone_dict['model'] = schemas.ModelDetail(
                 id=phone.model.id,
@@ -1475,7 +1549,7 @@ async def read_customers(db: AsyncSession = Depends(get_db)):
 
 @app.get("/api/v1/products-for-sale", response_model=List[schemas.ProductForSale], tags=["Sales"],
          dependencies=[Depends(security.require_permission("perform_sales"))])
-async def read_products_for_sale(db: AsyncSession = Depends(get_db), current_user: schemas.User = Depends(security.get_current_active_user)):
+async def read_products_for_sale(db: AsyncSession = Depends(get_db)):
     warehouse_items = await crud.get_products_for_sale(db=db)
     
 
@@ -1499,11 +1573,7 @@ async def read_products_for_sale(db: AsyncSession = Depends(get_db), current_use
             serial_number = product_obj.serial_number
             condition = product_obj.condition.value if product_obj.condition else None 
             if product_obj.model:
-                model_name_base = product_obj.model.model_name.name if product_obj.model.model_name else ""
-                storage_display = models.format_storage_for_display(product_obj.model.storage.storage) if product_obj.model.storage else ""
-                color_name = product_obj.model.color.color_name if product_obj.model.color else ""
-                full_name_parts = [part for part in [model_name_base, storage_display, color_name] if part]
-                name = " ".join(full_name_parts)
+                name = models.model_display_name(product_obj.model)
                 if product_obj.model.retail_prices_phones:
                     latest_price_entry = sorted(product_obj.model.retail_prices_phones, key=lambda p: p.date, reverse=True)[0]
                     price = latest_price_entry.price
@@ -1601,10 +1671,7 @@ async def create_new_sale(
                 serial_number = product_obj.serial_number
                 model_number = product_obj.model_number.name if product_obj.model_number else None
                 if product_obj.model:
-                    model_name_base = product_obj.model.model_name.name if product_obj.model.model_name else ""
-                    storage_display = models.format_storage_for_display(product_obj.model.storage.storage) if product_obj.model.storage else ""
-                    color_name = product_obj.model.color.color_name if product_obj.model.color else ""
-                    product_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
+                    product_name = models.model_display_name(product_obj.model)
         
         elif warehouse.product_type_id == 2: # Аксессуар
             product_obj = accessories_map.get(warehouse.product_id)
@@ -2058,13 +2125,15 @@ async def create_sdek_order_for_return_shipment(
 @app.get("/api/v1/phones/defective", response_model=List[schemas.Phone], tags=["Returns"], dependencies=[Depends(security.require_any_permission("manage_inventory", "perform_inspections"))])
 async def read_defective_phones(db: AsyncSession = Depends(get_db)):
     phones = await crud.get_defective_phones(db=db)
-    return [_format_phone_response(p) for p in phones]
+    model_names = await reference_cache.model_display_names(db, (p.model_id for p in phones))
+    return [_format_phone_response(p, model_names) for p in phones]
     # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
 
 @app.get("/api/v1/phones/sent-to-supplier", response_model=List[schemas.Phone], tags=["Returns"], dependencies=[Depends(security.require_any_permission("manage_inventory", "perform_inspections"))])
 async def read_phones_sent_to_supplier(db: AsyncSession = Depends(get_db)):
     phones = await crud.get_phones_sent_to_supplier(db=db)
-    return [_format_phone_response(p) for p in phones]
+    model_names = await reference_cache.model_display_names(db, (p.model_id for p in phones))
+    return [_format_phone_response(p, model_names) for p in phones]
 
 
 
@@ -2113,9 +2182,7 @@ async def process_phone_return_from_supplier(phone_id: int, db: AsyncSession = D
     phone_dict = updated_phone.__dict__
     if updated_phone.model:
         model_name_base = updated_phone.model.model_name.name if updated_phone.model.model_name else ""
-        storage_display = models.format_storage_for_display(updated_phone.model.storage.storage) if updated_phone.model.storage else ""
-        color_name = updated_phone.model.color.color_name if updated_phone.model.color else ""
-        full_display_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
+        full_display_name = models.model_display_name(updated_phone.model)
         phone_dict['model'] = schemas.ModelDetail(
             id=updated_phone.model.id,
             name=full_display_name,
@@ -2268,10 +2335,7 @@ async def get_replacement_phones(phone_id: int, db: AsyncSession = Depends(get_d
     for p in replacement_phones:
         full_name = "Модель не определена"
         if p.model:
-            model_name_base = p.model.model_name.name if p.model.model_name else ""
-            storage_display = models.format_storage_for_display(p.model.storage.storage) if p.model.storage else ""
-            color_name = p.model.color.color_name if p.model.color else ""
-            full_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
+            full_name = models.model_display_name(p.model)
 
         response_list.append(
             schemas.PhoneForExchange(
@@ -2311,10 +2375,7 @@ async def read_phones_in_stock(db: AsyncSession = Depends(get_db)):
         quantity = item["quantity"]
         model_numbers = item["model_numbers"]
 
-        model_name_base = phone_model.model_name.name if phone_model.model_name else ""
-        storage_display = models.format_storage_for_display(phone_model.storage.storage) if phone_model.storage else ""
-        color_name = phone_model.color.color_name if phone_model.color else ""
-        full_name = " ".join(part for part in [model_name_base, storage_display, color_name] if part)
+        full_name = models.model_display_name(phone_model)
 
         latest_price = None
         if phone_model.retail_prices_phones:
@@ -2337,8 +2398,9 @@ async def read_phones_in_stock(db: AsyncSession = Depends(get_db)):
 async def read_all_phones_in_stock_detailed(db: AsyncSession = Depends(get_db)):
     """Получает детальный список всех телефонов на складе с их местоположением."""
     phones = await crud.get_all_phones_in_stock_detailed(db=db)
-    # Форматируем ответ с помощью общей функции
-    return [_format_phone_response(p) for p in phones]
+    # Названия моделей - из кэша, без загрузки связей для каждого телефона
+    model_names = await reference_cache.model_display_names(db, (p.model_id for p in phones))
+    return [_format_phone_response(p, model_names) for p in phones]
 
 @app.get("/api/v1/phones/available-for-loaner", response_model=list[schemas.LoanerPhoneInfo], tags=["Repairs"])
 async def get_available_loaner_phones(db: AsyncSession = Depends(get_db)):
@@ -2386,11 +2448,7 @@ async def read_phone_by_id(
 
     if phone.model:
         model_name_base = phone.model.model_name.name if phone.model.model_name else ""
-        storage_display = models.format_storage_for_display(phone.model.storage.storage) if phone.model.storage else ""
-        color_name = phone.model.color.color_name if phone.model.color else ""
-
-        full_name_parts = [part for part in [model_name_base, storage_display, color_name] if part]
-        full_display_name = " ".join(full_name_parts)
+        full_display_name = models.model_display_name(phone.model)
 
         phone_dict['model'] = schemas.ModelDetail(
             id=phone.model.id,
@@ -2586,6 +2644,28 @@ async def get_payroll_report_endpoint(
         
     return await crud.get_payroll_report(db=db, start_date=start_date, end_date=end_date)
 
+@app.get("/api/v1/reports/payroll/tariffs",
+         response_model=List[schemas.PayrollTariff],
+         tags=["Reports"],
+         dependencies=[Depends(security.require_permission("view_reports"))])
+async def read_payroll_tariffs(db: AsyncSession = Depends(get_db)):
+    """Возвращает ставки, по которым считается зарплатный отчет."""
+    return await reference_cache.all(db, "payroll_tariffs")
+
+@app.put("/api/v1/reports/payroll/tariffs/{code}",
+         response_model=schemas.PayrollTariff,
+         tags=["Reports"],
+         dependencies=[Depends(security.require_permission("manage_users"))])
+async def update_payroll_tariff_endpoint(
+    code: str,
+    data: schemas.PayrollTariffUpdate,
+    db: AsyncSession = Depends(get_db)
+):
+    """Меняет ставку зарплатного отчета."""
+    if data.rate < 0:
+        raise HTTPException(status_code=400, detail="Ставка не может быть отрицательной.")
+    return await crud.update_payroll_tariff(db=db, code=code, data=data)
+
 @app.post("/api/v1/reports/payroll/pay", 
           tags=["Reports"],
           dependencies=[Depends(security.require_permission("manage_cashflow"))])
@@ -2665,17 +2745,18 @@ scheduler.add_job(close_overdue_shifts, 'cron', hour=23, minute=59)
 async def read_product_analytics(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает аналитику по продажам моделей телефонов за период."""
     return await crud.get_product_analytics(db=db, start_date=start_date, end_date=end_date)
 
 @app.get("/api/v1/analytics/financials", response_model=schemas.FinancialAnalyticsResponse, tags=["Analytics"],
          dependencies=[Depends(security.require_permission("view_reports"))])
+@cached_response(tags=("sales", "cash_flow"), scope="view_reports")
 async def read_financial_analytics(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает данные для построения финансовых графиков."""
     return await crud.get_financial_analytics(db=db, start_date=start_date, end_date=end_date)
@@ -2694,7 +2775,7 @@ async def read_product_analytics_details(
     model_name: str,
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает детали продаж (чеки) для конкретной модели за период."""
     sales = await crud.get_sales_for_product_analytics_details(db, model_name, start_date, end_date)
@@ -2705,7 +2786,7 @@ async def read_product_analytics_details(
 async def read_accessory_analytics(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает аналитику по продажам аксессуаров за период."""
     return await crud.get_accessory_analytics(db=db, start_date=start_date, end_date=end_date)
@@ -2716,7 +2797,7 @@ async def read_accessory_analytics(
 async def read_employee_analytics(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает аналитику по эффективности сотрудников за период."""
     return await crud.get_employee_analytics(db=db, start_date=start_date, end_date=end_date)
@@ -2726,76 +2807,83 @@ async def read_employee_analytics(
 async def read_customer_analytics(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает аналитику по источникам трафика и клиентам."""
     return await crud.get_customer_analytics(db=db, start_date=start_date, end_date=end_date)
 
 @app.get("/api/v1/analytics/inventory", response_model=schemas.InventoryAnalyticsResponse, tags=["Analytics"],
          dependencies=[Depends(security.require_permission("view_reports"))])
+@cached_response(tags=("inventory",), scope="view_reports")
 async def read_inventory_analytics(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает аналитику по складу."""
     return await crud.get_inventory_analytics(db=db, start_date=start_date, end_date=end_date)
 
 @app.get("/api/v1/analytics/margins", response_model=List[schemas.MarginAnalyticsItem], tags=["Analytics"],
          dependencies=[Depends(security.require_permission("view_reports"))])
+@cached_response(tags=("sales",), scope="view_reports")
 async def read_margin_analytics(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает аналитику по маржинальности моделей за период."""
     return await crud.get_margin_analytics(db=db, start_date=start_date, end_date=end_date)
 
 @app.get("/api/v1/analytics/sell-through", response_model=schemas.SellThroughReport, tags=["Analytics"],
          dependencies=[Depends(security.require_permission("view_reports"))])
+@cached_response(tags=("sales", "inventory"), scope="view_reports")
 async def read_sell_through_analytics(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает отчет по оборачиваемости (Sell-Through Rate)."""
     return await crud.get_sell_through_analytics(db=db, start_date=start_date, end_date=end_date)
 
 @app.get("/api/v1/analytics/abc-analysis", response_model=schemas.AbcAnalysisReport, tags=["Analytics"],
          dependencies=[Depends(security.require_permission("view_reports"))])
+@cached_response(tags=("sales",), scope="view_reports")
 async def read_abc_analysis(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает ABC-анализ товаров по выручке."""
     return await crud.get_abc_analysis(db=db, start_date=start_date, end_date=end_date)
 
 @app.get("/api/v1/analytics/repeat-customers", response_model=schemas.RepeatPurchaseReport, tags=["Analytics"],
          dependencies=[Depends(security.require_permission("view_reports"))])
+@cached_response(tags=("sales",), scope="view_reports")
 async def read_repeat_customer_analytics(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает аналитику по повторным покупкам."""
     return await crud.get_repeat_purchase_analytics(db=db, start_date=start_date, end_date=end_date)
 
 @app.get("/api/v1/analytics/average-check", response_model=schemas.AverageCheckReport, tags=["Analytics"],
          dependencies=[Depends(security.require_permission("view_reports"))])
+@cached_response(tags=("sales",), scope="view_reports")
 async def read_average_check_analytics(
     start_date: date,
     end_date: date,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает аналитику по среднему чеку."""
     return await crud.get_average_check_analytics(db=db, start_date=start_date, end_date=end_date)
 
 @app.get("/api/v1/analytics/cash-flow-forecast", response_model=schemas.CashFlowForecastReport, tags=["Analytics"],
          dependencies=[Depends(security.require_permission("view_reports"))])
+@cached_response(tags=("sales", "cash_flow"), scope="view_reports")
 async def read_cash_flow_forecast(
     forecast_days: int = 30,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Возвращает прогноз движения денежных средств."""
     return await crud.get_cash_flow_forecast(db=db, forecast_days=forecast_days)
@@ -2810,7 +2898,8 @@ async def read_dividend_calculations(db: AsyncSession = Depends(get_db)):
 
 @app.get("/api/v1/analytics/company-health", response_model=schemas.CompanyHealthResponse, tags=["Analytics"],
          dependencies=[Depends(security.require_permission("view_reports"))])
-async def read_company_health_analytics(db: AsyncSession = Depends(get_db)):
+@cached_response(tags=("finance", "cash_flow"), scope="view_reports")
+async def read_company_health_analytics(db: AsyncSession = Depends(get_read_db)):
     """Возвращает аналитику по общему состоянию компании."""
     return await crud.get_company_health_analytics(db=db)
 
@@ -2891,6 +2980,22 @@ async def calculate_sdek_cost(
     calculation_result = await sdek_api.calculate_sdek_delivery_cost(sdek_data.model_dump(), token)
     return calculation_result
 
+@app.post("/api/v1/sdek/webhook/{secret}", tags=["SDEK Integration"])
+async def sdek_status_webhook(
+    secret: str,
+    payload: dict,
+    db: AsyncSession = Depends(get_db)
+):
+    """Принимает вебхуки СДЭК ORDER_STATUS (регистрируются в СДЭК на этот URL)."""
+    if not SDEK_WEBHOOK_SECRET or secret != SDEK_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return await crud.ingest_sdek_status_webhook(db, payload)
+
+@app.get("/api/v1/sdek/calculate-cost/cache/stats", tags=["SDEK Integration"], dependencies=[Depends(security.require_permission("manage_users"))])
+async def read_sdek_tariff_cache_stats():
+    """Статистика кэша расчетов стоимости доставки СДЭК."""
+    return sdek_api.tariff_cache.stats()
+
 
 @app.post("/api/v1/supplier-orders/{order_id}/create-sdek-delivery", tags=["Supplier Orders"])
 async def create_sdek_order_for_supplier_order(
@@ -2970,11 +3075,32 @@ async def scheduled_sdek_check():
     async with AsyncSessionLocal() as session:
         await crud.check_and_update_sdek_statuses(session)
 
+async def scheduled_rollup_reconciliation():
+    """Ночная сверка дневных агрегатов аналитики с продажами и движением денег."""
+    async with AsyncSessionLocal() as session:
+        await rollups.reconcile_daily_rollups(session)
+
 # Внутри функции startup_event (если ее нет, создайте)
 @app.on_event("startup")
 async def startup_event():
-    scheduler.add_job(scheduled_sdek_check, 'interval', minutes=30)
+    # Справочники загружаем сразу, чтобы первые запросы не ходили за ними в БД
+    async with AsyncSessionLocal() as session:
+        await reference_cache.load(session)
+
+    scheduler.add_job(scheduled_sdek_check, 'interval', minutes=SDEK_RECONCILE_INTERVAL_MINUTES)
+    scheduler.add_job(scheduled_rollup_reconciliation, 'cron', hour=3, minute=0)
+
+    # Воркер очереди уведомлений (Telegram, лист ожидания)
+    app.state.outbox_worker = asyncio.create_task(notification_outbox.run_outbox_worker())
 
     # Запускаем планировщик
     scheduler.start()
-    print("Планировщик задач запущен.")
\ No newline at end of file
+    print("Планировщик задач запущен.")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    worker = getattr(app.state, "outbox_worker", None)
+    if worker:
+        worker.cancel()
+    # Закрываем общий HTTP-клиент СДЭК (пул keep-alive соединений)
+    await sdek_api.close_client()
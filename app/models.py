@@ -16,6 +16,10 @@ class Base(DeclarativeBase):
     pass
 
 
+# Текст лога, которым отмечается упаковка телефона (по нему считаются упаковки в отчетах)
+PACKAGING_LOG_DETAILS = "Телефон упакован и готов к приемке на склад."
+
+
 # Enum definitions
 class TechStatus(PyEnum):
     ОЖИДАЕТ_ПРОВЕРКУ = "ОЖИДАЕТ_ПРОВЕРКУ"
@@ -123,7 +127,7 @@ class SupplierOrders(Base):
     status: Mapped[Optional[StatusDelivery]] = mapped_column(Enum(StatusDelivery, native_enum=False)) 
     payment_status: Mapped[Optional[OrderPaymentStatus]] = mapped_column(Enum(OrderPaymentStatus, native_enum=False), default=OrderPaymentStatus.НЕ_ОПЛАЧЕН)
     delivery_payment_status: Mapped[Optional[OrderPaymentStatus]] = mapped_column(Enum(OrderPaymentStatus, native_enum=False), default=OrderPaymentStatus.НЕ_ОПЛАЧЕН, nullable=False)
-    sdek_order_uuid: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    sdek_order_uuid: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, index=True)
     sdek_track_number: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     sdek_status: Mapped[Optional[str]] = mapped_column(String(255), nullable=True) 
 
@@ -227,6 +231,25 @@ class Phones(Base):
     )
     repairs: Mapped[List["Repairs"]] = relationship("Repairs", back_populates="phone")
 
+    __table_args__ = (
+        sa.Index("ix_phones_commercial_status_model_id", "commercial_status", "model_id"),
+        sa.Index("ix_phones_technical_status", "technical_status"),
+        sa.Index("ix_phones_model_number_id", "model_number_id"),
+    )
+
+
+# Поиск по серийному номеру без учета регистра (get_phone_history_by_serial)
+sa.Index("ix_phones_serial_number_lower", sa.func.lower(Phones.serial_number))
+# Поиск по фрагменту серийного номера/IMEI и модельного номера (crud.search_phones, расширение pg_trgm)
+sa.Index(
+    "ix_phones_serial_number_trgm", sa.func.lower(Phones.serial_number).label("serial_number_lower"),
+    postgresql_using="gin", postgresql_ops={"serial_number_lower": "gin_trgm_ops"}
+)
+sa.Index(
+    "ix_model_number_name_trgm", sa.func.lower(ModelNumber.name).label("name_lower"),
+    postgresql_using="gin", postgresql_ops={"name_lower": "gin_trgm_ops"}
+)
+
 
 class Roles(Base):
     __tablename__ = "roles"
@@ -308,6 +331,10 @@ class DeviceInspection(Base):
     inspection_results: Mapped[List["InspectionResults"]] = relationship("InspectionResults", back_populates="device_inspection")
     battery_tests: Mapped[List["BatteryTest"]] = relationship("BatteryTest", back_populates="device_inspection")
 
+    __table_args__ = (
+        sa.Index("ix_device_inspection_user_id_inspection_date", "user_id", "inspection_date"),
+    )
+
 
 class InspectionResults(Base):
     __tablename__ = "inspection_results"
@@ -441,6 +468,10 @@ class Warehouse(Base):
     shop: Mapped[Optional["Shops"]] = relationship("Shops", back_populates="warehouses")
     sale_details: Mapped[List["SaleDetails"]] = relationship("SaleDetails", back_populates="warehouse")
     user: Mapped[Optional["Users"]] = relationship("Users")
+
+    __table_args__ = (
+        sa.Index("ix_warehouse_product_type_id_product_id", "product_type_id", "product_id", "id"),
+    )
     
     # Hybrid properties для получения товара
     def get_product(self, session):
@@ -522,6 +553,11 @@ class Sales(Base):
     payments: Mapped[List["SalePayments"]] = relationship("SalePayments", back_populates="sale") 
     currency: Mapped[Optional["Currency"]] = relationship("Currency", back_populates="sales")
 
+    __table_args__ = (
+        sa.Index("ix_sales_sale_date", "sale_date"),
+        sa.Index("ix_sales_user_id_sale_date", "user_id", "sale_date"),
+    )
+
 
 class SalePayments(Base):
     __tablename__ = "sale_payments"
@@ -554,6 +590,11 @@ class SaleDetails(Base):
     sale: Mapped[Optional["Sales"]] = relationship("Sales", back_populates="sale_details")
     warehouse: Mapped[Optional["Warehouse"]] = relationship("Warehouse", back_populates="sale_details")
 
+    __table_args__ = (
+        sa.Index("ix_sale_details_sale_id", "sale_id"),
+        sa.Index("ix_sale_details_warehouse_id", "warehouse_id"),
+    )
+
 
 class Counterparties(Base):
     __tablename__ = "counterparties"
@@ -599,6 +640,11 @@ class CashFlow(Base):
     account: Mapped[Optional["Accounts"]] = relationship("Accounts", back_populates="cash_flows")
     currency: Mapped[Optional["Currency"]] = relationship("Currency", back_populates="cash_flows")
 
+    __table_args__ = (
+        sa.Index("ix_cash_flow_date_id", "date", "id"),
+        sa.Index("ix_cash_flow_account_id_date_id", "account_id", "date", "id"),
+    )
+
 
 class WaitingRoom(Base):
     __tablename__ = "waiting_room"
@@ -838,6 +884,25 @@ def format_storage_for_display(storage_value_raw: Optional[Union[int, str]]) ->
         return f"{numeric_value // 1024}TB" # Используем целочисленное деление
     else:
         return f"{numeric_value}GB"
+
+
+def format_model_display_name(model_name: Optional[str], storage_value_raw=None, color_name: Optional[str] = None) -> str:
+    """Полное название модели: "<название> <память> <цвет>", пустые части пропускаются."""
+    storage_display = format_storage_for_display(storage_value_raw) if storage_value_raw is not None else None
+    return " ".join(part for part in [model_name, storage_display, color_name] if part)
+
+
+def model_display_name(model: Optional["Models"]) -> str:
+    """Полное название для модели с загруженными model_name, storage и color."""
+    if model is None:
+        return ""
+    return format_model_display_name(
+        model.model_name.name if model.model_name else None,
+        model.storage.storage if model.storage else None,
+        model.color.color_name if model.color else None,
+    )
+
+
 class PhoneMovementLog(Base):
     __tablename__ = "phone_movement_log"
 
@@ -851,6 +916,19 @@ class PhoneMovementLog(Base):
     # Связи
     phone: Mapped["Phones"] = relationship("Phones", back_populates="movement_logs")
     user: Mapped["Users"] = relationship("Users")
+
+    __table_args__ = (
+        sa.Index("ix_phone_movement_log_phone_id_timestamp", "phone_id", "timestamp"),
+        sa.Index("ix_phone_movement_log_event_type_timestamp", "event_type", "timestamp"),
+    )
+
+
+# Частичный индекс только по логам упаковки (отчеты по зарплате/сотрудникам, очередь приемки)
+sa.Index(
+    "ix_phone_movement_log_packaging",
+    PhoneMovementLog.timestamp, PhoneMovementLog.user_id, PhoneMovementLog.phone_id,
+    postgresql_where=PhoneMovementLog.details == PACKAGING_LOG_DETAILS,
+)
     
 class TrafficSource(Base):
     __tablename__ = "traffic_sources"
@@ -904,6 +982,16 @@ class Payroll(Base):
     user: Mapped["Users"] = relationship("Users")
     account: Mapped["Accounts"] = relationship("Accounts")
 
+class PayrollTariff(Base):
+    """Ставки для зарплатного отчета. code совпадает с ключом в PayrollBreakdown."""
+    __tablename__ = "payroll_tariffs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    code: Mapped[str] = mapped_column(String(50), unique=True, nullable=False)
+    name: Mapped[Optional[str]] = mapped_column(String(255))
+    rate: Mapped[Decimal] = mapped_column(Numeric, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, onupdate=datetime.now)
+
 class FinancialSnapshot(Base):
     __tablename__ = "financial_snapshots"
 
@@ -1011,7 +1099,7 @@ class ReturnShipment(Base):
     created_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
     track_number: Mapped[Optional[str]] = mapped_column(String(255))
     status: Mapped[str] = mapped_column(String(50), default="В сборке") # Например: В сборке, Отправлен, Завершен
-    sdek_order_uuid: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    sdek_order_uuid: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, index=True)
     sdek_track_number: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     sdek_status: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     
@@ -1028,3 +1116,150 @@ class ReturnShipmentItem(Base):
     shipment: Mapped["ReturnShipment"] = relationship("ReturnShipment", back_populates="items")
     phone: Mapped["Phones"] = relationship("Phones")
 
+
+
+class PhoneCurrentLocation(Base):
+    """
+    Проекция "телефон -> его последняя складская запись".
+    Поддерживается в тех же транзакциях, что создают/меняют записи warehouse,
+    чтобы запросы остатков не считали row_number() по всей истории склада.
+    """
+    __tablename__ = "phone_current_location"
+
+    phone_id: Mapped[int] = mapped_column(Integer, ForeignKey("phones.id"), primary_key=True)
+    warehouse_id: Mapped[int] = mapped_column(Integer, ForeignKey("warehouse.id"), nullable=False)
+    shop_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("shops.id"))
+    storage_location: Mapped[Optional[EnumShop]] = mapped_column(Enum(EnumShop, native_enum=False), index=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+
+    phone: Mapped["Phones"] = relationship("Phones")
+    warehouse: Mapped["Warehouse"] = relationship("Warehouse")
+    shop: Mapped[Optional["Shops"]] = relationship("Shops")
+
+
+class DailySalesRollup(Base):
+    """
+    Дневные итоги продаж в разрезе сотрудника и источника трафика.
+    Пересчитываются по затронутым дням после записи продаж и ночной сверкой (см. app/rollups.py).
+    """
+    __tablename__ = "daily_sales_rollup"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    day: Mapped[date] = mapped_column(Date, nullable=False, index=True)
+    user_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("users.id"))
+    source_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("traffic_sources.id"))
+    sales_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    revenue: Mapped[Decimal] = mapped_column(Numeric, nullable=False, default=0)
+    profit: Mapped[Decimal] = mapped_column(Numeric, nullable=False, default=0)
+    card_revenue: Mapped[Decimal] = mapped_column(Numeric, nullable=False, default=0)
+
+
+class DailyModelSalesRollup(Base):
+    """Дневные итоги продаж телефонов по названию модели (маржинальность, ABC-анализ)."""
+    __tablename__ = "daily_model_sales_rollup"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    day: Mapped[date] = mapped_column(Date, nullable=False, index=True)
+    model_name_id: Mapped[int] = mapped_column(Integer, ForeignKey("model_name.id"), nullable=False)
+    units: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    revenue: Mapped[Decimal] = mapped_column(Numeric, nullable=False, default=0)
+    # Только строки с ценой > 0 (без подарков) - для средних цен в аналитике маржинальности
+    priced_lines: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    priced_sum: Mapped[Decimal] = mapped_column(Numeric, nullable=False, default=0)
+    purchase_lines: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    purchase_sum: Mapped[Decimal] = mapped_column(Numeric, nullable=False, default=0)
+
+
+class DailyCashFlowRollup(Base):
+    """Дневные итоги движения денег в разрезе счета и категории операции."""
+    __tablename__ = "daily_cash_flow_rollup"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    day: Mapped[date] = mapped_column(Date, nullable=False, index=True)
+    account_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("accounts.id"))
+    operation_categories_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("operation_categories.id"))
+    operations_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    amount: Mapped[Decimal] = mapped_column(Numeric, nullable=False, default=0)
+
+
+class SdekWebhookEvent(Base):
+    """Принятые вебхуки СДЭК ORDER_STATUS. Уникальный ключ отсекает повторные доставки одного события."""
+    __tablename__ = "sdek_webhook_events"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    order_uuid: Mapped[str] = mapped_column(String(255), nullable=False)
+    status_code: Mapped[str] = mapped_column(String(100), nullable=False)
+    status_date_time: Mapped[str] = mapped_column(String(64), nullable=False, default="")
+    received_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+    payload: Mapped[Optional[dict]] = mapped_column(JSONB, nullable=True)
+
+    __table_args__ = (
+        sa.UniqueConstraint("order_uuid", "status_code", "status_date_time", name="uq_sdek_webhook_events_event"),
+    )
+
+
+class NotificationOutbox(Base):
+    """
+    Очередь исходящих уведомлений. Обработчики запросов и планировщик только добавляют
+    строки в своей транзакции, отправку в Telegram выполняет воркер (app/notification_outbox.py).
+    """
+    __tablename__ = "notification_outbox"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    # "telegram" - сообщение в chat_id; "waiting_list" - уведомление сотруднику о листе ожидания
+    kind: Mapped[str] = mapped_column(String(50), nullable=False)
+    chat_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    user_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("users.id"), nullable=True)
+    waiting_list_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("waiting_list.id"), nullable=True)
+    text: Mapped[str] = mapped_column(Text, nullable=False)
+    # pending / sent / failed
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.now)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.now)
+    sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    # Задержка доставки: от постановки в очередь до успешной отправки
+    latency_ms: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    __table_args__ = (
+        sa.Index("ix_notification_outbox_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+
+
+class AccountBalance(Base):
+    """
+    Текущий баланс счета. Изменяется в той же транзакции, что и записи cash_flow
+    (app/balances.py), поэтому балансы читаются без SUM по всей истории операций.
+    """
+    __tablename__ = "account_balances"
+
+    account_id: Mapped[int] = mapped_column(Integer, ForeignKey("accounts.id"), primary_key=True)
+    balance: Mapped[Decimal] = mapped_column(Numeric, nullable=False, default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.now)
+
+
+class PhoneDefectReason(Base):
+    """
+    Причины брака телефона, записанные вместе с событием, которое их выявило
+    (инспекция, тест АКБ, возврат или обмен). Причина одного события - одна или
+    несколько строк с общим movement_log_id.
+    """
+    __tablename__ = "phone_defect_reasons"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    phone_id: Mapped[int] = mapped_column(Integer, ForeignKey("phones.id"), nullable=False)
+    movement_log_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("phone_movement_log.id"), nullable=True)
+    event_type: Mapped[PhoneEventType] = mapped_column(Enum(PhoneEventType, native_enum=False), nullable=False)
+    # "checklist" - не пройден пункт чек-листа (checklist_item_id); "battery_test", "customer_return",
+    # "exchange" - причина из соответствующего события; "log" - перенесено из текста старых логов
+    reason_code: Mapped[str] = mapped_column(String(50), nullable=False)
+    checklist_item_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("checklist_items.id"), nullable=True)
+    reason: Mapped[str] = mapped_column(Text, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.now)
+
+    movement_log: Mapped[Optional["PhoneMovementLog"]] = relationship("PhoneMovementLog")
+
+    __table_args__ = (
+        sa.Index("ix_phone_defect_reasons_phone_id_created_at", "phone_id", "created_at"),
+    )
@@ -0,0 +1,220 @@
+# app/notification_outbox.py
+"""
+Очередь исходящих уведомлений (outbox) и воркер, который ее разбирает.
+
+Обработчики запросов и планировщик вызывают enqueue_*: строка добавляется в
+notification_outbox в той же транзакции, что и само изменение, поэтому уведомление
+не теряется при сбое и не задерживает транзакцию сетевым запросом в Telegram.
+
+Воркер (run_outbox_worker, запускается при старте приложения):
+  * забирает готовые строки через SELECT ... FOR UPDATE SKIP LOCKED, поэтому
+    несколько процессов не отправят одно сообщение дважды;
+  * создает внутренние уведомления по листу ожидания;
+  * склеивает несколько сообщений в один чат в одно (до лимита Telegram);
+  * отправляет в каждый чат не чаще раза в OUTBOX_CHAT_INTERVAL_SECONDS;
+  * при ошибке повторяет с экспоненциальной задержкой, после OUTBOX_MAX_ATTEMPTS
+    помечает строку как failed;
+  * записывает задержку доставки в latency_ms.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .database import AsyncSessionLocal
+
+
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "5"))
+# Telegram ограничивает частоту сообщений в один чат
+OUTBOX_CHAT_INTERVAL_SECONDS = float(os.getenv("OUTBOX_CHAT_INTERVAL_SECONDS", "1"))
+
+TELEGRAM_SDEK_CHAT_ID = os.getenv("TELEGRAM_SDEK_CHAT_ID")
+TELEGRAM_MESSAGE_LIMIT = 4096
+_COALESCE_SEPARATOR = "\n\n"
+
+_wakeup = asyncio.Event()
+_last_sent_by_chat: Dict[str, float] = {}
+
+
+# --- Постановка в очередь ---
+
+def enqueue_telegram(db: AsyncSession, chat_id, text: str) -> None:
+    """Ставит сообщение в чат Telegram в очередь (в текущей транзакции, без commit)."""
+    db.add(models.NotificationOutbox(kind="telegram", chat_id=str(chat_id), text=text))
+    _wakeup.set()
+
+
+def enqueue_sdek_status_update(db: AsyncSession, message: str) -> None:
+    """Уведомление об изменении статуса СДЭК в служебный чат."""
+    if not TELEGRAM_SDEK_CHAT_ID:
+        print("Переменная TELEGRAM_SDEK_CHAT_ID не установлена. Уведомление не отправлено.")
+        return
+    enqueue_telegram(db, TELEGRAM_SDEK_CHAT_ID, message)
+
+
+def enqueue_waiting_list_notifications(db: AsyncSession, notifications: List[dict]) -> None:
+    """
+    Уведомления сотрудникам о поступлении моделей из листа ожидания: словари с user_id,
+    waiting_list_id и message. Воркер создаст по ним записи в notifications.
+    """
+    db.add_all([
+        models.NotificationOutbox(
+            kind="waiting_list", user_id=n["user_id"], waiting_list_id=n["waiting_list_id"], text=n["message"]
+        )
+        for n in notifications
+    ])
+    _wakeup.set()
+
+
+# --- Воркер ---
+
+def _retry_delay(attempts: int, retry_after: Optional[float] = None) -> timedelta:
+    if retry_after:
+        return timedelta(seconds=retry_after)
+    return timedelta(seconds=OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+
+
+def _coalesce(rows: List[models.NotificationOutbox]) -> List[models.NotificationOutbox]:
+    """Берет сообщения по порядку, пока склеенный текст помещается в одно сообщение Telegram."""
+    batch, length = [], 0
+    for row in rows:
+        added = len(row.text) + (len(_COALESCE_SEPARATOR) if batch else 0)
+        if batch and length + added > TELEGRAM_MESSAGE_LIMIT:
+            break
+        batch.append(row)
+        length += added
+    return batch
+
+
+def _materialize_waiting_list(db: AsyncSession, rows: List[models.NotificationOutbox], now: datetime) -> None:
+    """Создает внутренние уведомления по листу ожидания и закрывает строки очереди."""
+    for row in rows:
+        db.add(models.Notification(user_id=row.user_id, message=row.text[:512], waiting_list_id=row.waiting_list_id))
+        _mark_sent(row, now)
+
+
+def _mark_sent(row: models.NotificationOutbox, now: datetime) -> None:
+    row.status = "sent"
+    row.sent_at = now
+    row.latency_ms = int((now - row.created_at).total_seconds() * 1000)
+    row.last_error = None
+
+
+def _mark_failed_attempt(row: models.NotificationOutbox, now: datetime, error: Exception) -> None:
+    row.attempts += 1
+    row.last_error = str(error)[:1000]
+    if row.attempts >= OUTBOX_MAX_ATTEMPTS:
+        row.status = "failed"
+    else:
+        row.next_attempt_at = now + _retry_delay(row.attempts, getattr(error, "retry_after", None))
+
+
+async def process_outbox_batch() -> int:
+    """Один проход воркера. Возвращает число строк, отправленных или закрытых в этом проходе."""
+    from .bot import bot
+
+    processed = 0
+    async with AsyncSessionLocal() as db:
+        now = datetime.now()
+        rows = (await db.execute(
+            select(models.NotificationOutbox)
+            .where(models.NotificationOutbox.status == "pending", models.NotificationOutbox.next_attempt_at <= now)
+            .order_by(models.NotificationOutbox.id)
+            .limit(OUTBOX_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )).scalars().all()
+        if not rows:
+            return 0
+
+        waiting_rows = [row for row in rows if row.kind == "waiting_list"]
+        if waiting_rows:
+            _materialize_waiting_list(db, waiting_rows, now)
+            processed += len(waiting_rows)
+
+        by_chat: Dict[str, List[models.NotificationOutbox]] = {}
+        for row in rows:
+            if row.kind == "telegram" and row.status == "pending":
+                by_chat.setdefault(row.chat_id, []).append(row)
+
+        for chat_id, chat_rows in by_chat.items():
+            last_sent = _last_sent_by_chat.get(chat_id)
+            if last_sent is not None and time.monotonic() - last_sent < OUTBOX_CHAT_INTERVAL_SECONDS:
+                continue  # остальное уйдет следующим проходом
+
+            batch = _coalesce(chat_rows)
+            try:
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=_COALESCE_SEPARATOR.join(row.text for row in batch),
+                    parse_mode="HTML"
+                )
+            except Exception as e:
+                print(f"Ошибка при отправке уведомления в Telegram (чат {chat_id}): {e}")
+                for row in batch:
+                    _mark_failed_attempt(row, datetime.now(), e)
+                continue
+            finally:
+                _last_sent_by_chat[chat_id] = time.monotonic()
+
+            sent_at = datetime.now()
+            for row in batch:
+                _mark_sent(row, sent_at)
+            processed += len(batch)
+
+        await db.commit()
+    return processed
+
+
+async def run_outbox_worker() -> None:
+    """Бесконечный цикл воркера. Между проходами ждет OUTBOX_POLL_SECONDS или новую запись в очереди."""
+    while True:
+        try:
+            processed = await process_outbox_batch()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Воркер уведомлений: ошибка прохода: {e}")
+            processed = 0
+
+        if processed:
+            # Возможно, в очереди есть еще строки - следующий проход сразу
+            continue
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def get_outbox_stats(db: AsyncSession, hours: int = 24) -> dict:
+    """Размер очереди по статусам и задержка доставки за последние hours часов."""
+    counts = await db.execute(
+        select(models.NotificationOutbox.status, func.count(models.NotificationOutbox.id))
+        .group_by(models.NotificationOutbox.status)
+    )
+    since = datetime.now() - timedelta(hours=hours)
+    latency = (await db.execute(
+        select(
+            func.count(models.NotificationOutbox.id),
+            func.avg(models.NotificationOutbox.latency_ms),
+            func.percentile_cont(0.95).within_group(models.NotificationOutbox.latency_ms),
+            func.max(models.NotificationOutbox.latency_ms),
+        )
+        .where(models.NotificationOutbox.status == "sent", models.NotificationOutbox.sent_at >= since)
+    )).one()
+    return {
+        "by_status": {status: count for status, count in counts.all()},
+        "period_hours": hours,
+        "sent": latency[0],
+        "latency_ms_avg": round(float(latency[1]), 1) if latency[1] is not None else None,
+        "latency_ms_p95": round(float(latency[2]), 1) if latency[2] is not None else None,
+        "latency_ms_max": latency[3],
+    }
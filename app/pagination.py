@@ -0,0 +1,118 @@
+# app/pagination.py
+"""
+Keyset-пагинация (по курсору) для больших списков.
+
+Вместо OFFSET/LIMIT следующая страница выбирается условием по ключу сортировки
+последней показанной строки (WHERE id < :last_id ORDER BY id DESC LIMIT n) - запрос
+идет по индексу и не замедляется при пролистывании вглубь.
+
+Курсор непрозрачен для клиента: это base64 от JSON {"d": "next"|"prev", "k": [значения ключа]}.
+Общее количество строк считается отдельно и кэшируется в response_cache по тегам данных,
+поэтому COUNT(*) не выполняется на каждой странице.
+"""
+import base64
+import json
+import os
+from datetime import datetime
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .response_cache import response_cache
+
+
+PAGINATION_TOTAL_TTL_SECONDS = int(os.getenv("PAGINATION_TOTAL_TTL_SECONDS", "60"))
+
+NEXT = "next"
+PREV = "prev"
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    return value
+
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict) and "dt" in value:
+        return datetime.fromisoformat(value["dt"])
+    return value
+
+
+def encode_cursor(direction: str, key: Iterable[Any]) -> str:
+    payload = json.dumps({"d": direction, "k": [_encode_value(v) for v in key]}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, key_length: int) -> Tuple[str, list]:
+    """Разбирает курсор. Некорректный курсор - 400, а не 500."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        direction = payload["d"]
+        key = [_decode_value(v) for v in payload["k"]]
+        if direction not in (NEXT, PREV) or len(key) != key_length:
+            raise ValueError
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный курсор пагинации")
+    return direction, key
+
+
+async def keyset_page(
+    db: AsyncSession,
+    query,
+    limit: int,
+    cursor: Optional[str],
+    order_desc: list,
+    order_asc: list,
+    seek: Callable[[list, str], Any],
+    key_of: Callable[[Any], list],
+    key_length: int,
+    skip: int = 0,
+) -> dict:
+    """
+    Одна страница списка, отсортированного по убыванию ключа.
+    seek(key, direction) - условие "строки после key" (NEXT) или "строки перед key" (PREV);
+    key_of(row) - значения ключа строки для курсоров.
+    skip без курсора - прежний режим OFFSET (для старых клиентов); курсоры возвращаются и в нем.
+    Возвращает {"items", "next_cursor", "prev_cursor"}.
+    """
+    direction, key = (NEXT, None) if cursor is None else decode_cursor(cursor, key_length)
+    if key is not None:
+        query = query.where(seek(key, direction))
+
+    if direction == PREV:
+        # Идем назад по возрастанию ключа и разворачиваем страницу
+        rows = (await db.execute(query.order_by(*order_asc).limit(limit + 1))).scalars().all()
+        has_prev = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+        has_next = True
+    else:
+        query = query.order_by(*order_desc)
+        if key is None and skip:
+            query = query.offset(skip)
+        rows = (await db.execute(query.limit(limit + 1))).scalars().all()
+        has_next = len(rows) > limit
+        rows = list(rows[:limit])
+        has_prev = key is not None or skip > 0
+
+    return {
+        "items": rows,
+        "next_cursor": encode_cursor(NEXT, key_of(rows[-1])) if rows and has_next else None,
+        "prev_cursor": encode_cursor(PREV, key_of(rows[0])) if rows and has_prev else None,
+    }
+
+
+async def cached_total(db: AsyncSession, name: str, query, tags: Iterable[str], params: Optional[dict] = None) -> int:
+    """
+    COUNT(*) по запросу списка с кэшем в response_cache: сбрасывается доменными событиями
+    с тегами tags, в остальном значение может отставать не более чем на PAGINATION_TOTAL_TTL_SECONDS.
+    """
+    key = await response_cache.build_key(f"total:{name}", params or {}, "pagination", tags)
+
+    async def compute() -> int:
+        return (await db.execute(select(func.count()).select_from(query.subquery()))).scalar_one()
+
+    return await response_cache.get_or_compute(key, compute, PAGINATION_TOTAL_TTL_SECONDS)
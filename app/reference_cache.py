@@ -0,0 +1,287 @@
+# app/reference_cache.py
+"""
+Кэш справочников в памяти процесса.
+
+Справочники (категории операций, счета, магазины, источники трафика, память,
+цвета, пункты чек-листа, типы товаров, ставки зарплаты, модельные номера) маленькие и меняются редко, поэтому
+загружаются один раз при старте и отдаются без обращения к Postgres.
+Это те же таблицы, что выгружены в spravochniki_export.
+
+Каждая таблица имеет свою версию: запись в справочник вызывает invalidate(),
+версия увеличивается, и следующее чтение перезагружает таблицу из БД.
+invalidate() действует только в процессе, который выполнил запись; другие воркеры
+uvicorn и бот увидят изменения после истечения REFERENCE_CACHE_TTL_SECONDS.
+
+search() - поиск по началу и по фрагменту имени (автодополнение модельных номеров)
+по отсортированному массиву имен: префиксы находятся бинарным поиском (bisect).
+
+Отдельно хранится карта model_id -> полное название модели ("iPhone 13 128GB Синий"):
+списки телефонов берут название из нее и не подгружают model_name, storage и color
+для каждой строки. Карта сбрасывается вместе со справочниками памяти и цветов
+и через invalidate_model_display_names() при изменении моделей, живет не дольше
+REFERENCE_CACHE_TTL_SECONDS и перечитывается, если в ней нет запрошенной модели
+(модели добавляются в БД в обход API).
+"""
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+
+
+# Время жизни загруженного справочника (секунды): страховка от изменений,
+# сделанных другими процессами. 0 - перечитывать при каждом обращении.
+REFERENCE_CACHE_TTL_SECONDS = int(os.getenv("REFERENCE_CACHE_TTL_SECONDS", "60"))
+
+# Справочники, из которых собирается полное название модели
+MODEL_DISPLAY_DEPENDENCIES = ("storage", "colors")
+
+# имя справочника -> (модель, поле для поиска по имени, сортировка)
+REFERENCE_TABLES = {
+    "operation_categories": (models.OperationCategories, "name", models.OperationCategories.id),
+    "accounts": (models.Accounts, "name", models.Accounts.id),
+    "shops": (models.Shops, "name", models.Shops.id),
+    "traffic_sources": (models.TrafficSource, "name", models.TrafficSource.id),
+    "storage": (models.Storage, "storage", models.Storage.id),
+    "colors": (models.Colors, "color_name", models.Colors.id),
+    "checklist_items": (models.ChecklistItems, "name", models.ChecklistItems.display_order),
+    "product_types": (models.ProductType, "name", models.ProductType.id),
+    "payroll_tariffs": (models.PayrollTariff, "code", models.PayrollTariff.id),
+    "model_numbers": (models.ModelNumber, "name", models.ModelNumber.id),
+}
+
+
+def _name_key(value) -> Optional[str]:
+    # В части справочников имена дополнены пробелами (CHAR), поэтому сравниваем без них
+    if value is None:
+        return None
+    return str(value).strip().lower()
+
+
+def _snapshot(obj, model) -> SimpleNamespace:
+    """Копия значений колонок: не привязана к сессии и не может быть случайно изменена через ORM."""
+    return SimpleNamespace(**{attr.key: getattr(obj, attr.key) for attr in model.__mapper__.column_attrs})
+
+
+class NameSearchIndex:
+    """Отсортированный массив (имя в нижнем регистре, запись) для поиска по префиксу и фрагменту."""
+
+    def __init__(self, items: List[SimpleNamespace], name_field: str):
+        entries = [(_name_key(getattr(item, name_field, None)), item) for item in items]
+        entries = sorted((entry for entry in entries if entry[0]), key=lambda entry: (entry[0], entry[1].id))
+        self.keys = [key for key, _ in entries]
+        self.items = [item for _, item in entries]
+
+    def search(self, query: str, limit: int) -> List[SimpleNamespace]:
+        """Сначала точное совпадение и совпадения по началу (короткие выше), затем по фрагменту."""
+        query = _name_key(query)
+        if not query or limit <= 0:
+            return []
+        prefix_matches = []
+        position = bisect_left(self.keys, query)
+        while position < len(self.keys) and self.keys[position].startswith(query):
+            prefix_matches.append(position)
+            position += 1
+        prefix_matches.sort(key=lambda i: (len(self.keys[i]), self.keys[i]))
+        found = [self.items[i] for i in prefix_matches[:limit]]
+        if len(found) < limit:
+            substring_matches = sorted(
+                (key.find(query), len(key), i)
+                for i, key in enumerate(self.keys)
+                if not key.startswith(query) and query in key
+            )
+            found += [self.items[i] for _, _, i in substring_matches[:limit - len(found)]]
+        return found
+
+
+class ReferenceTable:
+    def __init__(self, items: List[SimpleNamespace], name_field: str, version: int):
+        self.items = items
+        self.version = version
+        self.expires_at = time.monotonic() + REFERENCE_CACHE_TTL_SECONDS
+        self.name_field = name_field
+        self.by_id: Dict[int, SimpleNamespace] = {item.id: item for item in items}
+        self.by_name: Dict[str, SimpleNamespace] = {}
+        for item in items:
+            key = _name_key(getattr(item, name_field, None))
+            if key is not None:
+                self.by_name.setdefault(key, item)
+        self._search_index: Optional[NameSearchIndex] = None
+
+    def is_fresh(self, version: int) -> bool:
+        return self.version == version and self.expires_at > time.monotonic()
+
+    @property
+    def search_index(self) -> NameSearchIndex:
+        # Строится при первом поиске; новая версия справочника - новый ReferenceTable и новый индекс
+        if self._search_index is None:
+            self._search_index = NameSearchIndex(self.items, self.name_field)
+        return self._search_index
+
+
+class ReferenceDataCache:
+    def __init__(self):
+        self._tables: Dict[str, ReferenceTable] = {}
+        self._versions: Dict[str, int] = {name: 0 for name in REFERENCE_TABLES}
+        self._lock = asyncio.Lock()
+        self._model_display: Optional[Dict[int, SimpleNamespace]] = None
+        self._model_display_version = 0
+        self._model_display_expires_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    async def _load_table(self, db: AsyncSession, name: str) -> ReferenceTable:
+        model, name_field, order_by = REFERENCE_TABLES[name]
+        version = self._versions[name]
+        result = await db.execute(select(model).order_by(order_by))
+        table = ReferenceTable([_snapshot(obj, model) for obj in result.scalars().all()], name_field, version)
+        # Если во время загрузки справочник изменили, не сохраняем устаревший снимок
+        if self._versions[name] == version:
+            self._tables[name] = table
+        return table
+
+    async def load(self, db: AsyncSession, names: Optional[List[str]] = None) -> None:
+        """Загружает (или перезагружает) справочники. Вызывается при старте приложения."""
+        async with self._lock:
+            for name in names or REFERENCE_TABLES:
+                await self._load_table(db, name)
+
+    async def _get_table(self, db: AsyncSession, name: str) -> ReferenceTable:
+        table = self._tables.get(name)
+        if table is not None and table.is_fresh(self._versions[name]):
+            self.hits += 1
+            return table
+        self.misses += 1
+        async with self._lock:
+            table = self._tables.get(name)
+            if table is not None and table.is_fresh(self._versions[name]):
+                return table
+            return await self._load_table(db, name)
+
+    async def all(self, db: AsyncSession, name: str) -> List[SimpleNamespace]:
+        return (await self._get_table(db, name)).items
+
+    async def get_by_id(self, db: AsyncSession, name: str, item_id: int) -> Optional[SimpleNamespace]:
+        return (await self._get_table(db, name)).by_id.get(item_id)
+
+    async def get_by_name(self, db: AsyncSession, name: str, value: str) -> Optional[SimpleNamespace]:
+        return (await self._get_table(db, name)).by_name.get(_name_key(value))
+
+    async def search(self, db: AsyncSession, name: str, query: str, limit: int = 10) -> List[SimpleNamespace]:
+        """Поиск записей справочника по началу или фрагменту имени без обращения к БД."""
+        return (await self._get_table(db, name)).search_index.search(query, limit)
+
+    def invalidate(self, name: Optional[str] = None) -> None:
+        """Сбрасывает справочник (или все справочники) после записи в него."""
+        for table_name in ([name] if name else list(REFERENCE_TABLES)):
+            self._versions[table_name] += 1
+            self._tables.pop(table_name, None)
+        if name is None or name in MODEL_DISPLAY_DEPENDENCIES:
+            self.invalidate_model_display_names()
+
+    # --- Полные названия моделей ---
+
+    async def _load_model_display_names(self, db: AsyncSession) -> Dict[int, SimpleNamespace]:
+        version = self._model_display_version
+        result = await db.execute(
+            select(
+                models.Models.id, models.Models.model_name_id, models.Models.storage_id,
+                models.Models.color_id, models.Models.image_url,
+                models.ModelName.name, models.Storage.storage, models.Colors.color_name,
+            )
+            .outerjoin(models.ModelName, models.Models.model_name_id == models.ModelName.id)
+            .outerjoin(models.Storage, models.Models.storage_id == models.Storage.id)
+            .outerjoin(models.Colors, models.Models.color_id == models.Colors.id)
+        )
+        display = {
+            row.id: SimpleNamespace(
+                id=row.id,
+                name=models.format_model_display_name(row.name, row.storage, row.color_name),
+                base_name=row.name,
+                model_name_id=row.model_name_id,
+                storage_id=row.storage_id,
+                color_id=row.color_id,
+                image_url=row.image_url,
+                # У модели заполнены все три части названия
+                complete=row.name is not None and row.storage is not None and row.color_name is not None,
+            )
+            for row in result.all()
+        }
+        if self._model_display_version == version:
+            self._model_display = display
+            self._model_display_expires_at = time.monotonic() + REFERENCE_CACHE_TTL_SECONDS
+        return display
+
+    def _fresh_model_display(self) -> Optional[Dict[int, SimpleNamespace]]:
+        if self._model_display is not None and self._model_display_expires_at > time.monotonic():
+            return self._model_display
+        return None
+
+    async def _get_model_display(self, db: AsyncSession) -> Dict[int, SimpleNamespace]:
+        display = self._fresh_model_display()
+        if display is not None:
+            self.hits += 1
+            return display
+        self.misses += 1
+        async with self._lock:
+            display = self._fresh_model_display()
+            if display is not None:
+                return display
+            return await self._load_model_display_names(db)
+
+    async def model_display_names(
+        self, db: AsyncSession, model_ids: Optional[Iterable[Optional[int]]] = None
+    ) -> Dict[int, SimpleNamespace]:
+        """
+        Карта model_id -> название и поля модели для ответов API.
+        model_ids - модели, которые будут искать в карте: если какой-то из них нет
+        (добавлена после загрузки), карта перечитывается один раз.
+        """
+        display = await self._get_model_display(db)
+        if model_ids is not None:
+            missing = {model_id for model_id in model_ids if model_id is not None} - display.keys()
+            if missing:
+                self.invalidate_model_display_names()
+                display = await self._get_model_display(db)
+        return display
+
+    async def model_names_for(self, db: AsyncSession, model_ids: Iterable[Optional[int]]) -> Dict[int, str]:
+        """
+        Полные названия указанных моделей (с перечитыванием карты при промахе, см.
+        model_display_names); не найденная и после этого модель получает название "модель #<id>".
+        """
+        model_ids = {model_id for model_id in model_ids if model_id is not None}
+        display = await self.model_display_names(db, model_ids)
+        return {
+            model_id: display[model_id].name if model_id in display else f"модель #{model_id}"
+            for model_id in model_ids
+        }
+
+    def invalidate_model_display_names(self) -> None:
+        self._model_display_version += 1
+        self._model_display = None
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "tables": {
+                name: {"version": self._versions[name], "loaded": name in self._tables,
+                       "size": len(self._tables[name].items) if name in self._tables else 0}
+                for name in REFERENCE_TABLES
+            },
+            "model_display_names": {
+                "version": self._model_display_version,
+                "loaded": self._model_display is not None,
+                "size": len(self._model_display) if self._model_display is not None else 0,
+            },
+        }
+
+
+reference_cache = ReferenceDataCache()
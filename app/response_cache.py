@@ -0,0 +1,184 @@
+# app/response_cache.py
+"""
+Кэш ответов тяжелых аналитических эндпоинтов.
+
+Ключ ответа: (эндпоинт, параметры запроса, область прав, версии тегов данных).
+Каждый эндпоинт зависит от набора тегов ("sales", "inventory", ...). Доменные события
+(продажа, отмена продажи, движение денег, приемка заказа и т.д.) увеличивают
+версии своих тегов - старые ключи перестают совпадать и вытесняются по TTL/LRU.
+
+Хранилище подключаемое: по умолчанию InMemoryCacheBackend (LRU + TTL в памяти процесса),
+для нескольких воркеров можно передать свою реализацию CacheBackend в configure_response_cache().
+"""
+import functools
+import os
+from abc import ABC, abstractmethod
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Optional
+
+
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "60"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+
+# Доменное событие -> теги данных, которые оно меняет
+DOMAIN_EVENTS = {
+    "sale_created": ("sales", "cash_flow", "inventory"),
+    "sale_cancelled": ("sales", "cash_flow", "inventory"),
+    "cash_flow_created": ("cash_flow",),
+    "supplier_order_received": ("inventory", "cash_flow"),
+    "phones_accepted_to_warehouse": ("inventory",),
+    "financial_snapshot_created": ("finance",),
+    # Дневные агрегаты пересчитываются в фоне после commit (app/rollups.py)
+    "rollups_refreshed": ("sales", "cash_flow"),
+}
+
+# Типы параметров, которые попадают в ключ (сессии БД, пользователи и т.п. пропускаются)
+_KEY_PARAM_TYPES = (str, int, float, bool, Decimal, date, datetime, type(None))
+
+MISSING = object()
+
+
+class CacheBackend(ABC):
+    """Интерфейс хранилища кэша ответов."""
+
+    @abstractmethod
+    async def get(self, key: str) -> Any:
+        """Возвращает значение или MISSING, если ключа нет."""
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl_seconds: int) -> None:
+        ...
+
+    @abstractmethod
+    async def get_version(self, tag: str) -> int:
+        ...
+
+    @abstractmethod
+    async def bump_version(self, tag: str) -> int:
+        ...
+
+    @abstractmethod
+    async def clear(self) -> None:
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+
+class InMemoryCacheBackend(CacheBackend):
+    """LRU-кэш с TTL в памяти процесса."""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self.evictions = 0
+
+    async def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return MISSING
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl_seconds: int) -> None:
+        self._entries[key] = (time.monotonic() + ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_version(self, tag: str) -> int:
+        return self._versions.get(tag, 0)
+
+    async def bump_version(self, tag: str) -> int:
+        self._versions[tag] = self._versions.get(tag, 0) + 1
+        return self._versions[tag]
+
+    async def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "evictions": self.evictions,
+            "versions": dict(self._versions),
+        }
+
+
+class ResponseCache:
+    def __init__(self, backend: CacheBackend, ttl_seconds: int = RESPONSE_CACHE_TTL_SECONDS):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+    async def build_key(self, endpoint: str, params: dict, scope: str, tags: Iterable[str]) -> str:
+        versions = [f"{tag}:{await self.backend.get_version(tag)}" for tag in sorted(tags)]
+        key_params = [f"{name}={params[name]!r}" for name in sorted(params)]
+        return "|".join([endpoint, scope, *key_params, *versions])
+
+    async def get_or_compute(self, key: str, compute, ttl_seconds: Optional[int] = None):
+        value = await self.backend.get(key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await compute()
+        await self.backend.set(key, value, ttl_seconds or self.ttl_seconds)
+        return value
+
+    async def publish(self, event_name: str) -> None:
+        """Доменное событие: сбрасывает закэшированные ответы, зависящие от его тегов."""
+        for tag in DOMAIN_EVENTS.get(event_name, ()):
+            await self.backend.bump_version(tag)
+
+    async def clear(self) -> None:
+        await self.backend.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "ttl_seconds": self.ttl_seconds, **self.backend.stats()}
+
+
+response_cache = ResponseCache(InMemoryCacheBackend())
+
+
+def configure_response_cache(backend: CacheBackend, ttl_seconds: Optional[int] = None) -> None:
+    """Подменяет хранилище кэша (например, на общее для нескольких воркеров или фейк в тестах)."""
+    response_cache.backend = backend
+    if ttl_seconds is not None:
+        response_cache.ttl_seconds = ttl_seconds
+
+
+async def publish_event(event_name: str) -> None:
+    await response_cache.publish(event_name)
+
+
+def cached_response(tags: Iterable[str], scope: str, ttl_seconds: Optional[int] = None):
+    """
+    Декоратор для GET-эндпоинтов: кэширует результат по параметрам запроса.
+    scope - право, которым защищен эндпоинт: ответы для разных прав не смешиваются.
+    Ставится под @app.get(...), сигнатура эндпоинта сохраняется для FastAPI.
+    """
+    tags = tuple(tags)
+
+    def decorator(endpoint):
+        endpoint_name = f"{endpoint.__module__}.{endpoint.__name__}"
+
+        @functools.wraps(endpoint)
+        async def wrapper(**kwargs):
+            params = {name: value for name, value in kwargs.items() if isinstance(value, _KEY_PARAM_TYPES)}
+            key = await response_cache.build_key(endpoint_name, params, scope, tags)
+            return await response_cache.get_or_compute(key, lambda: endpoint(**kwargs), ttl_seconds)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,277 @@
+# app/rollups.py
+"""
+Дневные агрегаты продаж и движения денег для аналитики.
+
+Таблицы daily_sales_rollup, daily_model_sales_rollup и daily_cash_flow_rollup
+хранят итоги по дням, поэтому отчеты за любой период читают сотни строк вместо
+всей истории продаж.
+
+Поддержка:
+  * при flush сессии запоминаются дни, затронутые изменениями Sales, SaleDetails,
+    SalePayments и CashFlow; после commit эти дни пересчитываются целиком
+    в отдельной фоновой сессии;
+  * изменения в обход ORM (bulk update/insert) подхватывает ночная сверка
+    reconcile_daily_rollups, которая пересчитывает последние ROLLUP_RECONCILE_DAYS дней.
+"""
+import asyncio
+import os
+from datetime import date, datetime, timedelta
+from itertools import chain
+from typing import Iterable, Optional, Set
+
+from sqlalchemy import delete, event, func, insert, inspect as sa_inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import AsyncSessionLocal
+from .response_cache import publish_event
+
+
+ROLLUP_RECONCILE_DAYS = int(os.getenv("ROLLUP_RECONCILE_DAYS", "90"))
+
+# Ключ advisory-блокировки: пересчеты агрегатов выполняются строго по одному
+_ROLLUP_LOCK_KEY = 730_001
+
+_DAYS_KEY = "_rollup_days"
+_SALE_IDS_KEY = "_rollup_sale_ids"
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+_pending_tasks: Set[asyncio.Task] = set()
+
+
+# --- Пересчет ---
+
+def _day_range_filter(column, start_day: date, end_day_exclusive: date):
+    return (column >= start_day, column < end_day_exclusive)
+
+
+async def _rebuild_range(db: AsyncSession, start_day: date, end_day_exclusive: date) -> None:
+    """Удаляет и заново строит агрегаты за дни [start_day, end_day_exclusive)."""
+    sale_day = func.date(models.Sales.sale_date)
+    sales_in_range = select(models.Sales.id).where(*_day_range_filter(models.Sales.sale_date, start_day, end_day_exclusive))
+
+    for rollup in (models.DailySalesRollup, models.DailyModelSalesRollup, models.DailyCashFlowRollup):
+        await db.execute(delete(rollup).where(*_day_range_filter(rollup.day, start_day, end_day_exclusive)))
+
+    # 1. Продажи по сотрудникам и источникам трафика
+    profit_by_sale = (
+        select(models.SaleDetails.sale_id, func.sum(models.SaleDetails.profit).label("profit"))
+        .where(models.SaleDetails.sale_id.in_(sales_in_range))
+        .group_by(models.SaleDetails.sale_id)
+        .subquery()
+    )
+    card_by_sale = (
+        select(models.SalePayments.sale_id, func.sum(models.SalePayments.amount).label("amount"))
+        .where(
+            models.SalePayments.sale_id.in_(sales_in_range),
+            models.SalePayments.payment_method == models.EnumPayment.КАРТА
+        )
+        .group_by(models.SalePayments.sale_id)
+        .subquery()
+    )
+    sales_select = (
+        select(
+            sale_day,
+            models.Sales.user_id,
+            models.Customers.source_id,
+            func.count(models.Sales.id),
+            func.coalesce(func.sum(models.Sales.total_amount), 0),
+            func.coalesce(func.sum(profit_by_sale.c.profit), 0),
+            func.coalesce(func.sum(card_by_sale.c.amount), 0),
+        )
+        .select_from(models.Sales)
+        .outerjoin(models.Customers, models.Sales.customer_id == models.Customers.id)
+        .outerjoin(profit_by_sale, profit_by_sale.c.sale_id == models.Sales.id)
+        .outerjoin(card_by_sale, card_by_sale.c.sale_id == models.Sales.id)
+        .where(*_day_range_filter(models.Sales.sale_date, start_day, end_day_exclusive))
+        .group_by(sale_day, models.Sales.user_id, models.Customers.source_id)
+    )
+    await db.execute(
+        insert(models.DailySalesRollup).from_select(
+            ["day", "user_id", "source_id", "sales_count", "revenue", "profit", "card_revenue"], sales_select
+        )
+    )
+
+    # 2. Продажи телефонов по названию модели
+    is_priced = models.SaleDetails.unit_price > 0
+    has_purchase = is_priced & models.Phones.purchase_price.is_not(None)
+    model_select = (
+        select(
+            sale_day,
+            models.Models.model_name_id,
+            func.coalesce(func.sum(models.SaleDetails.quantity), 0),
+            func.coalesce(func.sum(models.SaleDetails.unit_price * models.SaleDetails.quantity), 0),
+            func.count(models.SaleDetails.id).filter(is_priced),
+            func.coalesce(func.sum(models.SaleDetails.unit_price).filter(is_priced), 0),
+            func.count(models.SaleDetails.id).filter(has_purchase),
+            func.coalesce(func.sum(models.Phones.purchase_price).filter(has_purchase), 0),
+        )
+        .select_from(models.SaleDetails)
+        .join(models.Sales, models.SaleDetails.sale_id == models.Sales.id)
+        .join(models.Warehouse, models.SaleDetails.warehouse_id == models.Warehouse.id)
+        .join(models.Phones, models.Warehouse.product_id == models.Phones.id)
+        .join(models.Models, models.Phones.model_id == models.Models.id)
+        .where(
+            models.Warehouse.product_type_id == 1,
+            models.Models.model_name_id.is_not(None),
+            *_day_range_filter(models.Sales.sale_date, start_day, end_day_exclusive)
+        )
+        .group_by(sale_day, models.Models.model_name_id)
+    )
+    await db.execute(
+        insert(models.DailyModelSalesRollup).from_select(
+            ["day", "model_name_id", "units", "revenue", "priced_lines", "priced_sum", "purchase_lines", "purchase_sum"],
+            model_select
+        )
+    )
+
+    # 3. Движение денег по счетам и категориям
+    cash_day = func.date(models.CashFlow.date)
+    cash_select = (
+        select(
+            cash_day,
+            models.CashFlow.account_id,
+            models.CashFlow.operation_categories_id,
+            func.count(models.CashFlow.id),
+            func.coalesce(func.sum(models.CashFlow.amount), 0),
+        )
+        .where(*_day_range_filter(models.CashFlow.date, start_day, end_day_exclusive))
+        .group_by(cash_day, models.CashFlow.account_id, models.CashFlow.operation_categories_id)
+    )
+    await db.execute(
+        insert(models.DailyCashFlowRollup).from_select(
+            ["day", "account_id", "operation_categories_id", "operations_count", "amount"], cash_select
+        )
+    )
+
+
+async def _lock_rollups(db: AsyncSession) -> None:
+    await db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _ROLLUP_LOCK_KEY})
+
+
+async def refresh_daily_rollups(db: AsyncSession, days: Iterable[date]) -> None:
+    """Пересчитывает агрегаты за указанные дни в текущей транзакции (без commit)."""
+    days = sorted(set(days))
+    if not days:
+        return
+    await _lock_rollups(db)
+    for day in days:
+        await _rebuild_range(db, day, day + timedelta(days=1))
+
+
+async def rebuild_daily_rollups(db: AsyncSession, start_day: Optional[date] = None, end_day: Optional[date] = None) -> None:
+    """
+    Полностью пересобирает агрегаты за период (включительно).
+    Без границ - за всю историю продаж и движения денег.
+    """
+    if start_day is None or end_day is None:
+        bounds = (await db.execute(
+            select(func.min(func.date(models.Sales.sale_date)), func.max(func.date(models.Sales.sale_date)))
+        )).one()
+        cash_bounds = (await db.execute(
+            select(func.min(func.date(models.CashFlow.date)), func.max(func.date(models.CashFlow.date)))
+        )).one()
+        known_days = [d for d in (*bounds, *cash_bounds) if d is not None]
+        if not known_days:
+            return
+        start_day = start_day or min(known_days)
+        end_day = end_day or max(known_days)
+
+    await _lock_rollups(db)
+    await _rebuild_range(db, start_day, end_day + timedelta(days=1))
+
+
+async def reconcile_daily_rollups(db: AsyncSession, days_back: int = ROLLUP_RECONCILE_DAYS) -> None:
+    """Ночная сверка: пересобирает агрегаты за последние days_back дней и фиксирует транзакцию."""
+    today = date.today()
+    await rebuild_daily_rollups(db, today - timedelta(days=days_back), today)
+    await db.commit()
+    await publish_event("rollups_refreshed")
+
+
+async def _refresh_after_commit(days: Set[date], sale_ids: Set[int]) -> None:
+    try:
+        async with AsyncSessionLocal() as session:
+            if sale_ids:
+                sale_days = await session.execute(
+                    select(func.date(models.Sales.sale_date)).where(models.Sales.id.in_(sale_ids)).distinct()
+                )
+                days |= {d for d in sale_days.scalars().all() if d is not None}
+            await refresh_daily_rollups(session, days)
+            await session.commit()
+        await publish_event("rollups_refreshed")
+    except Exception as e:
+        # Агрегаты догонит ночная сверка, основную операцию не ломаем
+        print(f"Ошибка пересчета дневных агрегатов за {sorted(days)}: {e}")
+
+
+async def wait_pending() -> None:
+    """Дожидается фоновых пересчетов, запущенных после commit (скрипты - перед удалением данных и выходом)."""
+    while _pending_tasks:
+        await asyncio.gather(*list(_pending_tasks), return_exceptions=True)
+
+
+# --- Отслеживание затронутых дней ---
+
+def _as_day(value) -> Optional[date]:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return None
+
+
+def _attribute_days(obj, key: str) -> Set[date]:
+    """Старое и новое значение даты объекта. Не вызывает ленивую загрузку."""
+    history = sa_inspect(obj).attrs[key].history
+    values = chain(history.added or (), history.unchanged or (), history.deleted or ())
+    return {d for d in map(_as_day, values) if d is not None}
+
+
+def _attribute_value(obj, key: str):
+    return sa_inspect(obj).dict.get(key)
+
+
+@event.listens_for(Session, "before_flush")
+def _collect_rollup_changes(session, flush_context, instances):
+    days = session.info.setdefault(_DAYS_KEY, set())
+    sale_ids = session.info.setdefault(_SALE_IDS_KEY, set())
+
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, models.Sales):
+            days |= _attribute_days(obj, "sale_date")
+            if obj in session.dirty and _attribute_value(obj, "id") is not None:
+                sale_ids.add(obj.id)
+        elif isinstance(obj, models.CashFlow):
+            days |= _attribute_days(obj, "date")
+        elif isinstance(obj, (models.SaleDetails, models.SalePayments)):
+            sale_id = _attribute_value(obj, "sale_id")
+            sale = _attribute_value(obj, "sale")
+            if sale_id is not None:
+                sale_ids.add(sale_id)
+            elif sale is not None:
+                days |= _attribute_days(sale, "sale_date")
+
+
+@event.listens_for(Session, "after_commit")
+def _schedule_rollup_refresh(session):
+    days = session.info.pop(_DAYS_KEY, None) or set()
+    sale_ids = session.info.pop(_SALE_IDS_KEY, None) or set()
+    if not days and not sale_ids:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Синхронный код вне event loop (скрипты) - дни подхватит ночная сверка
+        return
+    task = loop.create_task(_refresh_after_commit(set(days), set(sale_ids)))
+    _pending_tasks.add(task)
+    task.add_done_callback(_pending_tasks.discard)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rollup_changes(session):
+    session.info.pop(_DAYS_KEY, None)
+    session.info.pop(_SALE_IDS_KEY, None)
+
@@ -655,6 +655,19 @@ class PhoneHistoryResponse(Phone): # Наследуем от основной с
     movement_logs: List[PhoneMovementLog] = []
     repairs: List[Repair] = []
 
+class PhoneSearchResult(BaseModel):
+    id: int
+    serial_number: Optional[str] = None
+    model_name: Optional[str] = None
+    model_number: Optional[str] = None
+    technical_status: Optional[str] = None
+    commercial_status: Optional[str] = None
+    storage_location: Optional[str] = None
+    shop_name: Optional[str] = None
+    # serial_exact / serial_prefix / serial_contains / serial_fuzzy / model_number / model_name
+    match: str
+    score: float
+
 class RefundRequest(BaseModel):
     account_id: int # ID счета, с которого возвращаются деньги
     notes: Optional[str] = None
@@ -764,6 +777,18 @@ class PayrollPaymentCreate(BaseModel):
     account_id: int
     notes: Optional[str] = None
 
+class PayrollTariff(BaseModel):
+    id: int
+    code: str
+    name: Optional[str] = None
+    rate: Decimal
+    class Config:
+        from_attributes = True
+
+class PayrollTariffUpdate(BaseModel):
+    rate: Decimal
+    name: Optional[str] = None
+
 class FinancialSnapshotSchema(BaseModel):
     id: int
     snapshot_date: datetime
@@ -990,11 +1015,15 @@ class ModelNumberCreate(BaseModel):
 
 class PaginatedPhonesResponse(BaseModel):
     items: List[Phone]
-    total: int
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
 
 class PaginatedCashFlowResponse(BaseModel):
     items: List[CashFlow]
-    total: int
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
 
 class DividendCalculation(BaseModel):
     id: int
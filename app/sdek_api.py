@@ -1,28 +1,261 @@
 # app/sdek_api.py
+import asyncio
 import httpx
 import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
 from fastapi import HTTPException
 import json
 
-SDEK_API_URL = "https://api.cdek.ru/v2" # Тестовый контур
+# Адрес API можно переопределить (например, на локальный мок-сервер СДЭК)
+SDEK_API_URL = os.getenv("SDEK_API_URL", "https://api.cdek.ru/v2")
 CLIENT_ID = os.getenv("SDEK_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SDEK_CLIENT_SECRET")
 
-async def get_sdek_token():
-    """Получает токен авторизации СДЭК."""
-    auth_url = f"{SDEK_API_URL}/oauth/token"
-    payload = {
-        "grant_type": "client_credentials",
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-    }
-    async with httpx.AsyncClient() as client:
+# --- Настройки HTTP-клиента ---
+SDEK_TIMEOUT_SECONDS = float(os.getenv("SDEK_TIMEOUT_SECONDS", "20"))
+SDEK_MAX_CONNECTIONS = int(os.getenv("SDEK_MAX_CONNECTIONS", "10"))
+# Сколько запросов статусов выполняется одновременно при плановой проверке
+SDEK_STATUS_CONCURRENCY = int(os.getenv("SDEK_STATUS_CONCURRENCY", "5"))
+SDEK_MAX_RETRIES = int(os.getenv("SDEK_MAX_RETRIES", "3"))
+SDEK_RETRY_BACKOFF_SECONDS = float(os.getenv("SDEK_RETRY_BACKOFF_SECONDS", "0.5"))
+# За сколько секунд до истечения токена запрашивать новый
+SDEK_TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("SDEK_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+
+# --- Кэш расчетов стоимости доставки ---
+SDEK_TARIFF_CACHE_TTL_SECONDS = int(os.getenv("SDEK_TARIFF_CACHE_TTL_SECONDS", "3600"))
+SDEK_TARIFF_CACHE_MAX_ENTRIES = int(os.getenv("SDEK_TARIFF_CACHE_MAX_ENTRIES", "256"))
+
+_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Коды статусов из вебхука ORDER_STATUS -> названия, которые отдает /orders/{uuid} в statuses[].name
+SDEK_STATUS_NAMES = {
+    "CREATED": "Создан",
+    "ACCEPTED": "Принят",
+    "INVALID": "Некорректный заказ",
+    "RECEIVED_AT_SHIPMENT_WAREHOUSE": "Принят на склад отправителя",
+    "READY_FOR_SHIPMENT_IN_SENDER_CITY": "Выдан на отправку в г. отправителе",
+    "RETURNED_TO_SENDER_CITY_WAREHOUSE": "Возвращен на склад отправителя",
+    "TAKEN_BY_TRANSPORTER_FROM_SENDER_CITY": "Сдан перевозчику в г. отправителе",
+    "SENT_TO_TRANSIT_CITY": "Отправлен в г. транзит",
+    "ACCEPTED_IN_TRANSIT_CITY": "Встречен в г. транзите",
+    "ACCEPTED_AT_TRANSIT_WAREHOUSE": "Принят на склад транзита",
+    "RETURNED_TO_TRANSIT_WAREHOUSE": "Возвращен на склад транзита",
+    "READY_FOR_SHIPMENT_IN_TRANSIT_CITY": "Выдан на отправку в г. транзите",
+    "TAKEN_BY_TRANSPORTER_FROM_TRANSIT_CITY": "Сдан перевозчику в г. транзите",
+    "SENT_TO_RECIPIENT_CITY": "Отправлен в г. получателя",
+    "ACCEPTED_IN_RECIPIENT_CITY": "Встречен в г. получателе",
+    "ACCEPTED_AT_RECIPIENT_CITY_WAREHOUSE": "Принят на склад доставки",
+    "ACCEPTED_AT_PICK_UP_POINT": "Принят на склад до востребования",
+    "TAKEN_BY_COURIER": "Выдан на доставку",
+    "RETURNED_TO_RECIPIENT_CITY_WAREHOUSE": "Возвращен на склад доставки",
+    "DELIVERED": "Вручен",
+    "NOT_DELIVERED": "Не вручен",
+}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Общий долгоживущий клиент: пул соединений и keep-alive вместо нового TLS-рукопожатия на каждый запрос."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=SDEK_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=SDEK_MAX_CONNECTIONS, max_keepalive_connections=SDEK_MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def close_client():
+    """Закрывает общий клиент (при остановке приложения)."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _request(method: str, url: str, retry: bool = True, **kwargs) -> httpx.Response:
+    """
+    Запрос к СДЭК через общий клиент. Для безопасных к повтору запросов (retry=True)
+    сетевые ошибки и ответы 429/5xx повторяются с экспоненциальной задержкой.
+    Возвращает ответ после raise_for_status().
+    """
+    attempts = SDEK_MAX_RETRIES if retry else 1
+    for attempt in range(1, attempts + 1):
         try:
-            response = await client.post(auth_url, data=payload)
+            response = await get_client().request(method, url, **kwargs)
+            if response.status_code in _RETRY_STATUS_CODES and attempt < attempts:
+                raise httpx.HTTPStatusError("retryable status", request=response.request, response=response)
             response.raise_for_status()
-            return response.json()["access_token"]
+            return response
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            retryable = isinstance(e, httpx.TransportError) or e.response.status_code in _RETRY_STATUS_CODES
+            if not retryable or attempt >= attempts:
+                raise
+            await asyncio.sleep(SDEK_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+
+class SdekTokenManager:
+    """
+    Кэш OAuth-токена СДЭК на процесс. Токен обновляется заранее, за
+    SDEK_TOKEN_REFRESH_MARGIN_SECONDS до истечения expires_in; одновременные
+    вызовы ждут одно общее обновление под блокировкой.
+    """
+
+    def __init__(self, refresh_margin_seconds: int = SDEK_TOKEN_REFRESH_MARGIN_SECONDS):
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self.refreshes = 0
+
+    def _is_fresh(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires_at - self.refresh_margin_seconds
+
+    async def _fetch(self) -> str:
+        auth_url = f"{SDEK_API_URL}/oauth/token"
+        payload = {
+            "grant_type": "client_credentials",
+            "client_id": CLIENT_ID,
+            "client_secret": CLIENT_SECRET,
+        }
+        try:
+            response = await _request("POST", auth_url, data=payload)
         except httpx.HTTPStatusError as e:
             raise HTTPException(status_code=500, detail=f"SDEK Auth Error: {e.response.text}")
+        data = response.json()
+        self._token = data["access_token"]
+        self._expires_at = time.monotonic() + int(data.get("expires_in", 3600))
+        self.refreshes += 1
+        return self._token
+
+    async def get_token(self) -> str:
+        if self._is_fresh():
+            return self._token
+        async with self._lock:
+            if self._is_fresh():
+                return self._token
+            return await self._fetch()
+
+    async def refresh(self, rejected_token: Optional[str] = None) -> str:
+        """Обновляет токен после 401. Если другой вызов уже обновил его, новый запрос не делается."""
+        async with self._lock:
+            if self._is_fresh() and self._token != rejected_token:
+                return self._token
+            return await self._fetch()
+
+    def invalidate(self) -> None:
+        self._token = None
+        self._expires_at = 0.0
+
+
+token_manager = SdekTokenManager()
+
+
+async def get_sdek_token():
+    """Получает токен авторизации СДЭК (из кэша, пока он не истек)."""
+    return await token_manager.get_token()
+
+
+async def _authorized_request(method: str, url: str, token: str, retry: bool = True, **kwargs) -> httpx.Response:
+    """
+    Запрос с токеном. При 401 токен принудительно обновляется и запрос повторяется один раз:
+    отклоненный авторизацией запрос СДЭК не выполнял, поэтому повтор безопасен и для создания заказов.
+    """
+    headers = dict(kwargs.pop("headers", None) or {})
+    headers["Authorization"] = f"Bearer {token}"
+    try:
+        return await _request(method, url, retry=retry, headers=headers, **kwargs)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 401:
+            raise
+    headers["Authorization"] = f"Bearer {await token_manager.refresh(token)}"
+    return await _request(method, url, retry=retry, headers=headers, **kwargs)
+
+
+def _tariff_cache_key(calculator_payload: dict) -> str:
+    """Ключ расчета: адрес без лишних пробелов и регистра, остальные поля как есть."""
+    normalized = json.loads(json.dumps(calculator_payload))
+    address = normalized["from_location"].get("address") or ""
+    normalized["from_location"]["address"] = " ".join(str(address).split()).lower()
+    return json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+
+
+class TariffCache:
+    """
+    Кэш ответов калькулятора СДЭК (LRU + TTL). Одинаковые расчеты, запущенные
+    одновременно, выполняются одним запросом к СДЭК (single-flight).
+    Ошибки не кэшируются.
+    """
+
+    def __init__(self, ttl_seconds: int = SDEK_TARIFF_CACHE_TTL_SECONDS, max_entries: int = SDEK_TARIFF_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def _get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key: str, value) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _calculate_and_store(self, key: str, calculate):
+        try:
+            value = await calculate()
+            self._set(key, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    async def get_or_calculate(self, key: str, calculate):
+        value = self._get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._calculate_and_store(key, calculate))
+            self._inflight[key] = task
+        # shield: отмена одного клиента не отменяет общий запрос для остальных
+        return await asyncio.shield(task)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared_inflight": self.shared,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+
+tariff_cache = TariffCache()
+
 
 async def calculate_sdek_delivery_cost(calculation_data: dict, token: str):
     """Рассчитывает стоимость доставки СДЭК."""
@@ -46,14 +279,16 @@ async def calculate_sdek_delivery_cost(calculation_data: dict, token: str):
         }]
     }
     
-    async with httpx.AsyncClient() as client:
+    async def calculate():
         try:
-            response = await client.post(calculator_url, headers=headers, json=calculator_payload, timeout=20.0)
-            response.raise_for_status()
+            # Расчет тарифа ничего не создает, поэтому его можно безопасно повторять
+            response = await _authorized_request("POST", calculator_url, token, headers=headers, json=calculator_payload)
             return response.json()
         except httpx.HTTPStatusError as e:
             raise HTTPException(status_code=400, detail=f"SDEK Calculator Error: {e.response.text}")
 
+    return await tariff_cache.get_or_calculate(_tariff_cache_key(calculator_payload), calculate)
+
 
 async def create_sdek_delivery_order(order_data: dict, token: str):
     """Создает заказ на доставку в СДЭК."""
@@ -106,18 +341,17 @@ async def create_sdek_delivery_order(order_data: dict, token: str):
     print(json.dumps(sdek_payload, indent=2, ensure_ascii=False))
     print("="*50 + "\n")
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(order_url, headers=headers, json=sdek_payload, timeout=20.0)
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            print("\n" + "!"*50)
-            print("--- ОШИБКА ОТ СДЭК ---")
-            print(f"Статус код: {e.response.status_code}")
-            print(f"Ответ: {e.response.text}")
-            print("!"*50 + "\n")
-            raise HTTPException(status_code=400, detail=f"Ошибка от API СДЭК: {e.response.text}")
+    try:
+        # Создание заказа не повторяем: повтор после таймаута может создать дубликат
+        response = await _authorized_request("POST", order_url, token, retry=False, headers=headers, json=sdek_payload)
+        return response.json()
+    except httpx.HTTPStatusError as e:
+        print("\n" + "!"*50)
+        print("--- ОШИБКА ОТ СДЭК ---")
+        print(f"Статус код: {e.response.status_code}")
+        print(f"Ответ: {e.response.text}")
+        print("!"*50 + "\n")
+        raise HTTPException(status_code=400, detail=f"Ошибка от API СДЭК: {e.response.text}")
 
 async def create_sdek_return_order(shipment_details: dict, token: str):
     """СОЗДАЕТ ЗАКАЗ В СДЭК ДЛЯ ВОЗВРАТА ПОСТАВЩИКУ."""
@@ -168,26 +402,42 @@ async def create_sdek_return_order(shipment_details: dict, token: str):
         }]
     }
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(order_url, headers=headers, json=sdek_payload, timeout=20.0)
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=400, detail=f"Ошибка от API СДЭК: {e.response.text}")
+    try:
+        response = await _authorized_request("POST", order_url, token, retry=False, headers=headers, json=sdek_payload)
+        return response.json()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=400, detail=f"Ошибка от API СДЭК: {e.response.text}")
     
 
 async def get_sdek_order_info(uuid: str, token: str):
     """Получает информацию о заказе по его UUID."""
     info_url = f"{SDEK_API_URL}/orders/{uuid}"
     headers = {"Authorization": f"Bearer {token}"}
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(info_url, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            # Не бросаем ошибку, а возвращаем None, чтобы планировщик не останавливался
-            print(f"SDEK Info Error for UUID {uuid}: {e.response.text}")
-            return None
+    try:
+        response = await _authorized_request("GET", info_url, token, headers=headers)
+        return response.json()
+    except httpx.HTTPStatusError as e:
+        # Не бросаем ошибку, а возвращаем None, чтобы планировщик не останавливался
+        print(f"SDEK Info Error for UUID {uuid}: {e.response.text}")
+        return None
+
+
+
+async def get_sdek_orders_info(uuids: List[str], token: str) -> Dict[str, Optional[dict]]:
+    """
+    Получает информацию по нескольким заказам параллельно (не более SDEK_STATUS_CONCURRENCY
+    запросов одновременно). Для заказов, которые не удалось получить, значение None.
+    """
+    semaphore = asyncio.Semaphore(SDEK_STATUS_CONCURRENCY)
+
+    async def fetch(uuid: str) -> Optional[dict]:
+        async with semaphore:
+            try:
+                return await get_sdek_order_info(uuid, token)
+            except httpx.HTTPError as e:
+                print(f"SDEK Info Error for UUID {uuid}: {e!r}")
+                return None
 
+    unique_uuids = list(dict.fromkeys(uuids))
+    results = await asyncio.gather(*(fetch(uuid) for uuid in unique_uuids))
+    return dict(zip(unique_uuids, results))
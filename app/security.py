@@ -1,8 +1,10 @@
 # app/security.py
 
 import os
+import time
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Dict, FrozenSet, Optional, Tuple
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
@@ -31,6 +33,126 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # Схема аутентификации
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/v1/auth/token")
 
+# Время жизни записи в кэше прав (секунды). 0 - кэш выключен.
+PERMISSION_CACHE_TTL_SECONDS = int(os.getenv("PERMISSION_CACHE_TTL_SECONDS", "60"))
+
+# Режим "stateless": роль и коды прав кладутся прямо в access token,
+# и проверка прав не обращается ни к кэшу, ни к БД.
+# Устаревание прав ограничено сроком жизни токена (ACCESS_TOKEN_EXPIRE_MINUTES).
+EMBED_PERMISSIONS_IN_TOKEN = os.getenv("EMBED_PERMISSIONS_IN_TOKEN", "false").lower() in ("1", "true", "yes")
+
+# Версия прав. Токены с другой версией не используются для stateless-проверки.
+# Увеличьте PERMISSION_VERSION в окружении после массового изменения прав ролей.
+_permission_version = int(os.getenv("PERMISSION_VERSION", "1"))
+
+
+# --- Кэш прав пользователей ---
+
+@dataclass(frozen=True)
+class Principal:
+    """Неизменяемый "слепок" пользователя, достаточный для проверки прав."""
+    id: int
+    username: str
+    active: bool
+    role_id: Optional[int]
+    permissions: FrozenSet[str]
+    # Отображаемое имя (для приветствий бота); в Principal из claims токена не передается
+    name: Optional[str] = None
+
+
+class PrincipalCache:
+    """
+    In-process кэш Principal по username с TTL и явной инвалидацией.
+    Избавляет проверки прав от повторной загрузки пользователя, роли и прав из БД.
+    """
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[str, Tuple[float, Principal]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username: str) -> Optional[Principal]:
+        entry = self._entries.get(username)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, principal = entry
+        if expires_at <= time.monotonic():
+            self._entries.pop(username, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return principal
+
+    def set(self, principal: Principal) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        self._entries[principal.username] = (time.monotonic() + self.ttl_seconds, principal)
+
+    def invalidate(self, username: str) -> None:
+        self._entries.pop(username, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+principal_cache = PrincipalCache(PERMISSION_CACHE_TTL_SECONDS)
+
+# username -> момент инвалидации. Токены, выпущенные раньше, не проходят stateless-проверку.
+_revoked_principals: Dict[str, float] = {}
+
+
+def get_permission_version() -> int:
+    return _permission_version
+
+
+def invalidate_principal(username: str) -> None:
+    """Сбрасывает кэш прав конкретного пользователя (создание/удаление/изменение)."""
+    principal_cache.invalidate(username)
+    _revoked_principals[username] = time.time()
+
+
+def invalidate_all_principals() -> None:
+    """Полностью сбрасывает кэш прав (например, после изменения прав роли)."""
+    global _permission_version
+    principal_cache.clear()
+    _revoked_principals.clear()
+    # Все ранее выпущенные токены с правами в этом процессе становятся "устаревшими"
+    _permission_version += 1
+
+
+def _get_user_permission_codes(user: models.Users) -> FrozenSet[str]:
+    """Собирает коды прав пользователя из загруженных связей роли."""
+    if not user.role or not hasattr(user.role, 'role_permissions'):
+        return frozenset()
+    return frozenset(
+        rp.permission.code
+        for rp in user.role.role_permissions if rp.permission
+    )
+
+
+def principal_from_user(user: models.Users) -> Principal:
+    """Строит Principal из ORM-объекта пользователя с загруженной ролью и правами."""
+    return Principal(
+        id=user.id,
+        username=user.username,
+        active=bool(user.active),
+        role_id=user.role_id,
+        permissions=_get_user_permission_codes(user),
+        name=user.name,
+    )
+
 
 # --- Функции ---
 
@@ -45,28 +167,68 @@ def get_password_hash(password: str) -> str:
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Создает JWT токен."""
     to_encode = data.copy()
+    now = datetime.now(timezone.utc)
     if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
+        expire = now + expires_delta
     else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+        expire = now + timedelta(minutes=15)
+    to_encode.update({"exp": expire, "iat": now})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
-    credentials_exception = HTTPException(
+def build_access_token_claims(user: models.Users) -> dict:
+    """
+    Формирует данные для access token.
+    В режиме EMBED_PERMISSIONS_IN_TOKEN добавляет id пользователя, роль, коды прав и версию прав.
+    Пользователь должен быть загружен вместе с ролью и правами (crud.get_user_by_username).
+    """
+    claims = {"sub": user.username}
+    if EMBED_PERMISSIONS_IN_TOKEN:
+        claims.update({
+            "uid": user.id,
+            "act": bool(user.active),
+            "rid": user.role_id,
+            "perms": sorted(_get_user_permission_codes(user)),
+            "pv": get_permission_version(),
+        })
+    return claims
+
+def _principal_from_claims(payload: dict) -> Optional[Principal]:
+    """Восстанавливает Principal из claims токена, если им можно доверять без обращения к БД."""
+    if not EMBED_PERMISSIONS_IN_TOKEN or "perms" not in payload or "uid" not in payload:
+        return None
+    if payload.get("pv") != get_permission_version():
+        return None
+    revoked_at = _revoked_principals.get(payload["sub"])
+    if revoked_at is not None and payload.get("iat", 0) <= revoked_at:
+        return None
+    return Principal(
+        id=payload["uid"],
+        username=payload["sub"],
+        active=bool(payload.get("act", True)),
+        role_id=payload.get("rid"),
+        permissions=frozenset(payload["perms"]),
+    )
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _decode_access_token(token: str) -> dict:
+    """Декодирует access token; без "sub" токен считается невалидным."""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(username=username)
     except JWTError:
-        raise credentials_exception
+        raise _credentials_exception()
+    if payload.get("sub") is None:
+        raise _credentials_exception()
+    return payload
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    token_data = schemas.TokenData(username=_decode_access_token(token)["sub"])
     
     # Загружаем пользователя вместе с его ролью и всеми правами этой роли
     user = await crud.get_user_by_username(
@@ -75,7 +237,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
     )
     
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
+
+    # Пользователь уже загружен - заодно обновляем кэш прав
+    principal_cache.set(principal_from_user(user))
     return user
 
 async def get_current_active_user(current_user: models.Users = Depends(get_current_user)):
@@ -83,65 +248,74 @@ async def get_current_active_user(current_user: models.Users = Depends(get_curre
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
+async def get_current_principal(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> Principal:
+    """
+    Возвращает Principal текущего пользователя.
+    Сначала пробует claims токена (stateless-режим), затем кэш, и только потом БД.
+    """
+    payload = _decode_access_token(token)
+
+    principal = _principal_from_claims(payload)
+    if principal is not None:
+        return principal
+
+    token_data = schemas.TokenData(username=payload["sub"])
+    principal = principal_cache.get(token_data.username)
+    if principal is not None:
+        return principal
+
+    user = await crud.get_user_by_username(db, username=token_data.username)
+    if user is None:
+        raise _credentials_exception()
+
+    principal = principal_from_user(user)
+    principal_cache.set(principal)
+    return principal
+
+async def get_current_active_principal(principal: Principal = Depends(get_current_principal)) -> Principal:
+    if not principal.active:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    return principal
+
 def require_permission(permission_code: str):
     """
     Фабрика зависимостей, которая проверяет, есть ли у пользователя нужное право.
     """
-    # --- НАЧАЛО ИЗМЕНЕНИЙ ---
-    async def _check_permission(user: models.Users = Depends(get_current_active_user)):
-        # Теперь user - это объект модели SQLAlchemy, а не Pydantic-схема.
-        # Мы должны обращаться к его реальным атрибутам из models.py
-
-        if not user.role or not hasattr(user.role, 'role_permissions'):
+    async def _check_permission(principal: Principal = Depends(get_current_active_principal)):
+        # Права берутся из кэшированного Principal, без повторной загрузки роли из БД
+        if principal.role_id is None:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Not enough permissions (role is not configured)"
             )
 
-        # Извлекаем коды прав из правильного, вложенного атрибута
-        user_permissions = {
-            rp.permission.code
-            for rp in user.role.role_permissions if rp.permission
-        }
-
-        if permission_code not in user_permissions:
+        if permission_code not in principal.permissions:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail=f"Required permission '{permission_code}' is missing"
             )
-    # --- КОНЕЦ ИЗМЕНЕНИЙ ---
 
     return _check_permission
 
-def user_has_permission(user: models.Users, permission_code: str) -> bool:
-    """Проверяет, есть ли у пользователя указанное право."""
-    if not user.role or not hasattr(user.role, 'role_permissions'):
-        return False
-
-    user_permissions = {
-        rp.permission.code
-        for rp in user.role.role_permissions if rp.permission
-    }
-    return permission_code in user_permissions
+def user_has_permission(user, permission_code: str) -> bool:
+    """Проверяет, есть ли у пользователя (ORM-объект или Principal) указанное право."""
+    if isinstance(user, Principal):
+        return permission_code in user.permissions
+    return permission_code in _get_user_permission_codes(user)
 
 def require_any_permission(*permission_codes: str):
     """
     Фабрика зависимостей, которая проверяет, есть ли у пользователя ХОТЯ БЫ ОДНО из нужных прав.
     """
-    async def _check_any_permission(user: models.Users = Depends(get_current_active_user)):
-        if not user.role or not hasattr(user.role, 'role_permissions'):
+    async def _check_any_permission(principal: Principal = Depends(get_current_active_principal)):
+        if principal.role_id is None:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Not enough permissions (role is not configured)"
             )
 
-        user_permissions = {
-            rp.permission.code
-            for rp in user.role.role_permissions if rp.permission
-        }
-        
         # Проверяем, есть ли пересечение между правами пользователя и требуемыми правами
-        if not user_permissions.intersection(permission_codes):
+        if not principal.permissions.intersection(permission_codes):
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail=f"Required any of permissions: {', '.join(permission_codes)}"
@@ -0,0 +1,155 @@
+# benchmark_payroll.py
+# Сравнение старого (по запросу на каждого сотрудника) и нового (сгруппированные запросы)
+# расчета зарплатного отчета на сгенерированных данных.
+#   python benchmark_payroll.py --employees 200 --days 365
+# Все тестовые данные создаются в одной транзакции и откатываются в конце.
+import argparse
+import asyncio
+import random
+import time as time_module
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import func, insert, select  # noqa: E402
+from sqlalchemy.orm import selectinload  # noqa: E402
+
+from app import crud, models  # noqa: E402
+from app.database import AsyncSessionLocal  # noqa: E402
+
+
+async def legacy_payroll_report(db, start_date: date, end_date: date):
+    """Прежняя реализация get_payroll_report: шесть запросов на каждого сотрудника."""
+    users_result = await db.execute(
+        select(models.Users).options(selectinload(models.Users.role))
+        .join(models.Users.role)
+        .filter(models.Roles.role_name.in_(crud.PAYROLL_ROLES))
+    )
+    users = users_result.scalars().all()
+    report = []
+    end_date_inclusive = end_date + timedelta(days=1)
+
+    for user in users:
+        earned_salary = Decimal(0)
+        inspections_count = (await db.execute(select(func.count(models.DeviceInspection.id)).filter(models.DeviceInspection.user_id == user.id, models.DeviceInspection.inspection_date >= start_date, models.DeviceInspection.inspection_date < end_date_inclusive))).scalar_one()
+        battery_tests_count = (await db.execute(select(func.count(models.BatteryTest.id)).join(models.DeviceInspection).filter(models.DeviceInspection.user_id == user.id, models.DeviceInspection.inspection_date >= start_date, models.DeviceInspection.inspection_date < end_date_inclusive))).scalar_one()
+        packaging_count = (await db.execute(select(func.count(models.PhoneMovementLog.id)).filter(models.PhoneMovementLog.user_id == user.id, models.PhoneMovementLog.details == models.PACKAGING_LOG_DETAILS, models.PhoneMovementLog.timestamp >= start_date, models.PhoneMovementLog.timestamp < end_date_inclusive))).scalar_one()
+        earned_salary += inspections_count * Decimal(150) + battery_tests_count * Decimal(50) + packaging_count * Decimal(100)
+
+        shifts_count = (await db.execute(select(func.count(func.distinct(func.date(models.EmployeeShifts.shift_start)))).filter(models.EmployeeShifts.user_id == user.id, models.EmployeeShifts.shift_start >= start_date, models.EmployeeShifts.shift_start < end_date_inclusive))).scalar_one()
+        phones_sold_count = (await db.execute(select(func.sum(models.SaleDetails.quantity)).join(models.Sales).join(models.Warehouse).filter(models.Sales.user_id == user.id, models.Warehouse.product_type_id == 1, models.Sales.sale_date >= start_date, models.Sales.sale_date < end_date_inclusive))).scalar_one() or 0
+        earned_salary += shifts_count * Decimal(2000) + phones_sold_count * Decimal(500)
+
+        paid_amount = (await db.execute(
+            select(func.sum(models.Payroll.amount))
+            .filter(models.Payroll.user_id == user.id)
+            .filter(models.Payroll.payment_date >= start_date, models.Payroll.payment_date < end_date_inclusive)
+        )).scalar_one() or Decimal(0)
+
+        if earned_salary > 0 or paid_amount > 0:
+            report.append({"user_id": user.id, "total_earned": earned_salary, "total_paid": paid_amount})
+    return report
+
+
+async def generate_dataset(db, employees: int, days: int, start_date: date):
+    """Создает сотрудников и их активность за период. Возвращает число созданных строк."""
+    roles = (await db.execute(select(models.Roles).filter(models.Roles.role_name.in_(crud.PAYROLL_ROLES)))).scalars().all()
+    if not roles:
+        raise SystemExit("В БД нет ролей из зарплатного отчета - загрузите справочники.")
+    phone_id = (await db.execute(select(models.Phones.id).limit(1))).scalar()
+    warehouse_id = (await db.execute(select(models.Warehouse.id).filter(models.Warehouse.product_type_id == 1).limit(1))).scalar()
+    account_id = (await db.execute(select(models.Accounts.id).limit(1))).scalar()
+
+    user_ids = (await db.scalars(insert(models.Users).returning(models.Users.id), [
+        {"username": f"bench_payroll_{i}", "role_id": random.choice(roles).id, "active": True, "name": f"Сотрудник {i}"}
+        for i in range(employees)
+    ])).all()
+
+    rows = len(user_ids)
+    for user_id in user_ids:
+        shifts, inspections, packaging, sales, payroll = [], [], [], [], []
+        for day in range(days):
+            moment = datetime.combine(start_date + timedelta(days=day), datetime.min.time()) + timedelta(hours=10)
+            if random.random() < 0.6:
+                shifts.append({"user_id": user_id, "shift_start": moment, "shift_end": moment + timedelta(hours=9)})
+            for _ in range(random.randint(0, 3)):
+                inspections.append({"user_id": user_id, "inspection_date": moment, "phone_id": phone_id})
+            if phone_id:
+                for _ in range(random.randint(0, 2)):
+                    packaging.append({"user_id": user_id, "phone_id": phone_id, "timestamp": moment,
+                                      "event_type": models.PhoneEventType.ИНСПЕКЦИЯ_ПРОЙДЕНА,
+                                      "details": models.PACKAGING_LOG_DETAILS})
+            if warehouse_id and random.random() < 0.3:
+                sales.append({"user_id": user_id, "sale_date": moment, "total_amount": Decimal(10000), "currency_id": 1})
+            if account_id and day % 30 == 0:
+                payroll.append({"user_id": user_id, "payment_date": moment, "amount": Decimal(30000), "account_id": account_id})
+
+        if shifts:
+            await db.execute(insert(models.EmployeeShifts), shifts)
+        if inspections:
+            inspection_ids = (await db.scalars(insert(models.DeviceInspection).returning(models.DeviceInspection.id), inspections)).all()
+            battery = [{"device_inspection_id": i} for i in inspection_ids if random.random() < 0.5]
+            if battery:
+                await db.execute(insert(models.BatteryTest), battery)
+            rows += len(battery)
+        if packaging:
+            await db.execute(insert(models.PhoneMovementLog), packaging)
+        if sales:
+            sale_ids = (await db.scalars(insert(models.Sales).returning(models.Sales.id), sales)).all()
+            await db.execute(insert(models.SaleDetails), [
+                {"sale_id": sale_id, "warehouse_id": warehouse_id, "quantity": 1, "unit_price": Decimal(10000)}
+                for sale_id in sale_ids
+            ])
+            rows += len(sale_ids)
+        if payroll:
+            await db.execute(insert(models.Payroll), payroll)
+        rows += len(shifts) + len(inspections) + len(packaging) + len(sales) + len(payroll)
+    return rows
+
+
+async def timed(coro_factory, repeat: int):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time_module.perf_counter()
+        result = await coro_factory()
+        elapsed = time_module.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+async def main(employees: int, days: int, repeat: int):
+    end_date = date.today()
+    start_date = end_date - timedelta(days=days)
+
+    async with AsyncSessionLocal() as session:
+        print(f"Генерируем данные: {employees} сотрудников, {days} дней...")
+        rows = await generate_dataset(session, employees, days, start_date)
+        await session.flush()
+        print(f"Создано строк: {rows}")
+
+        legacy_time, legacy = await timed(lambda: legacy_payroll_report(session, start_date, end_date), repeat)
+        new_time, new = await timed(lambda: crud.get_payroll_report(session, start_date, end_date), repeat)
+
+        legacy_totals = {r["user_id"]: (r["total_earned"], r["total_paid"]) for r in legacy}
+        new_totals = {r["user_id"]: (r["total_earned"], r["total_paid"]) for r in new}
+
+        print(f"Старый расчет: {legacy_time * 1000:.1f} ms")
+        print(f"Новый расчет:  {new_time * 1000:.1f} ms  (x{legacy_time / new_time:.1f})")
+        if legacy_totals == new_totals:
+            print("✅ Итоги совпадают.")
+        else:
+            print("❌ Итоги отличаются (проверьте, не менялись ли ставки в payroll_tariffs).")
+
+        await session.rollback()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк зарплатного отчета")
+    parser.add_argument("--employees", type=int, default=100)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.employees, args.days, args.repeat))
@@ -0,0 +1,114 @@
+# benchmark_phone_search.py
+# Замер поиска телефонов (crud.search_phones) на синтетических данных.
+#   python benchmark_phone_search.py --phones 100000 --runs 200
+# Телефоны вставляются внутри внешней транзакции и в конце откатываются.
+# Нужны миграции с триграммными индексами (alembic upgrade head).
+import argparse
+import asyncio
+import random
+import statistics
+import string
+import time as time_module
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import insert, select, text  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession  # noqa: E402
+
+from app import crud, models  # noqa: E402
+from app.database import engine  # noqa: E402
+
+SERIAL_ALPHABET = string.ascii_uppercase + string.digits
+TARGET_MS = 10.0
+
+
+def random_serial(rng: random.Random) -> str:
+    return "".join(rng.choices(SERIAL_ALPHABET, k=12))
+
+
+def typo(value: str, rng: random.Random) -> str:
+    position = rng.randrange(len(value))
+    return value[:position] + rng.choice(SERIAL_ALPHABET) + value[position + 1:]
+
+
+async def create_phones(db: AsyncSession, count: int, rng: random.Random):
+    model_ids = (await db.execute(select(models.Models.id))).scalars().all()
+    if not model_ids:
+        raise SystemExit("В БД нет моделей - загрузите справочники.")
+    model_number_ids = (await db.scalars(insert(models.ModelNumber).returning(models.ModelNumber.id), [
+        {"name": f"M{rng.randrange(1000, 9999)}LL/A"} for _ in range(200)
+    ])).all()
+
+    serials = [random_serial(rng) for _ in range(count)]
+    statuses = [models.CommerceStatus.НА_СКЛАДЕ, models.CommerceStatus.ПРОДАН, models.CommerceStatus.НЕ_ГОТОВ_К_ПРОДАЖЕ]
+    for start in range(0, count, 5000):
+        await db.execute(insert(models.Phones), [
+            {
+                "serial_number": serial,
+                "model_id": rng.choice(model_ids),
+                "model_number_id": rng.choice(model_number_ids),
+                "commercial_status": rng.choice(statuses),
+                "technical_status": models.TechStatus.УПАКОВАН,
+            }
+            for serial in serials[start:start + 5000]
+        ])
+    await db.execute(text("ANALYZE phones"))
+    await db.execute(text("ANALYZE model_number"))
+    return serials
+
+
+def build_queries(serials, rng: random.Random, runs: int):
+    kinds = {
+        "точный": lambda s: s,
+        "префикс": lambda s: s[:5],
+        "фрагмент": lambda s: s[4:9],
+        "опечатка": lambda s: typo(s, rng),
+    }
+    return {name: [make(rng.choice(serials)) for _ in range(runs)] for name, make in kinds.items()}
+
+
+async def main(phones: int, runs: int, seed: int):
+    rng = random.Random(seed)
+    async with engine.connect() as conn:
+        outer = await conn.begin()
+        db = AsyncSession(bind=conn, join_transaction_mode="create_savepoint", expire_on_commit=False)
+        try:
+            print(f"Создаем {phones} синтетических телефонов...")
+            serials = await create_phones(db, phones, rng)
+            queries = build_queries(serials, rng, runs)
+
+            await crud.search_phones(db, serials[0])  # прогрев кэша названий моделей и соединения
+            results = {}
+            for name, values in queries.items():
+                timings = []
+                for value in values:
+                    started = time_module.perf_counter()
+                    await crud.search_phones(db, value)
+                    timings.append((time_module.perf_counter() - started) * 1000)
+                results[name] = timings
+        finally:
+            await db.close()
+            await outer.rollback()
+    await engine.dispose()
+
+    slowest_p95 = 0.0
+    for name, timings in results.items():
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        slowest_p95 = max(slowest_p95, p95)
+        print(f"{name:10} median {statistics.median(timings):6.2f} ms, p95 {p95:6.2f} ms, max {timings[-1]:6.2f} ms")
+    if slowest_p95 < TARGET_MS:
+        print(f"✅ p95 всех видов поиска меньше {TARGET_MS:.0f} ms.")
+    else:
+        print(f"❌ p95 {slowest_p95:.2f} ms - больше {TARGET_MS:.0f} ms.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска телефонов")
+    parser.add_argument("--phones", type=int, default=100_000)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    asyncio.run(main(args.phones, args.runs, args.seed))
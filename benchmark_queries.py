@@ -0,0 +1,163 @@
+# benchmark_queries.py
+# Замер планов и времени выполнения "горячих" запросов склада и аналитики через EXPLAIN ANALYZE.
+#
+# Порядок замера до/после индексов на данных из data_dump_inserts.sql:
+#   psql "$DB" -f data_dump_inserts.sql
+#   alembic downgrade fa6eb3733ff5   && python benchmark_queries.py --output before.json
+#   alembic upgrade head             && python benchmark_queries.py --output after.json
+#   python benchmark_queries.py --compare before.json after.json
+import argparse
+import asyncio
+import json
+from datetime import date, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import text  # noqa: E402
+
+from app.database import engine  # noqa: E402
+from app.models import PACKAGING_LOG_DETAILS  # noqa: E402
+
+
+# Запросы повторяют фильтры соответствующих функций из crud.py
+QUERIES = {
+    "stock_grouped": """
+        SELECT p.model_id, count(p.id), array_agg(mn.name)
+        FROM phones p
+        JOIN phone_current_location l ON l.phone_id = p.id
+        LEFT JOIN model_number mn ON mn.id = p.model_number_id
+        WHERE p.commercial_status = 'НА_СКЛАДЕ' AND l.storage_location != 'ПОДМЕННЫЙ_ФОНД'
+          AND p.model_id IS NOT NULL
+        GROUP BY p.model_id
+    """,
+    "stock_detailed": """
+        SELECT p.*, l.storage_location
+        FROM phones p
+        JOIN phone_current_location l ON l.phone_id = p.id
+        WHERE p.commercial_status IN ('НА_СКЛАДЕ', 'ПОДМЕННЫЙ_ФОНД')
+        ORDER BY p.id DESC
+    """,
+    "phones_for_inspection": """
+        SELECT * FROM phones WHERE technical_status = 'ОЖИДАЕТ_ПРОВЕРКУ'
+    """,
+    "phone_by_serial": """
+        SELECT * FROM phones WHERE lower(serial_number) = lower(:serial_number)
+    """,
+    "phone_movement_log": """
+        SELECT * FROM phone_movement_log WHERE phone_id = :phone_id ORDER BY timestamp DESC
+    """,
+    "latest_warehouse_for_phone": """
+        SELECT * FROM warehouse WHERE product_type_id = 1 AND product_id = :phone_id ORDER BY id DESC LIMIT 1
+    """,
+    "sale_detail_by_warehouse": """
+        SELECT * FROM sale_details WHERE warehouse_id = :warehouse_id
+    """,
+    "ready_for_stock_packaging_logs": """
+        SELECT phone_id, max(timestamp) FROM phone_movement_log
+        WHERE details = :packaging_details
+        GROUP BY phone_id
+    """,
+    "payroll_packaging_count": """
+        SELECT user_id, count(*) FROM phone_movement_log
+        WHERE details = :packaging_details AND timestamp >= :start_date AND timestamp < :end_date
+        GROUP BY user_id
+    """,
+    "sales_for_period": """
+        SELECT s.id, sum(sd.unit_price * sd.quantity)
+        FROM sales s JOIN sale_details sd ON sd.sale_id = s.id
+        WHERE s.sale_date >= :start_date AND s.sale_date < :end_date
+        GROUP BY s.id
+    """,
+    "sales_by_user_for_period": """
+        SELECT * FROM sales WHERE user_id = :user_id AND sale_date >= :start_date AND sale_date < :end_date
+    """,
+    "cash_flow_by_day": """
+        SELECT date_trunc('day', date), sum(amount) FROM cash_flow
+        WHERE date >= :start_date AND date < :end_date
+        GROUP BY 1 ORDER BY 1
+    """,
+    "cash_flows_by_account": """
+        SELECT * FROM cash_flow WHERE account_id = :account_id ORDER BY date DESC LIMIT 100
+    """,
+    "inspections_by_user": """
+        SELECT count(*) FROM device_inspection
+        WHERE user_id = :user_id AND inspection_date >= :start_date AND inspection_date < :end_date
+    """,
+}
+
+
+async def _sample_params(conn) -> dict:
+    """Берет реальные значения из БД, чтобы планы строились на существующих данных."""
+    async def scalar(sql, default):
+        value = (await conn.execute(text(sql))).scalar()
+        return value if value is not None else default
+
+    end_date = date.today() + timedelta(days=1)
+    return {
+        "serial_number": await scalar("SELECT serial_number FROM phones WHERE serial_number IS NOT NULL ORDER BY id DESC LIMIT 1", ""),
+        "phone_id": await scalar("SELECT id FROM phones ORDER BY id DESC LIMIT 1", 0),
+        "warehouse_id": await scalar("SELECT warehouse_id FROM sale_details ORDER BY id DESC LIMIT 1", 0),
+        "user_id": await scalar("SELECT user_id FROM sales WHERE user_id IS NOT NULL ORDER BY id DESC LIMIT 1", 0),
+        "account_id": await scalar("SELECT account_id FROM cash_flow WHERE account_id IS NOT NULL ORDER BY id DESC LIMIT 1", 0),
+        "packaging_details": PACKAGING_LOG_DETAILS,
+        "start_date": end_date - timedelta(days=31),
+        "end_date": end_date,
+    }
+
+
+async def run_benchmark(repeat: int) -> dict:
+    results = {}
+    async with engine.connect() as conn:
+        params = await _sample_params(conn)
+        for name, sql in QUERIES.items():
+            bind_names = {key for key in params if f":{key}" in sql}
+            query_params = {key: params[key] for key in bind_names}
+            timings = []
+            plan = None
+            for _ in range(repeat):
+                explain = text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql)
+                raw = (await conn.execute(explain, query_params)).scalar()
+                plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]
+                timings.append(plan["Execution Time"])
+            results[name] = {
+                "execution_ms": round(min(timings), 3),
+                "planning_ms": round(plan["Planning Time"], 3),
+                "top_node": plan["Plan"]["Node Type"],
+                "plan": plan["Plan"],
+            }
+            print(f"{name:32} {results[name]['execution_ms']:>10.3f} ms   {results[name]['top_node']}")
+    await engine.dispose()
+    return results
+
+
+def compare(before_path: str, after_path: str):
+    with open(before_path, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(after_path, encoding="utf-8") as f:
+        after = json.load(f)
+
+    print(f"{'запрос':32} {'до, ms':>10} {'после, ms':>10} {'ускорение':>10}")
+    for name in QUERIES:
+        if name not in before or name not in after:
+            continue
+        b, a = before[name]["execution_ms"], after[name]["execution_ms"]
+        speedup = f"x{b / a:.1f}" if a else "-"
+        print(f"{name:32} {b:>10.3f} {a:>10.3f} {speedup:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EXPLAIN ANALYZE для горячих запросов")
+    parser.add_argument("--repeat", type=int, default=3, help="число прогонов каждого запроса (берется минимум)")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="сравнить два JSON с результатами")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        benchmark_results = asyncio.run(run_benchmark(args.repeat))
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(benchmark_results, f, ensure_ascii=False, indent=2)
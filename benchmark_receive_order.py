@@ -0,0 +1,168 @@
+# benchmark_receive_order.py
+# Сравнение старой (ORM-объект на каждую единицу) и новой (пакетные INSERT) приемки заказа поставщика.
+#   python benchmark_receive_order.py --units 1000
+# Оба прогона идут внутри внешней транзакции: commit внутри crud фиксирует только SAVEPOINT,
+# в конце все откатывается.
+import argparse
+import asyncio
+import time as time_module
+from datetime import datetime
+from decimal import Decimal
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import event, insert, select  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession  # noqa: E402
+from sqlalchemy.orm import joinedload, selectinload  # noqa: E402
+
+from app import crud, models  # noqa: E402
+from app.database import engine  # noqa: E402
+
+
+async def legacy_receive_supplier_order(db, order_id: int, returned_phone_ids, user_id: int):
+    """Прежняя реализация receive_supplier_order: ORM-объект и INSERT на каждую единицу."""
+    result = await db.execute(
+        select(models.SupplierOrders).options(
+            selectinload(models.SupplierOrders.supplier_order_details).options(
+                joinedload(models.SupplierOrderDetails.accessory),
+                joinedload(models.SupplierOrderDetails.model)
+            ),
+            selectinload(models.SupplierOrders.supplier)
+        ).filter(models.SupplierOrders.id == order_id)
+    )
+    order = result.scalars().unique().one_or_none()
+    order.status = models.StatusDelivery.ПОЛУЧЕН
+    order.delivery_payment_status = models.OrderPaymentStatus.НЕ_ОПЛАЧЕН
+
+    new_phones = []
+    for detail in order.supplier_order_details:
+        if detail.model_id:
+            for _ in range(detail.quantity):
+                new_phones.append(models.Phones(
+                    model_id=detail.model_id,
+                    supplier_order_id=order.id,
+                    purchase_price=detail.price,
+                    technical_status=models.TechStatus.ОЖИДАЕТ_ПРОВЕРКУ,
+                    commercial_status=models.CommerceStatus.НЕ_ГОТОВ_К_ПРОДАЖЕ,
+                    condition=models.PhoneCondition.REFURBISHED,
+                    added_date=datetime.now().date()
+                ))
+    db.add_all(new_phones)
+    await db.flush()
+
+    supplier_name = order.supplier.name if order.supplier else "Неизвестно"
+    db.add_all([
+        models.PhoneMovementLog(
+            phone_id=phone.id,
+            user_id=user_id,
+            event_type=models.PhoneEventType.ПОСТУПЛЕНИЕ_ОТ_ПОСТАВЩИКА,
+            details=f"Заказ №{order.id}. Поставщик: {supplier_name}. Цена: {phone.purchase_price} руб."
+        )
+        for phone in new_phones
+    ])
+
+    if returned_phone_ids:
+        returned_phones = (await db.execute(
+            select(models.Phones).filter(models.Phones.id.in_(returned_phone_ids))
+        )).scalars().all()
+        for phone in returned_phones:
+            if phone.commercial_status == models.CommerceStatus.ОТПРАВЛЕН_ПОСТАВЩИКУ:
+                phone.technical_status = models.TechStatus.ОЖИДАЕТ_ПРОВЕРКУ
+                phone.commercial_status = models.CommerceStatus.НЕ_ГОТОВ_К_ПРОДАЖЕ
+                db.add(models.PhoneMovementLog(
+                    phone_id=phone.id, user_id=user_id,
+                    event_type=models.PhoneEventType.ПОЛУЧЕН_ОТ_ПОСТАВЩИКА,
+                    details=f"Получен от поставщика вместе с заказом №{order.id}. Направлен на повторную инспекцию."
+                ))
+
+    await db.commit()
+    await db.refresh(order)
+    return order
+
+
+async def create_order(db, units: int, details: int, returned: int):
+    """Создает заказ на units телефонов (разбитых на details позиций) и returned телефонов, отправленных поставщику."""
+    model_id = (await db.execute(select(models.Models.id).limit(1))).scalar()
+    user_id = (await db.execute(select(models.Users.id).limit(1))).scalar()
+    if model_id is None or user_id is None:
+        raise SystemExit("В БД нет моделей или пользователей - загрузите справочники.")
+
+    supplier_id = (await db.scalars(insert(models.Supplier).returning(models.Supplier.id), [
+        {"name": "Бенчмарк-поставщик", "contact_info": "-"}
+    ])).one()
+    order_id = (await db.scalars(insert(models.SupplierOrders).returning(models.SupplierOrders.id), [
+        {"supplier_id": supplier_id, "order_date": datetime.now(), "status": models.StatusDelivery.ЗАКАЗ}
+    ])).one()
+
+    per_detail, rest = divmod(units, details)
+    await db.execute(insert(models.SupplierOrderDetails), [
+        {"supplier_order_id": order_id, "model_id": model_id, "quantity": per_detail + (1 if i < rest else 0),
+         "price": Decimal(10000 + i)}
+        for i in range(details)
+    ])
+    returned_ids = []
+    if returned:
+        returned_ids = (await db.scalars(insert(models.Phones).returning(models.Phones.id), [
+            {"model_id": model_id, "commercial_status": models.CommerceStatus.ОТПРАВЛЕН_ПОСТАВЩИКУ,
+             "technical_status": models.TechStatus.БРАК}
+            for _ in range(returned)
+        ])).all()
+    return order_id, returned_ids, user_id
+
+
+async def measure(db, receive, units, details, returned):
+    order_id, returned_ids, user_id = await create_order(db, units, details, returned)
+    await db.commit()
+
+    queries = 0
+
+    def count_query(*args):
+        nonlocal queries
+        queries += 1
+
+    event.listen(engine.sync_engine, "before_cursor_execute", count_query)
+    started = time_module.perf_counter()
+    try:
+        await receive(db, order_id, returned_ids, user_id)
+    finally:
+        elapsed = time_module.perf_counter() - started
+        event.remove(engine.sync_engine, "before_cursor_execute", count_query)
+
+    phones = (await db.execute(
+        select(models.Phones.id).filter(models.Phones.supplier_order_id == order_id)
+    )).scalars().all()
+    return elapsed, queries, len(phones)
+
+
+async def main(units: int, details: int, returned: int):
+    async with engine.connect() as conn:
+        outer = await conn.begin()
+        db = AsyncSession(bind=conn, join_transaction_mode="create_savepoint", expire_on_commit=False)
+        try:
+            legacy_time, legacy_queries, legacy_phones = await measure(
+                db, legacy_receive_supplier_order, units, details, returned)
+            new_time, new_queries, new_phones = await measure(
+                db, crud.receive_supplier_order, units, details, returned)
+        finally:
+            await db.close()
+            await outer.rollback()
+    await engine.dispose()
+
+    print(f"Заказ: {units} телефонов в {details} позициях, возвратов: {returned}")
+    print(f"Старая приемка: {legacy_time * 1000:8.1f} ms, запросов: {legacy_queries}")
+    print(f"Новая приемка:  {new_time * 1000:8.1f} ms, запросов: {new_queries}  (x{legacy_time / new_time:.1f})")
+    if legacy_phones == new_phones == units:
+        print("✅ Созданы все телефоны заказа.")
+    else:
+        print(f"❌ Создано телефонов: старая {legacy_phones}, новая {new_phones}, ожидалось {units}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк приемки заказа поставщика")
+    parser.add_argument("--units", type=int, default=1000)
+    parser.add_argument("--details", type=int, default=10)
+    parser.add_argument("--returned", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.units, args.details, args.returned))
@@ -0,0 +1,43 @@
+# check_account_balances.py
+# Сверка текущих балансов счетов (account_balances) с суммой операций cash_flow.
+#   python check_account_balances.py        - только отчет о расхождениях
+#   python check_account_balances.py --fix  - пересчитать балансы, если есть расхождения
+import argparse
+import asyncio
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app import balances  # noqa: E402
+from app.database import AsyncSessionLocal  # noqa: E402
+
+
+async def main(fix: bool):
+    async with AsyncSessionLocal() as session:
+        print("Сверяем балансы счетов с движением денег...")
+        drift = await balances.check_account_balances(session)
+        unassigned = await balances.get_unassigned_cash_flow_amount(session)
+        if unassigned:
+            print(f"⚠️ Операции без счета на сумму {unassigned} не входят ни в один баланс.")
+
+        if not drift:
+            print("✅ Расхождений нет.")
+            return
+
+        print(f"❌ Расхождения по {len(drift)} счетам:")
+        for row in drift:
+            print(f"  Счет {row['account_id']}: в таблице {row['ledger_balance']}, "
+                  f"по операциям {row['actual_balance']}, разница {row['drift']}")
+
+        if fix:
+            await balances.rebuild_account_balances(session)
+            await session.commit()
+            print("✅ Балансы пересчитаны.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сверка балансов счетов с cash_flow")
+    parser.add_argument("--fix", action="store_true", help="пересчитать балансы при расхождениях")
+    args = parser.parse_args()
+    asyncio.run(main(args.fix))
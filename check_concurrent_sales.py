@@ -0,0 +1,171 @@
+# check_concurrent_sales.py
+# Проверка блокировки остатков при параллельных продажах (crud.create_sale).
+#   python check_concurrent_sales.py --workers 8 --stock 3
+# Можно запускать повторно (данные каждого запуска уникальны и удаляются); при ошибках код выхода 1.
+# Сценарии:
+#   * один телефон (остаток 1) продают --workers запросов одновременно - успешна ровно одна продажа;
+#   * аксессуар с остатком --stock продают --workers запросов по одной штуке - успешно ровно --stock,
+#     остаток не уходит в минус.
+# Параллельные продажи идут в разных соединениях, поэтому тестовые данные фиксируются,
+# а в конце удаляются (вместе с созданными продажами и записями журнала) и дневные агрегаты
+# за сегодня пересчитываются. Продажи оформляются с доставкой - без платежей и движения денег.
+import argparse
+import asyncio
+import uuid
+from datetime import date
+from decimal import Decimal
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from fastapi import HTTPException  # noqa: E402
+from sqlalchemy import delete, func, select  # noqa: E402
+
+from app import crud, models, rollups, schemas  # noqa: E402
+from app.database import AsyncSessionLocal, engine  # noqa: E402
+
+DELIVERY_METHOD = "Проверка параллельных продаж"
+
+
+async def create_fixtures(stock: int) -> dict:
+    async with AsyncSessionLocal() as session:
+        model_id = (await session.execute(select(models.Models.id).limit(1))).scalar_one_or_none()
+        user_id = (await session.execute(select(models.Users.id).limit(1))).scalar_one_or_none()
+        if model_id is None or user_id is None:
+            raise SystemExit("В БД нет моделей или пользователей - загрузите справочники.")
+
+        suffix = uuid.uuid4().hex[:8].upper()
+        phone = models.Phones(serial_number=f"CONC{suffix}", model_id=model_id, purchase_price=Decimal("10000"),
+                              commercial_status=models.CommerceStatus.НА_СКЛАДЕ)
+        accessory = models.Accessories(name=f"Проверка параллельных продаж {suffix}", purchase_price=Decimal("100"))
+        session.add_all([phone, accessory])
+        await session.flush()
+        phone_entry = models.Warehouse(product_type_id=1, product_id=phone.id, quantity=1)
+        accessory_entry = models.Warehouse(product_type_id=2, product_id=accessory.id, quantity=stock)
+        session.add_all([phone_entry, accessory_entry])
+        await session.commit()
+        return {
+            "user_id": user_id,
+            "phone_id": phone.id,
+            "accessory_id": accessory.id,
+            "phone_warehouse_id": phone_entry.id,
+            "accessory_warehouse_id": accessory_entry.id,
+        }
+
+
+async def sell(start: asyncio.Event, warehouse_id: int, user_id: int) -> bool:
+    """Одна продажа в собственной сессии. True - продажа прошла, False - остатка не хватило."""
+    sale_data = schemas.SaleCreate(
+        details=[schemas.SaleDetailCreate(warehouse_id=warehouse_id, quantity=1, unit_price=Decimal("15000"))],
+        delivery_method=DELIVERY_METHOD,
+    )
+    async with AsyncSessionLocal() as session:
+        await start.wait()
+        try:
+            await crud.create_sale(session, sale_data, user_id)
+        except HTTPException as exc:
+            if exc.status_code != 400:
+                raise
+            return False
+    return True
+
+
+async def run_concurrently(warehouse_id: int, workers: int, user_id: int) -> int:
+    start = asyncio.Event()
+    tasks = [asyncio.create_task(sell(start, warehouse_id, user_id)) for _ in range(workers)]
+    await asyncio.sleep(0)
+    start.set()
+    return sum(await asyncio.gather(*tasks))
+
+
+async def collect_state(fixtures: dict) -> dict:
+    async with AsyncSessionLocal() as session:
+        quantities = dict((await session.execute(
+            select(models.Warehouse.id, models.Warehouse.quantity)
+            .where(models.Warehouse.id.in_([fixtures["phone_warehouse_id"], fixtures["accessory_warehouse_id"]]))
+        )).all())
+        sold = dict((await session.execute(
+            select(models.SaleDetails.warehouse_id, func.coalesce(func.sum(models.SaleDetails.quantity), 0))
+            .where(models.SaleDetails.warehouse_id.in_(quantities.keys()))
+            .group_by(models.SaleDetails.warehouse_id)
+        )).all())
+        sold_logs = (await session.execute(
+            select(func.count()).select_from(models.PhoneMovementLog).where(
+                models.PhoneMovementLog.phone_id == fixtures["phone_id"],
+                models.PhoneMovementLog.event_type == models.PhoneEventType.ПРОДАН,
+            )
+        )).scalar_one()
+        phone_status = (await session.execute(
+            select(models.Phones.commercial_status).where(models.Phones.id == fixtures["phone_id"])
+        )).scalar_one()
+    return {"quantities": quantities, "sold": sold, "sold_logs": sold_logs, "phone_status": phone_status}
+
+
+async def cleanup(fixtures: dict) -> None:
+    # Пересчеты агрегатов после commit продаж должны закончиться до удаления данных
+    await rollups.wait_pending()
+
+    warehouse_ids = [fixtures["phone_warehouse_id"], fixtures["accessory_warehouse_id"]]
+    async with AsyncSessionLocal() as session:
+        sale_ids = select(models.SaleDetails.sale_id).where(models.SaleDetails.warehouse_id.in_(warehouse_ids))
+        sale_ids = (await session.execute(sale_ids)).scalars().all()
+        await session.execute(delete(models.SaleDetails).where(models.SaleDetails.sale_id.in_(sale_ids)))
+        await session.execute(delete(models.Sales).where(models.Sales.id.in_(sale_ids)))
+        await session.execute(delete(models.PhoneMovementLog).where(models.PhoneMovementLog.phone_id == fixtures["phone_id"]))
+        await session.execute(delete(models.Warehouse).where(models.Warehouse.id.in_(warehouse_ids)))
+        await session.execute(delete(models.Phones).where(models.Phones.id == fixtures["phone_id"]))
+        await session.execute(delete(models.Accessories).where(models.Accessories.id == fixtures["accessory_id"]))
+        await rollups.refresh_daily_rollups(session, [date.today()])
+        await session.commit()
+
+
+async def main(workers: int, stock: int):
+    errors = []
+
+    def expect(condition: bool, message: str):
+        if not condition:
+            errors.append(message)
+
+    fixtures = await create_fixtures(stock)
+    try:
+        print(f"Продаем один телефон {workers} параллельными запросами...")
+        phone_sales = await run_concurrently(fixtures["phone_warehouse_id"], workers, fixtures["user_id"])
+        print(f"Продаем аксессуар (остаток {stock}) {workers} параллельными запросами...")
+        accessory_sales = await run_concurrently(fixtures["accessory_warehouse_id"], workers, fixtures["user_id"])
+
+        state = await collect_state(fixtures)
+        phone_wid, accessory_wid = fixtures["phone_warehouse_id"], fixtures["accessory_warehouse_id"]
+        expect(phone_sales == 1, f"телефон продан {phone_sales} раз(а) вместо одного")
+        expect(state["quantities"][phone_wid] == 0, f"остаток телефона {state['quantities'][phone_wid]} вместо 0")
+        expect(state["sold"].get(phone_wid, 0) == 1, f"позиций продажи по телефону: {state['sold'].get(phone_wid, 0)}")
+        expect(state["sold_logs"] == 1, f"записей о продаже в журнале телефона: {state['sold_logs']}")
+        expect(state["phone_status"] == models.CommerceStatus.ОТПРАВЛЕН_КЛИЕНТУ,
+               f"статус телефона {state['phone_status']}")
+
+        expected_accessory_sales = min(stock, workers)
+        expect(accessory_sales == expected_accessory_sales,
+               f"аксессуар продан {accessory_sales} раз(а) вместо {expected_accessory_sales}")
+        expect(state["quantities"][accessory_wid] == stock - expected_accessory_sales,
+               f"остаток аксессуара {state['quantities'][accessory_wid]} вместо {stock - expected_accessory_sales}")
+        expect(state["sold"].get(accessory_wid, 0) == accessory_sales,
+               "продано аксессуаров больше, чем прошло продаж")
+        expect(min(state["quantities"].values()) >= 0, "остаток ушел в минус")
+    finally:
+        await cleanup(fixtures)
+        await engine.dispose()
+
+    if errors:
+        print(f"❌ Найдено ошибок: {len(errors)}")
+        for error in errors:
+            print(f"  - {error}")
+        raise SystemExit(1)
+    print("✅ Параллельные продажи не продают товар сверх остатка.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка параллельных продаж одной складской позиции")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--stock", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.workers, args.stock))
@@ -0,0 +1,129 @@
+# check_phone_history.py
+# Проверка эндпоинта истории телефона (main.get_phone_history) с разделами по умолчанию.
+#   python check_phone_history.py
+# Телефоны, склад и продажи создаются внутри внешней транзакции и в конце откатываются.
+# Проверяется, что в историю попадают последняя складская запись и последняя продажа по ней,
+# что телефон без склада отдается без этих разделов и что продавцу не видны закупка и инспекции.
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import select  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession  # noqa: E402
+
+from app import models, security  # noqa: E402
+from app.database import engine  # noqa: E402
+from app.main import get_phone_history  # noqa: E402
+
+
+def principal(permissions) -> security.Principal:
+    return security.Principal(
+        id=0, username="check_phone_history", active=True, role_id=None, permissions=frozenset(permissions)
+    )
+
+
+async def create_fixtures(db: AsyncSession) -> dict:
+    model_id = (await db.execute(select(models.Models.id).limit(1))).scalar_one_or_none()
+    if model_id is None:
+        raise SystemExit("В БД нет моделей - загрузите справочники.")
+
+    suffix = uuid.uuid4().hex[:8].upper()
+    sold_phone = models.Phones(serial_number=f"CHK{suffix}S", model_id=model_id, purchase_price=Decimal("10000"),
+                               commercial_status=models.CommerceStatus.ПРОДАН)
+    new_phone = models.Phones(serial_number=f"CHK{suffix}N", model_id=model_id,
+                              commercial_status=models.CommerceStatus.НЕ_ГОТОВ_К_ПРОДАЖЕ)
+    old_shop = models.Shops(name=f"Проверка {suffix} (старый)")
+    new_shop = models.Shops(name=f"Проверка {suffix} (новый)")
+    customer = models.Customers(name=f"Покупатель {suffix}", number="+70000000000")
+    db.add_all([sold_phone, new_phone, old_shop, new_shop, customer])
+    await db.flush()
+
+    now = datetime.now()
+    # Две складские записи: в историю должна попасть более поздняя (с большим id)
+    old_entry = models.Warehouse(product_type_id=1, product_id=sold_phone.id, quantity=0,
+                                 shop_id=old_shop.id, added_date=now - timedelta(days=10))
+    new_entry = models.Warehouse(product_type_id=1, product_id=sold_phone.id, quantity=0,
+                                 shop_id=new_shop.id, added_date=now - timedelta(days=1))
+    db.add_all([old_entry, new_entry])
+    await db.flush()
+
+    # По последней складской записи - две продажи (продажа, возврат, повторная продажа)
+    first_sale = models.Sales(sale_date=now - timedelta(hours=5), customer_id=customer.id,
+                              total_amount=Decimal("15000"), payment_status=models.StatusPay.ОПЛАЧЕН)
+    last_sale = models.Sales(sale_date=now, customer_id=customer.id,
+                             total_amount=Decimal("14000"), payment_status=models.StatusPay.ОПЛАЧЕН)
+    db.add_all([first_sale, last_sale])
+    await db.flush()
+    db.add_all([
+        models.SaleDetails(sale_id=first_sale.id, warehouse_id=new_entry.id, quantity=1, unit_price=Decimal("15000")),
+        models.SaleDetails(sale_id=last_sale.id, warehouse_id=new_entry.id, quantity=1, unit_price=Decimal("14000")),
+    ])
+    await db.flush()
+
+    return {
+        "sold_serial": sold_phone.serial_number,
+        "new_serial": new_phone.serial_number,
+        "shop_name": new_shop.name,
+        "last_sale_id": last_sale.id,
+        "customer_name": customer.name,
+    }
+
+
+async def main():
+    errors = []
+
+    def expect(condition: bool, message: str):
+        if not condition:
+            errors.append(message)
+
+    async with engine.connect() as conn:
+        outer = await conn.begin()
+        db = AsyncSession(bind=conn, join_transaction_mode="create_savepoint", expire_on_commit=False)
+        try:
+            fixtures = await create_fixtures(db)
+            manager = principal({"manage_inventory"})
+            salesperson = principal({"perform_sales"})
+
+            print("Запрашиваем историю проданного телефона (разделы по умолчанию)...")
+            history = await get_phone_history(fixtures["sold_serial"], None, db, manager)
+            expect(history.serial_number == fixtures["sold_serial"], "вернулся не тот телефон")
+            expect(history.warehouse_info is not None, "нет раздела склада")
+            if history.warehouse_info:
+                expect(history.warehouse_info.shop_name == fixtures["shop_name"],
+                       f"склад взят не из последней записи: {history.warehouse_info.shop_name}")
+            expect(history.sale_info is not None, "нет раздела продажи")
+            if history.sale_info:
+                expect(history.sale_info.sale_id == fixtures["last_sale_id"],
+                       f"продажа не последняя: №{history.sale_info.sale_id}")
+                expect(history.sale_info.customer_name == fixtures["customer_name"], "не подтянулся покупатель")
+
+            print("Запрашиваем историю телефона без складских записей...")
+            history = await get_phone_history(fixtures["new_serial"], None, db, manager)
+            expect(history.warehouse_info is None and history.sale_info is None,
+                   "у телефона без склада есть разделы склада или продажи")
+
+            print("Запрашиваем историю от имени продавца...")
+            history = await get_phone_history(fixtures["sold_serial"], None, db, salesperson)
+            expect(history.purchase_info is None and not history.inspections,
+                   "продавцу видны закупка или инспекции")
+            expect(history.sale_info is not None, "продавцу не виден раздел продажи")
+        finally:
+            await db.close()
+            await outer.rollback()
+    await engine.dispose()
+
+    if errors:
+        print(f"❌ Найдено ошибок: {len(errors)}")
+        for error in errors:
+            print(f"  - {error}")
+    else:
+        print("✅ История телефона с разделами по умолчанию собирается корректно.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,205 @@
+# check_waiting_list_notifications.py
+# Проверка сопоставления поступивших телефонов с листом ожидания (crud._notify_waiting_list_for_phones).
+#   python check_waiting_list_notifications.py
+# Сценарии на временных моделях:
+#   * телефонов в партии больше, чем заявок, и меньше, чем заявок;
+#   * партия из разных моделей;
+#   * заявки разбираются в порядке created_at (а не id), одна заявка на телефон;
+#   * у каждой уведомленной заявки ровно одна строка в notification_outbox и status = 1;
+#   * две параллельные приемки не уведомляют одну заявку дважды (FOR UPDATE SKIP LOCKED).
+# Первые сценарии выполняются во внешней транзакции и откатываются. Параллельным приемкам
+# нужны разные соединения, поэтому их данные фиксируются и в конце удаляются.
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import delete, func, select  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession  # noqa: E402
+
+from app import crud, models  # noqa: E402
+from app.database import AsyncSessionLocal, engine  # noqa: E402
+
+LOCK_WAIT_SECONDS = 5
+
+
+class Checker:
+    def __init__(self):
+        self.errors = []
+
+    def expect(self, condition: bool, message: str):
+        if not condition:
+            self.errors.append(message)
+
+
+async def create_model(db: AsyncSession) -> int:
+    """Временная модель с названием существующей: на нее нет чужих заявок в листе ожидания."""
+    source = (await db.execute(select(models.Models).limit(1))).scalar_one_or_none()
+    if source is None:
+        raise SystemExit("В БД нет моделей - загрузите справочники.")
+    model = models.Models(model_name_id=source.model_name_id, storage_id=source.storage_id, color_id=source.color_id)
+    db.add(model)
+    await db.flush()
+    return model.id
+
+
+async def create_entries(db: AsyncSession, model_id: int, user_id: int, ages_in_minutes) -> list:
+    """Заявки в порядке вставки (по возрастанию id) с заданным возрастом: очередь задает created_at."""
+    now = datetime.now()
+    entries = [
+        models.WaitingList(customer_name=f"Клиент {uuid.uuid4().hex[:6]}", customer_phone="+70000000000",
+                           model_id=model_id, user_id=user_id, created_at=now - timedelta(minutes=age))
+        for age in ages_in_minutes
+    ]
+    db.add_all(entries)
+    await db.flush()
+    return [entry.id for entry in entries]
+
+
+async def create_phones(db: AsyncSession, model_ids) -> list:
+    phones = [models.Phones(serial_number=f"WL{uuid.uuid4().hex[:10].upper()}", model_id=model_id) for model_id in model_ids]
+    db.add_all(phones)
+    await db.flush()
+    return [phone.id for phone in phones]
+
+
+async def load_phones(db: AsyncSession, phone_ids) -> list:
+    result = await db.execute(select(models.Phones).where(models.Phones.id.in_(phone_ids)))
+    by_id = {phone.id: phone for phone in result.scalars().all()}
+    return [by_id[phone_id] for phone_id in phone_ids]
+
+
+async def notification_state(db: AsyncSession, entry_ids) -> dict:
+    """{waiting_list_id: (status, число строк в outbox)}"""
+    statuses = dict((await db.execute(
+        select(models.WaitingList.id, models.WaitingList.status).where(models.WaitingList.id.in_(entry_ids))
+    )).all())
+    outbox = dict((await db.execute(
+        select(models.NotificationOutbox.waiting_list_id, func.count())
+        .where(models.NotificationOutbox.waiting_list_id.in_(entry_ids),
+               models.NotificationOutbox.kind == "waiting_list")
+        .group_by(models.NotificationOutbox.waiting_list_id)
+    )).all())
+    return {entry_id: (statuses[entry_id], outbox.get(entry_id, 0)) for entry_id in entry_ids}
+
+
+async def accept(db: AsyncSession, phone_ids) -> None:
+    await crud._notify_waiting_list_for_phones(db, await load_phones(db, phone_ids))
+    await db.flush()
+
+
+def expect_notified(checker: Checker, scenario: str, state: dict, notified, waiting) -> None:
+    for entry_id in notified:
+        checker.expect(state[entry_id] == (1, 1), f"{scenario}: заявка {entry_id} не уведомлена ровно один раз: {state[entry_id]}")
+    for entry_id in waiting:
+        checker.expect(state[entry_id] == (0, 0), f"{scenario}: заявка {entry_id} не должна уведомляться: {state[entry_id]}")
+
+
+async def check_batches(checker: Checker, user_id: int) -> None:
+    async with engine.connect() as conn:
+        outer = await conn.begin()
+        db = AsyncSession(bind=conn, join_transaction_mode="create_savepoint", expire_on_commit=False)
+        try:
+            model_a = await create_model(db)
+            model_b = await create_model(db)
+
+            print("Телефонов больше, чем заявок...")
+            entries = await create_entries(db, model_a, user_id, [30, 20])
+            await accept(db, await create_phones(db, [model_a] * 3))
+            expect_notified(checker, "телефонов больше", await notification_state(db, entries), entries, [])
+
+            print("Телефонов меньше, чем заявок (очередь по created_at)...")
+            # id растет, а самая старая заявка - вторая: уведомляются вторая и третья
+            entries = await create_entries(db, model_a, user_id, [10, 50, 40])
+            await accept(db, await create_phones(db, [model_a] * 2))
+            expect_notified(checker, "телефонов меньше", await notification_state(db, entries),
+                            [entries[1], entries[2]], [entries[0]])
+
+            print("Партия из разных моделей...")
+            waiting_a = entries[0]
+            entries_b = await create_entries(db, model_b, user_id, [15, 5, 25])
+            await accept(db, await create_phones(db, [model_b, model_a, model_b, model_a]))
+            # Модель A: осталась одна заявка на два телефона; модель B: два телефона на три заявки
+            expect_notified(checker, "разные модели", await notification_state(db, [waiting_a, *entries_b]),
+                            [waiting_a, entries_b[2], entries_b[0]], [entries_b[1]])
+
+            messages = (await db.execute(
+                select(models.NotificationOutbox.text).where(models.NotificationOutbox.waiting_list_id.in_(entries_b))
+            )).scalars().all()
+            checker.expect(all(not message.startswith("🔔 Появился ,") for message in messages),
+                           "в уведомлении нет названия модели")
+        finally:
+            await db.close()
+            await outer.rollback()
+
+
+async def check_concurrent_acceptance(checker: Checker, user_id: int) -> None:
+    async with AsyncSessionLocal() as session:
+        model_id = await create_model(session)
+        entries = await create_entries(session, model_id, user_id, [30, 20, 10, 5, 1])
+        phone_ids = await create_phones(session, [model_id] * 5)
+        await session.commit()
+
+    try:
+        print("Вторая приемка, пока первая держит блокировки заявок...")
+        async with AsyncSessionLocal() as first, AsyncSessionLocal() as second:
+            await accept(first, phone_ids[:1])
+            try:
+                await asyncio.wait_for(accept(second, phone_ids[1:2]), LOCK_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                checker.expect(False, "вторая приемка ждет блокировки заявок вместо SKIP LOCKED")
+                await second.rollback()
+            await first.commit()
+            await second.commit()
+
+        print("Три приемки одновременно...")
+
+        async def accept_in_own_session(ids):
+            async with AsyncSessionLocal() as session:
+                await accept(session, ids)
+                await session.commit()
+
+        await asyncio.gather(*(accept_in_own_session([phone_id]) for phone_id in phone_ids[2:]))
+
+        async with AsyncSessionLocal() as session:
+            state = await notification_state(session, entries)
+        for entry_id, (entry_status, outbox_rows) in state.items():
+            checker.expect(outbox_rows <= 1, f"параллельные приемки: заявка {entry_id} уведомлена {outbox_rows} раз(а)")
+            checker.expect((entry_status == 1) == (outbox_rows == 1),
+                           f"параллельные приемки: у заявки {entry_id} статус {entry_status} и {outbox_rows} уведомлений")
+        checker.expect(state[entries[0]][0] == 1, "параллельные приемки: самая старая заявка не уведомлена")
+    finally:
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(models.NotificationOutbox).where(models.NotificationOutbox.waiting_list_id.in_(entries)))
+            await session.execute(delete(models.WaitingList).where(models.WaitingList.id.in_(entries)))
+            await session.execute(delete(models.Phones).where(models.Phones.id.in_(phone_ids)))
+            await session.execute(delete(models.Models).where(models.Models.id == model_id))
+            await session.commit()
+
+
+async def main():
+    checker = Checker()
+    async with AsyncSessionLocal() as session:
+        user_id = (await session.execute(select(models.Users.id).limit(1))).scalar_one_or_none()
+    if user_id is None:
+        raise SystemExit("В БД нет пользователей.")
+
+    try:
+        await check_batches(checker, user_id)
+        await check_concurrent_acceptance(checker, user_id)
+    finally:
+        await engine.dispose()
+
+    if checker.errors:
+        print(f"❌ Найдено ошибок: {len(checker.errors)}")
+        for error in checker.errors:
+            print(f"  - {error}")
+    else:
+        print("✅ Лист ожидания: очередь по created_at, одна заявка на телефон, без повторных уведомлений.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
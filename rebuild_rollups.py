@@ -0,0 +1,30 @@
+# rebuild_rollups.py
+# Пересборка дневных агрегатов аналитики (daily_*_rollup).
+#   python rebuild_rollups.py                              - за всю историю
+#   python rebuild_rollups.py --start 2025-01-01 --end 2025-03-31
+import argparse
+import asyncio
+from datetime import date
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app import rollups  # noqa: E402
+from app.database import AsyncSessionLocal  # noqa: E402
+
+
+async def main(start_day, end_day):
+    async with AsyncSessionLocal() as session:
+        print("Пересобираем дневные агрегаты...")
+        await rollups.rebuild_daily_rollups(session, start_day, end_day)
+        await session.commit()
+        print("✅ Готово.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пересборка дневных агрегатов аналитики")
+    parser.add_argument("--start", type=date.fromisoformat, help="первый день (YYYY-MM-DD)")
+    parser.add_argument("--end", type=date.fromisoformat, help="последний день (YYYY-MM-DD)")
+    args = parser.parse_args()
+    asyncio.run(main(args.start, args.end))
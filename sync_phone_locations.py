@@ -0,0 +1,37 @@
+# sync_phone_locations.py
+# Пересборка и проверка проекции phone_current_location.
+#   python sync_phone_locations.py            - проверить расхождения
+#   python sync_phone_locations.py --rebuild  - пересобрать проекцию из warehouse
+import argparse
+import asyncio
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app import crud  # noqa: E402
+from app.database import AsyncSessionLocal  # noqa: E402
+
+
+async def main(rebuild: bool):
+    async with AsyncSessionLocal() as session:
+        if rebuild:
+            print("Пересобираем phone_current_location...")
+            count = await crud.rebuild_phone_current_locations(session)
+            print(f"Готово. Записей в проекции: {count}.")
+
+        mismatches = await crud.verify_phone_current_locations(session)
+        if not mismatches:
+            print("✅ Проекция совпадает с историей склада.")
+            return
+
+        print(f"❌ Найдено расхождений: {len(mismatches)}")
+        for item in mismatches[:50]:
+            print(f"   {item}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка/пересборка phone_current_location")
+    parser.add_argument("--rebuild", action="store_true", help="пересобрать проекцию перед проверкой")
+    args = parser.parse_args()
+    asyncio.run(main(args.rebuild))